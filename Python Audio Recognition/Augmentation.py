@@ -0,0 +1,138 @@
+import time
+import numpy as np
+from itertools import product
+import ConvertMidiToFeatures
+import Metrics
+import QuantizedIndex
+
+# Clips handed to training at a time, a catalog gets one segment per chunk
+CHUNK_CLIPS = 100000
+
+
+def variantCombos(augmentation):
+    '''
+    returns the (offset, secondsPerClip) of every spread and tempo variant of
+    a store's augmentation settings, leaving out the base clips the store
+    already holds
+    '''
+    offset = augmentation["offset"]
+    secondsPerClip = augmentation["secondsPerClip"]
+    spRange, tmpRange = ConvertMidiToFeatures.augmentationRanges(
+        secondsPerClip, augmentation["spread"], augmentation["tempoSpread"])
+    return [(offset+i, secondsPerClip+j) for i, j in product(spRange, tmpRange)
+            if (i, j) != (0, 0)]
+
+
+def songVariants(events, augmentation, featuresPerClip, budget=None, rng=None):
+    '''
+    returns the variant clips of one song's events, at most budget of them
+    picked at random when a budget is given
+    '''
+    clips = ConvertMidiToFeatures.midiToFeatureArray(
+        events, featuresPerClip=featuresPerClip, combos=variantCombos(augmentation))
+    if budget is not None and len(clips) > budget:
+        rng = rng if rng is not None else np.random.default_rng()
+        clips = clips[np.sort(rng.choice(len(clips), budget, replace=False))]
+    return clips
+
+
+def variantRows(events, augmentation, featuresPerClip, budget=None):
+    '''
+    returns the most variant clips songVariants can make of one song's
+    events, found from the song's length without taking any features. Clips
+    with too few notes are dropped later, so there may be fewer.
+    '''
+    timeoffs = ConvertMidiToFeatures.eventsToArrays(events)[3]
+    if len(timeoffs) == 0:
+        return 0
+    rows = 0
+    for offset, secondsPerClip in variantCombos(augmentation):
+        # The bins midiToFeatureArray makes for the combination, in whole clips
+        end = ConvertMidiToFeatures.timeToIndexArray(timeoffs, secondsPerClip, featuresPerClip, offset)
+        rows += -(-max(int(end.max()), 0)//featuresPerClip)
+    return rows if budget is None else min(rows, budget)
+
+
+def trainingRows(store, budget=None):
+    '''
+    returns the most clips trainingChunks can yield for a store, every base
+    clip and at most variantRows variants of each song
+    '''
+    if not store.hasEvents():
+        return store.clipCount
+    return store.clipCount+sum(variantRows(store.songEvents(x), store.augmentation, store.featuresPerClip, budget=budget)
+                               for x in store.songs)
+
+
+def augmentedSongs(store, budget=None, seed=0, stats=None, songs=None):
+    '''
+    yields (class name, song name, clips) for every song of a feature store,
+    or of songs if given, the stored base clips followed by variants made
+    from the song's events. Only one song's variants are held at a time.
+    stats, if given, is a dict the generated clip count, bytes and seconds
+    are added to.
+    '''
+    rng = np.random.default_rng(seed)
+    for song in (store.songs if songs is None else songs):
+        clips = store.songClips(song)
+        if store.hasEvents():
+            startTime = time.perf_counter()
+            with Metrics.stage("augment", song["name"], events=song["eventCount"]) as counts:
+                variants = songVariants(store.songEvents(song), store.augmentation,
+                                        store.featuresPerClip, budget=budget, rng=rng)
+                counts["clips"] = len(variants)
+            if stats is not None:
+                stats["clips"] = stats.get("clips", 0)+len(variants)
+                stats["bytes"] = stats.get("bytes", 0)+len(variants)*store.rowBytes
+                stats["seconds"] = stats.get("seconds", 0)+time.perf_counter()-startTime
+            if len(variants) > 0:
+                # Variants get the same rounding as the stored clips
+                if store.quantized:
+                    variants = QuantizedIndex.unpack(QuantizedIndex.pack(variants), store.featuresPerClip)
+                    clips = np.asarray(clips)
+                clips = np.concatenate([clips, variants.astype(clips.dtype)])
+        yield store.classNames[song["class"]], song["name"], clips
+
+
+def trainingChunks(store, chunkClips=CHUNK_CLIPS, budget=None, seed=0, stats=None):
+    '''
+    yields (clips, class numbers) chunks of at least chunkClips clips (the
+    last one may be smaller) of every base and variant clip of the store.
+    Chunks of a uint8 store are QuantizedClips.
+    '''
+    classNumbers = {x: i for i, x in enumerate(store.classNames)}
+    clips = []
+    labels = []
+    held = 0
+
+    def chunk():
+        joined = np.concatenate(clips)
+        if store.quantized:
+            joined = QuantizedIndex.QuantizedClips(QuantizedIndex.pack(joined), store.featuresPerClip)
+        return joined, np.concatenate(labels)
+    for className, name, songClips in augmentedSongs(store, budget=budget, seed=seed, stats=stats):
+        clips.append(np.asarray(songClips, dtype=np.float32))
+        labels.append(np.full(len(songClips), classNumbers[className], dtype=np.int32))
+        held += len(songClips)
+        if held >= chunkClips:
+            yield chunk()
+            clips = []
+            labels = []
+            held = 0
+    if held > 0:
+        yield chunk()
+
+
+def reportSavings(store, stats, loadSeconds=None):
+    '''
+    prints what generating the variants saved over writing them into the store
+    '''
+    onDisk = store.bytesOnDisk()
+    eventBytes = store.eventCount*store.events.dtype.itemsize
+    materialized = onDisk-eventBytes+stats.get("bytes", 0)
+    print("Generated {} variant clips, {:.1f} MB, in {:.2f}s. The store holds {:.1f} MB on disk "
+          "instead of {:.1f} MB, {:.1f} MB saved".format(
+              stats.get("clips", 0), stats.get("bytes", 0)/2**20, stats.get("seconds", 0), onDisk/2**20,
+              materialized/2**20, (materialized-onDisk)/2**20))
+    if loadSeconds is not None:
+        print("Stored clips loaded in {:.2f}s".format(loadSeconds))
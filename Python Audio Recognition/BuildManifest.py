@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+from collections import Counter
+
+# Bump when a change to the converters changes what they output, so every
+# artifact built by an older version gets rebuilt
+TOOL_VERSION = "2"
+
+
+def fileHash(path, blockSize=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blockSize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class BuildManifest:
+    '''
+    Remembers, for every artifact built, the hash of the file it was built
+    from, the parameters it was built with and the tool version. Artifacts
+    are grouped by stage, e.g. "midi" or "features".
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.stages = json.loads(f.read())["stages"]
+        self.hashes = {}
+
+    def artifacts(self, stage):
+        return self.stages.setdefault(stage, {})
+
+    def sourceHash(self, source):
+        # Sources are read at most once per run
+        if source not in self.hashes:
+            self.hashes[source] = fileHash(source)
+        return self.hashes[source]
+
+    def check(self, stage, output, source, params, outputExists):
+        '''
+        returns why output has to be rebuilt, or None if it is up to date
+        '''
+        entry = self.artifacts(stage).get(output)
+        if entry is None:
+            return "new"
+        if not outputExists:
+            return "output missing"
+        if entry["tool"] != TOOL_VERSION:
+            return "tool version changed"
+        if entry["params"] != params:
+            return "parameters changed"
+        if entry["hash"] != self.sourceHash(source):
+            return "source changed"
+        return None
+
+    def record(self, stage, output, source, params):
+        self.artifacts(stage)[output] = {"source": source, "hash": self.sourceHash(source),
+                                         "params": params, "tool": TOOL_VERSION}
+
+    def forget(self, stage, output):
+        self.artifacts(stage).pop(output, None)
+
+    def plan(self, stage, sources, params, outputExists):
+        '''
+        sources is {output: source path}. returns a StagePlan of the outputs
+        to rebuild, the ones to skip and the ones whose source was deleted
+        '''
+        plan = StagePlan(stage)
+        for output in sorted(sources):
+            reason = self.check(stage, output, sources[output], params, outputExists(output))
+            if reason:
+                plan.rebuild.append(output)
+                plan.reasons[output] = reason
+            else:
+                plan.skipped.append(output)
+        for output, entry in self.artifacts(stage).items():
+            if output not in sources and not os.path.exists(entry["source"]):
+                plan.removed.append(output)
+        return plan
+
+    def save(self):
+        parentFolder = os.path.dirname(self.path)
+        if parentFolder != "" and not os.path.exists(parentFolder):
+            os.makedirs(parentFolder)
+        tempPath = self.path+".tmp"
+        with open(tempPath, "w") as f:
+            f.write(json.dumps({"tool": TOOL_VERSION, "stages": self.stages}, indent=1))
+        os.replace(tempPath, self.path)
+
+
+class StagePlan:
+    def __init__(self, stage):
+        self.stage = stage
+        self.rebuild = []
+        self.skipped = []
+        self.removed = []
+        self.reasons = {}
+        self.failed = []
+
+    def summary(self):
+        reasons = Counter(self.reasons[x] for x in self.rebuild if x not in self.failed)
+        reasonText = ", ".join("{} {}".format(reasons[x], x) for x in sorted(reasons))
+        line = "{}: rebuilt {}".format(self.stage, len(self.rebuild)-len(self.failed))
+        if reasonText:
+            line += " ({})".format(reasonText)
+        line += ", skipped {} (unchanged), removed {} (source deleted)".format(
+            len(self.skipped), len(self.removed))
+        if self.failed:
+            line += ", failed {}".format(len(self.failed))
+        return line
@@ -0,0 +1,69 @@
+import time
+import numpy as np
+from sklearn.neighbors import KDTree, BallTree
+
+TREE_TYPES = {"kd": KDTree, "ball": BallTree}
+
+
+class ClipIndex:
+    '''
+    Nearest neighbour model over clip vectors. fit and predict work like the
+    sklearn classifiers, rankSongs returns ranked candidate songs for all the
+    clips of one query.
+    '''
+
+    def __init__(self, treeType="kd", neighbours=10, leafSize=40):
+        self.treeType = treeType
+        self.neighbours = neighbours
+        self.leafSize = leafSize
+        self.tree = None
+        self.classes = None
+
+    def fit(self, data, classes):
+        startTime = time.time()
+        self.classes = np.asarray(classes, dtype=np.int32)
+        self.tree = TREE_TYPES[self.treeType](
+            np.asarray(data, dtype=np.float64), leaf_size=self.leafSize)
+        self.buildTime = time.time()-startTime
+        print("Built {} tree over {} clips in {:.2f}s".format(
+            self.treeType, len(self.classes), self.buildTime))
+        return self
+
+    def query(self, data, neighbours=None):
+        '''
+        returns the distances and classes of the nearest clips to every clip
+        '''
+        k = min(neighbours or self.neighbours, len(self.classes))
+        distances, indices = self.tree.query(
+            np.asarray(data, dtype=np.float64), k=k)
+        return distances, self.classes[indices]
+
+    def predict(self, data):
+        distances, classes = self.query(data, neighbours=1)
+        return classes[:, 0]
+
+    def rankSongs(self, data, top=5):
+        '''
+        returns [(class, score, mean distance), ...] best first. Every
+        neighbour of every query clip votes for its song with a weight of
+        1/(1+distance), the score is the summed weight over the neighbour
+        count so it falls between 0 and 1.
+        '''
+        distances, classes = self.query(data)
+        return rankNeighbours(distances, classes, top=top)
+
+
+def rankNeighbours(distances, classes, top=5):
+    '''
+    aggregates (clips, neighbours) distance and class arrays into ranked songs
+    '''
+    if len(distances) == 0:
+        return []
+    distances = distances.ravel()
+    classes = classes.ravel()
+    found, inverse = np.unique(classes, return_inverse=True)
+    scores = np.bincount(inverse, weights=1/(1+distances))/len(distances)
+    meanDistances = np.bincount(inverse, weights=distances)/np.bincount(inverse)
+
+    order = np.argsort(-scores, kind="stable")[:top]
+    return [(int(found[i]), float(scores[i]), float(meanDistances[i])) for i in order]
@@ -6,65 +6,70 @@ import math
 import os
 import json
 import FileManagement
+import FeatureStore
+import NumpyTranscriber
+import MidiDecoder
+import HarmonicCleanup
+import Metrics
 import shutil
 from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import progressbar
 import heapq
 
 
-def convertMidiToEvents(midifile):
-    '''
-    returns ['note', 'velocity', 'time on', 'time off']s
-    '''
-    mid = mido.MidiFile(midifile)
-    events = []
-    for track in mid.tracks:
-        tick = 0
-        currentTime = 0
-        holdoverNotes = {}
-        for msg in track:
-            if msg.__class__.__name__ is not "MetaMessage":
-                # Update the summed time
-                tick += msg.time
-                currentTime = mido.tick2second(
-                    tick, mid.ticks_per_beat, 500000)
-
-                if msg.type == 'note_on':
-                    holdoverNotes[msg.note] = [
-                        msg.note, msg.velocity, currentTime]
-                elif msg.type == 'note_off':
-                    # TODO maybe it should check if we're in a new feature first?
-                    #
-                    # Once a note is released, add it to to the current feature
-                    info = holdoverNotes.pop(msg.note)
-                    info.append(currentTime)
-                    events.append(info)
-        if len(holdoverNotes.keys()) > 0:
-            raise Exception("Notes didn't end")
-    return events
+def convertMidiToEvents(midifile, cacheFolder=None):
+    '''
+    returns the notes as a MidiDecoder.EVENT_DTYPE array, rows unpack to
+    'note', 'velocity', 'time on', 'time off'
+    '''
+    return MidiDecoder.loadMidiEvents(midifile, cacheFolder=cacheFolder)
 
 
-def convertEventsToMidi(events):
+def convertEventsToMidi(events, outputFile=None):
+    '''
+    builds a midi file from ['note', 'velocity', 'time on', 'time off']s,
+    and saves it when outputFile is given
+    '''
     midievents = []
     for note, velocity, timeon, timeoff in events:
-        heapq.heappush(midievents, (timeon, "on", note, velocity))
-        heapq.heappush(midievents, (timeoff, "off", note, velocity))
+        heapq.heappush(midievents, (timeon, "on", int(note), int(velocity)))
+        heapq.heappush(midievents, (timeoff, "off", int(note), int(velocity)))
+    # "off" sorts before "on", so a repeated note is released before it restarts
     midievents = [heapq.heappop(midievents) for x in range(len(midievents))]
 
     mid = mido.MidiFile()
     t = mid.add_track(name="Test Track")
     lastTick = 0
-    for ev in events:
-        tick = mido.second2tick(ev[0], mid.ticks_per_beat, 500000)
+    for timeStamp, kind, note, velocity in midievents:
+        # Round the absolute tick so rounding errors don't add up
+        tick = math.floor(mido.second2tick(
+            timeStamp, mid.ticks_per_beat, 500000) + 0.5)
         tickDif = tick - lastTick
         lastTick = tick
-        mType = "note_on" if ev[2] == "on" else "note_off"
-        tickDif += 0.5
-        tickDif = math.floor(tickDif)
-        t.append(mido.Message(mType, note=ev[1], time=tickDif))
+        if kind == "on":
+            t.append(mido.Message("note_on", note=note,
+                                  velocity=velocity, time=tickDif))
+        else:
+            t.append(mido.Message("note_off", note=note, time=tickDif))
 
     t.append(mido.MetaMessage("end_of_track"))
-    return midievents
+    if outputFile:
+        mid.save(outputFile)
+    return mid
+
+
+def loadEvents(inputFile, eventCache=None):
+    '''
+    returns the events of a midi file, or of a wav file transcribed with the
+    numpy transcriber
+    '''
+    isWav = os.path.splitext(inputFile)[1].lower() == ".wav"
+    with Metrics.stage("transcribe" if isWav else "decode", inputFile, bytes=os.path.getsize(inputFile)) as counts:
+        events = NumpyTranscriber.wavToEvents(
+            inputFile) if isWav else convertMidiToEvents(inputFile, cacheFolder=eventCache)
+        counts["events"] = len(events)
+    return events
 
 
 def timetoindex(time, cliplength, featurecount, offset):
@@ -79,35 +84,136 @@ def timetoindex(time, cliplength, featurecount, offset):
 
 
 def midiToFeatures(events, offset=0, secondsPerClip=20, featuresPerClip=40):
-    # mid = mido.MidiFile(fileName)
+    return midiToFeatureArray(events, offsets=[offset], secondsPerClips=[secondsPerClip],
+                              featuresPerClip=featuresPerClip).tolist()
 
-    # fullTime = mid.length
-    numFeatures = featuresPerClip
 
-    secondsPerFeature = secondsPerClip/featuresPerClip
-    features = []
-    for note, velocity, timeon, timeoff in events:
-        pass
-        start = timetoindex(timeon, secondsPerClip, featuresPerClip, offset)
-        end = timetoindex(timeoff, secondsPerClip, featuresPerClip, offset)
-        while len(features) < end:
-            features.append([])
-        for i in range(start, end, 1):
-            features[i].append((note, velocity))
-    while(len(features) % featuresPerClip != 0):
-        features.append([])
-    lengths = list(map(len, features))
-    avgfeatures = list(map(notesAverage, features))
-    clips = []
-    for i in range(int(len(avgfeatures)//featuresPerClip)):
-        normalized = normalizeData(
-            avgfeatures[int(i*numFeatures):int((i+1)*numFeatures)])
-        if normalized != None:
-            clips.append(normalized)
+def eventsToArrays(events):
+    '''
+    returns the note, velocity, time on and time off columns of an event list
+    '''
+    if len(events) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0), np.zeros(0))
+    if isinstance(events, np.ndarray) and events.dtype.names:
+        names = events.dtype.names
+        return (events[names[0]].astype(np.int64), events[names[1]].astype(np.int64),
+                events[names[2]].astype(np.float64), events[names[3]].astype(np.float64))
+    table = np.asarray(events, dtype=np.float64)
+    return (table[:, 0].astype(np.int64), table[:, 1].astype(np.int64),
+            table[:, 2], table[:, 3])
+
+
+def timeToIndexArray(times, cliplength, featurecount, offset):
+    '''
+    vectorized timetoindex, rounds exactly the same way
+    '''
+    t = times+offset
+    clip = np.floor_divide(t, cliplength)
+    if offset < 0:
+        clip += abs(offset // cliplength)
+
+    feature = np.floor_divide(np.remainder(t, cliplength),
+                              cliplength/featurecount)
+    return (feature + clip*featurecount).astype(np.int64)
+
 
+def midiToFeatureArray(events, offsets=[0], secondsPerClips=[20], featuresPerClip=40, returnStarts=False, combos=None):
+    '''
+    returns an (n_clips, featuresPerClip) float array holding the clips of
+    every (offset, secondsPerClip) combination, in the order of
+    product(offsets, secondsPerClips), or of combos when it is given
+
+    The event list is turned into arrays once and every combination is binned
+    into one long difference array, so the velocity weighted note average of
+    every bin comes from a single cumulative sum.
+    If returnStarts is set, the start time of each clip (in song time) is
+    returned as a second array.
+    '''
+    featuresPerClip = int(featuresPerClip)
+    notes, velocities, timeon, timeoff = eventsToArrays(events)
+    if combos is None:
+        combos = list(product(offsets, secondsPerClips))
+
+    starts = []
+    ends = []
+    clipStarts = []
+    totalBins = 0
+    for offset, secondsPerClip in combos:
+        start = timeToIndexArray(timeon, secondsPerClip, featuresPerClip, offset)
+        end = timeToIndexArray(timeoff, secondsPerClip, featuresPerClip, offset)
+        binCount = int(end.max()) if len(end) > 0 else 0
+        binCount = max(binCount, 0)
+        binCount += -binCount % featuresPerClip
+
+        starts.append(start+totalBins)
+        ends.append(end+totalBins)
+        if returnStarts:
+            clipStarts.append(timeOfClips(binCount//featuresPerClip, secondsPerClip, offset))
+        totalBins += binCount
+
+    if totalBins == 0:
+        empty = np.zeros((0, featuresPerClip))
+        return (empty, np.zeros(0)) if returnStarts else empty
+
+    start = np.concatenate(starts)
+    end = np.concatenate(ends)
+    # A note only covers bins when it ends after it starts
+    used = start < end
+    start = start[used]
+    end = end[used]
+    weighted = np.tile(notes*velocities, len(combos))[used]
+    weights = np.tile(velocities, len(combos))[used]
+
+    noteSum = np.cumsum(np.bincount(start, weights=weighted, minlength=totalBins+1) -
+                        np.bincount(end, weights=weighted, minlength=totalBins+1))[:totalBins]
+    velocitySum = np.cumsum(np.bincount(start, weights=weights, minlength=totalBins+1) -
+                            np.bincount(end, weights=weights, minlength=totalBins+1))[:totalBins]
+
+    # The sums are whole numbers, so the average can be rounded to 3 decimals
+    # exactly instead of through float rounding
+    noteSum = np.rint(noteSum).astype(np.int64)
+    velocitySum = np.rint(velocitySum).astype(np.int64)
+    occupied = velocitySum > 0
+    divisor = np.where(occupied, velocitySum, 1)
+    averages = ((2000*noteSum + divisor) // (2*divisor)) / 1000
+    averages = np.where(occupied, averages, np.nan).reshape(-1, featuresPerClip)
+
+    clips, kept = normalizeArray(averages)
+    if returnStarts:
+        return clips, np.concatenate(clipStarts)[kept]
     return clips
 
 
+def timeOfClips(clipCount, secondsPerClip, offset):
+    # Inverse of timetoindex for the first bin of each clip
+    clip = np.arange(clipCount, dtype=np.float64)
+    if offset < 0:
+        clip -= abs(offset // secondsPerClip)
+    return clip*secondsPerClip - offset
+
+
+def normalizeArray(averages):
+    '''
+    normalizeData applied to every row of averages, returns the normalized
+    rows and a mask of which rows were kept
+    '''
+    present = ~np.isnan(averages)
+    counts = present.sum(axis=1)
+    kept = ~(counts < (1/3 * averages.shape[1]))
+    rows = averages[kept]
+    present = present[kept]
+    if len(rows) == 0:
+        return np.zeros((0, averages.shape[1])), kept
+
+    mi = np.nanmin(rows, axis=1, keepdims=True)
+    shifted = rows - mi
+    ma = np.nanmax(shifted, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scaled = np.where(ma == 0, 15.0, (shifted/ma)*10+10)
+    return np.where(present, scaled, 0.0), kept
+
+
 def notesAverage(notes):
     # If no notes are given, respond "NA"
     if notes == [] or notes == {}:
@@ -157,7 +263,7 @@ def normalizeData(data):
     return num2
 
 
-def fileMidiToFeatures(inputFile, outputFile, offset=0, secondsPerClip=20, featuresPerClip=40, skipExistingFiles=False, spread=0, tempoSpread=0):
+def fileMidiToFeatures(inputFile, outputFile, offset=0, secondsPerClip=20, featuresPerClip=40, skipExistingFiles=False, spread=0, tempoSpread=0, eventCache=None, cleanHarmonics=False, countRemovedClips=False):
     if not os.path.exists(inputFile):
         return
 
@@ -169,45 +275,231 @@ def fileMidiToFeatures(inputFile, outputFile, offset=0, secondsPerClip=20, featu
             return
 
     print("Converting {} to features, {}...".format(inputFile, outputFile))
-    result = []
+    result = midiFileToClips(inputFile, offset=offset, secondsPerClip=secondsPerClip,
+                             featuresPerClip=featuresPerClip, spread=spread, tempoSpread=tempoSpread, eventCache=eventCache, cleanHarmonics=cleanHarmonics,
+                             countRemovedClips=countRemovedClips)
+
+    writeData(outputFile, result.tolist())
+
+    print("Finished conversion.\n")
+
+
+def midiFileToClips(inputFile, offset=0, secondsPerClip=20, featuresPerClip=40, spread=0, tempoSpread=0, eventCache=None, cleanHarmonics=False, returnEvents=False, countRemovedClips=False):
+    '''
+    returns every augmented clip of a midi file as one array.
+    cleanHarmonics removes the harmonics of the notes before the features
+    are taken, and countRemovedClips also takes the features of the
+    uncleaned events to count the clips the clean up removed, which doubles
+    the feature time. returnEvents also returns the events the clips were
+    taken from, as (clips, events).
+    '''
+    events = loadEvents(inputFile, eventCache=eventCache)
+    return eventsToClips(events, inputFile, offset=offset, secondsPerClip=secondsPerClip, featuresPerClip=featuresPerClip,
+                         spread=spread, tempoSpread=tempoSpread, cleanHarmonics=cleanHarmonics, returnEvents=returnEvents,
+                         countRemovedClips=countRemovedClips)
+
+
+def eventsToClips(events, inputFile=None, offset=0, secondsPerClip=20, featuresPerClip=40, spread=0, tempoSpread=0, cleanHarmonics=False, returnEvents=False, countRemovedClips=False):
+    '''
+    midiFileToClips for events already loaded from inputFile
+    '''
+    spRange, tmpRange = augmentationRanges(secondsPerClip, spread, tempoSpread)
+    offsets = [offset+i for i in spRange]
+    secondsPerClips = [secondsPerClip+j for j in tmpRange]
+
+    rawEvents = events
+    if cleanHarmonics:
+        with Metrics.stage("cleanHarmonics", inputFile, events=len(events)) as counts:
+            events = HarmonicCleanup.cleanEvents(events)
+            counts["removedEvents"] = len(rawEvents)-len(events)
+    with Metrics.stage("features", inputFile, events=len(events)) as counts:
+        clips = midiToFeatureArray(events, offsets=offsets, secondsPerClips=secondsPerClips,
+                                   featuresPerClip=featuresPerClip)
+        counts["clips"] = len(clips)
+    if cleanHarmonics and countRemovedClips:
+        # Only to count the clips the clean up removed, kept out of its timing
+        with Metrics.stage("cleanHarmonicsBaseline", inputFile) as counts:
+            counts["removedClips"] = len(midiToFeatureArray(
+                rawEvents, offsets=offsets, secondsPerClips=secondsPerClips, featuresPerClip=featuresPerClip))-len(clips)
+    if returnEvents:
+        return clips, events
+    return clips
+
+
+def augmentationRanges(secondsPerClip, spread=0, tempoSpread=0):
+    '''
+    returns the offsets and clip length adjustments used for augmentation.
+    Both include 0, so the unaugmented clips are always one of the combinations.
+    '''
     spRange = [0]
     if spread != 0:
         # spRange = range(-spread, spread)
-        spRange = np.linspace(-spread, 0, spread*2+1).tolist()
+        spRange = np.linspace(-spread, 0, int(spread*2+1)).tolist()
     tmpRange = [0]
     if tempoSpread != 0:
-        tmpRange = np.linspace(
-            secondsPerClip-tempoSpread, secondsPerClip+tempoSpread, (tempoSpread*2)*2+1).tolist()
-
-    combos = [x for x in product(spRange, tmpRange)]
-    counter = 0
-    events = convertMidiToEvents(inputFile)
-    for i, j in progressbar.progressbar(combos):
-        result.extend(midiToFeatures(events, offset=offset+i,
-                                     secondsPerClip=secondsPerClip+j, featuresPerClip=featuresPerClip))
-
-    writeData(outputFile, result)
-
-    print("Finished conversion.\n")
+        # Adjustments of -tempoSpread to +tempoSpread added to secondsPerClip,
+        # about half a second apart. An odd count keeps 0 in the middle,
+        # snapped to exactly 0
+        tmpRange = [0.0 if abs(x) < 1e-9 else x for x in np.linspace(
+            -tempoSpread, tempoSpread, 2*int(round(tempoSpread*2))+1).tolist()]
+    return spRange, tmpRange
 
 
 def writeData(path, data):
-    with open(path, "w") as f:
-        f.write(json.dumps(data))
+    with Metrics.stage("writeJson", path) as counts:
+        text = json.dumps(data)
+        with open(path, "w") as f:
+            f.write(text)
+        counts["bytes"] = len(text)
 
 
-def folderMidiToFeatures(inputFolder, outputFolder, offset=0, secondsPerClip=20, featuresPerClip=40, skipExistingFiles=False, spread=0, tempoSpread=0):
+def folderMidiToFeatures(inputFolder, outputFolder, offset=0, secondsPerClip=20, featuresPerClip=40, skipExistingFiles=False, spread=0, tempoSpread=0, outputFormat="json", storeType="float32", workers=1, files=None, eventCache=None, cleanHarmonics=False, materialize=False, countRemovedClips=False):
+    '''
+    outputFormat "json" writes one json file per midi file into outputFolder,
+    with every spread and tempo variant. "store" writes every song into the
+    feature store at outputFolder, keeping only the base clips and the events
+    the variants are made from at training time, unless materialize is set.
+    With more than one worker the files are converted in a process pool.
+    files limits the conversion to those paths relative to inputFolder.
+    eventCache is the folder decoded midi events are cached in, None disables it.
+    cleanHarmonics removes the harmonics of the notes before taking features,
+    countRemovedClips also counts the clips that removed, see midiFileToClips.
+    '''
+    if files is None:
+        files = FileManagement.listAllFiles(inputFolder, relative=True)
     print("Converting folder {} to features, {}...".format(
         inputFolder, outputFolder))
-    for x in FileManagement.listAllFiles(inputFolder, relative=True):
+    settings = {"offset": offset, "secondsPerClip": secondsPerClip, "featuresPerClip": featuresPerClip,
+                "spread": spread, "tempoSpread": tempoSpread, "eventCache": eventCache, "cleanHarmonics": cleanHarmonics,
+                "countRemovedClips": countRemovedClips}
+    if outputFormat == "store":
+        folderMidiToStore(inputFolder, outputFolder, skipExistingFiles=skipExistingFiles,
+                          storeType=storeType, workers=workers, files=files, materialize=materialize, **settings)
+        print("Finished Folder Conversion.")
+        return
+
+    if workers > 1:
+        jobs = []
+        for x in files:
+            outputFile = os.path.join(
+                outputFolder, os.path.splitext(x)[0]+".json")
+            if skipExistingFiles and os.path.exists(outputFile):
+                continue
+            jobs.append((x, os.path.join(inputFolder, x), outputFile))
+        runParallelJobs(jobs, settings, workers)
+        print("Finished Folder Conversion.")
+        return
+
+    for x in files:
         fileMidiToFeatures(os.path.join(inputFolder, x),
-                           os.path.join(outputFolder, os.path.splitext(x)[0]+".json"), offset=offset, secondsPerClip=secondsPerClip, featuresPerClip=featuresPerClip, skipExistingFiles=skipExistingFiles, spread=spread, tempoSpread=tempoSpread)
+                           os.path.join(outputFolder, os.path.splitext(x)[0]+".json"), skipExistingFiles=skipExistingFiles, **settings)
     print("Finished Folder Conversion.")
 
 
+def folderMidiToStore(inputFolder, storePath, offset=0, secondsPerClip=20, featuresPerClip=40, skipExistingFiles=False, spread=0, tempoSpread=0, storeType="float32", workers=1, files=None, eventCache=None, cleanHarmonics=False, materialize=False, countRemovedClips=False):
+    '''
+    Unless materialize is set only the base clips are written, with the
+    events and the spread and tempo settings the variants are made from.
+    '''
+    if files is None:
+        files = FileManagement.listAllFiles(inputFolder, relative=True)
+    augmentation = None
+    if not materialize:
+        augmentation = {"offset": offset, "secondsPerClip": secondsPerClip,
+                        "spread": spread, "tempoSpread": tempoSpread}
+        spread = 0
+        tempoSpread = 0
+    settings = {"offset": offset, "secondsPerClip": secondsPerClip, "featuresPerClip": featuresPerClip,
+                "spread": spread, "tempoSpread": tempoSpread, "eventCache": eventCache, "cleanHarmonics": cleanHarmonics,
+                "returnEvents": not materialize, "countRemovedClips": countRemovedClips}
+    with FeatureStore.FeatureStoreWriter(storePath, featuresPerClip, dtype=storeType, append=skipExistingFiles,
+                                         augmentation=augmentation) as writer:
+        if workers > 1:
+            jobs = []
+            for x in files:
+                if not writer.hasSong(FeatureStore.songName(x)[1]):
+                    jobs.append((x, os.path.join(inputFolder, x), None))
+
+            # Only this process writes to the store, workers hand back clips
+            def addResult(x, result):
+                className, name = FeatureStore.songName(x)
+                clips, events = (result, None) if materialize else result
+                writer.addSong(className, name, clips, events)
+            runParallelJobs(jobs, settings, workers, onResult=addResult)
+            return
+
+        for x in files:
+            className, name = FeatureStore.songName(x)
+            if writer.hasSong(name):
+                continue
+            print("Converting {} to features...".format(x))
+            result = midiFileToClips(os.path.join(inputFolder, x), **settings)
+            clips, events = (result, None) if materialize else result
+            writer.addSong(className, name, clips, events)
+
+
+def convertJob(inputFile, outputFile, settings):
+    '''
+    Runs in a worker process.
+    returns (clips or None, clip count, error, metrics recorded by the worker)
+    '''
+    try:
+        result = midiFileToClips(inputFile, **settings)
+        clips = result[0] if settings.get("returnEvents") else result
+        if outputFile is None:
+            return result, len(clips), None, Metrics.collect()
+        parentFolder = os.path.dirname(outputFile)
+        if parentFolder != "" and not os.path.exists(parentFolder):
+            os.makedirs(parentFolder, exist_ok=True)
+        writeData(outputFile, clips.tolist())
+        return None, len(clips), None, Metrics.collect()
+    except Exception as e:
+        return None, 0, "{}: {}".format(e.__class__.__name__, e), Metrics.collect()
+
+
+def runParallelJobs(jobs, settings, workers, onResult=None):
+    '''
+    jobs are (name, input file, output file or None). Files are handed out
+    largest first so one long song doesn't finish alone at the end, and a
+    failing file is reported instead of stopping the batch.
+    '''
+    jobs = sorted(jobs, key=lambda x: os.path.getsize(x[1]), reverse=True)
+    failures = []
+    clipCount = 0
+    done = 0
+    startTime = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convertJob, inputFile, outputFile, settings): name
+                   for name, inputFile, outputFile in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                clips, count, error, records = future.result()
+                Metrics.merge(records)
+            except Exception as e:
+                # The worker itself died, e.g. ran out of memory
+                clips, count, error = None, 0, "{}: {}".format(
+                    e.__class__.__name__, e)
+            done += 1
+            if error:
+                failures.append((name, error))
+            else:
+                clipCount += count
+                if onResult and clips is not None:
+                    onResult(name, clips)
+
+            elapsed = max(time.time()-startTime, 1e-9)
+            print("\r{}/{} files, {} failed, {:.2f} files/s, {:.0f} clips/s".format(
+                done, len(jobs), len(failures), done/elapsed, clipCount/elapsed), end="", flush=True)
+    print()
+    for name, error in failures:
+        print("Failed to convert {}: {}".format(name, error))
+    return failures
+
+
 if __name__ == "__main__":
     a = convertMidiToEvents("new Midi Test.mid")
-    b = convertEventsToMidi(a)
+    b = convertEventsToMidi(a, "new Midi Test copy.mid")
     exit()
     # fileMidiToFeatures("test.mid", "testfeature.json",
     #    secondsPerClip=8, featuresPerClip=200)
@@ -1,50 +1,206 @@
 import os
+import shlex
+import asyncio
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import FileManagement
+import Metrics
 
+DEFAULT_TRANSCRIBER = os.path.join("waon-0.11-mingw", "waon.exe")
 
-def __getCommand__(clean=False):
-    command = os.path.join("waon-0.11-mingw", "waon.exe")
-    shellCommand = command+" -i \"{}\" -o \"{}\" "
+
+def __getCommand__(clean=False, transcriber=None, transcriberArgs=None):
+    '''
+    returns the transcriber command as a list of arguments, "{input}" and
+    "{output}" are replaced with the wav and midi paths
+    '''
+    command = transcriber if transcriber else DEFAULT_TRANSCRIBER
+    if transcriberArgs is not None:
+        return [command] + shlex.split(transcriberArgs)
+
+    arguments = ["-i", "{input}", "-o", "{output}"]
     if clean:
         rate = 4096//2
-        shellCommand += "-w 6 -n {} -s {}".format(rate, rate//4)
+        arguments += ["-w", "6", "-n", str(rate), "-s", str(rate//4)]
         # shellCommand += "-w 1 -n 4096 -s 1024 -oct 2 -r 2"
         pass
 
-    return shellCommand
+    return [command] + arguments
+
+
+def buildCommand(inputPath, outputPath, transcriber=None, transcriberArgs=None):
+    command = __getCommand__(
+        clean=True, transcriber=transcriber, transcriberArgs=transcriberArgs)
+    inputPath = os.path.join(os.getcwd(), inputPath)
+    outputPath = os.path.join(os.getcwd(), outputPath)
+    return [x.replace("{input}", inputPath).replace("{output}", outputPath) for x in command]
+
+
+def partPath(outputPath):
+    '''
+    returns the temp file a transcription writes before it is renamed to outputPath
+    '''
+    return os.path.splitext(outputPath)[0]+".part.mid"
+
+
+def runTranscription(inputPath, outputPath, transcriber=None, transcriberArgs=None, timeout=None, retries=0):
+    '''
+    Runs the transcriber on one file, without a shell. The midi is written
+    to a temp file and only replaces outputPath once it succeeds, so a
+    failed run keeps any midi an earlier run made.
+    returns (success, seconds taken, attempts, error)
+    '''
+    parentfolder = os.path.dirname(outputPath)
+    if not os.path.exists(parentfolder) and parentfolder != "":
+        os.makedirs(parentfolder, exist_ok=True)
+
+    finCommand = buildCommand(inputPath, partPath(outputPath), transcriber=transcriber,
+                              transcriberArgs=transcriberArgs)
+    with Metrics.stage("transcribe", inputPath, bytes=os.path.getsize(inputPath)) as counts:
+        result = runAttempts(finCommand, outputPath, timeout, retries)
+        counts["attempts"] = result[2]
+        counts["failed"] = 0 if result[0] else 1
+    return result
+
+
+def runAttempts(finCommand, outputPath, timeout, retries):
+    '''
+    Runs finCommand, which writes partPath(outputPath), until it succeeds
+    '''
+    tempPath = partPath(outputPath)
+    startTime = time.time()
+    error = None
+    try:
+        for attempt in range(1, retries+2):
+            try:
+                subprocess.run(finCommand, check=True, timeout=timeout,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                if os.path.exists(tempPath):
+                    os.replace(tempPath, outputPath)
+                    return True, time.time()-startTime, attempt, None
+                error = "no midi file was written"
+            except subprocess.CalledProcessError as e:
+                error = "return code {}: {}".format(
+                    e.returncode, e.output.decode(errors="replace").strip())
+            except subprocess.TimeoutExpired:
+                error = "timed out after {} seconds".format(timeout)
+            except OSError as e:
+                error = str(e)
+        return False, time.time()-startTime, retries+1, error
+    finally:
+        # Only the half written temp file goes, never an earlier midi
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+async def transcribeAsync(inputPath, outputPath, transcriber=None, transcriberArgs=None, timeout=None, retries=0):
+    '''
+    runTranscription for an asyncio pipeline. The transcriber writes a temp
+    file that is only renamed to outputPath once it succeeds, so a failed or
+    cancelled run never leaves a half written midi.
+    returns (success, seconds taken, attempts, error)
+    '''
+    parentfolder = os.path.dirname(outputPath)
+    if not os.path.exists(parentfolder) and parentfolder != "":
+        os.makedirs(parentfolder, exist_ok=True)
+    tempPath = partPath(outputPath)
+    finCommand = buildCommand(inputPath, tempPath, transcriber=transcriber,
+                              transcriberArgs=transcriberArgs)
+    startTime = time.time()
+    error = None
+    with Metrics.stage("transcribe", inputPath, bytes=os.path.getsize(inputPath)) as counts:
+        try:
+            for attempt in range(1, retries+2):
+                counts["attempts"] = attempt
+                try:
+                    process = await asyncio.create_subprocess_exec(
+                        *finCommand, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+                except OSError as e:
+                    error = str(e)
+                    continue
+                try:
+                    output, _ = await asyncio.wait_for(process.communicate(), timeout)
+                except asyncio.TimeoutError:
+                    error = "timed out after {} seconds".format(timeout)
+                    continue
+                finally:
+                    if process.returncode is None:
+                        # Timed out or cancelled
+                        process.kill()
+                        await process.wait()
+                if process.returncode != 0:
+                    error = "return code {}: {}".format(
+                        process.returncode, output.decode(errors="replace").strip())
+                elif not os.path.exists(tempPath):
+                    error = "no midi file was written"
+                else:
+                    os.replace(tempPath, outputPath)
+                    counts["failed"] = 0
+                    return True, time.time()-startTime, attempt, None
+            counts["failed"] = 1
+            return False, time.time()-startTime, retries+1, error
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
 
 
-def singleWavToMidi(inputPath, outputPath, skipExistingMidiFiles=True):
+def singleWavToMidi(inputPath, outputPath, skipExistingMidiFiles=True, transcriber=None, transcriberArgs=None, timeout=None, retries=0):
     if not os.path.exists(inputPath):
         return
     if os.path.exists(outputPath) and skipExistingMidiFiles:
         return
-    parentfolder = os.path.dirname(outputPath)
-    if not os.path.exists(parentfolder) and parentfolder != "":
-        os.makedirs(parentfolder)
 
-    finCommand = __getCommand__(clean=True).format(os.path.join(
-        os.getcwd(), inputPath), os.path.join(os.getcwd(), outputPath))
-    print("\n"+finCommand+"\n")
-    try:
-        a = subprocess.check_output(finCommand, shell=True)
-    except subprocess.CalledProcessError as e:
-        output = "command '{}' return with error (code {}): {}".format(
-            e.cmd, e.returncode, e.output.decode())
-        print(output)
-        exit()
+    print("\nConverting {} to {}\n".format(inputPath, outputPath))
+    success, taken, attempts, error = runTranscription(
+        inputPath, outputPath, transcriber=transcriber, transcriberArgs=transcriberArgs, timeout=timeout, retries=retries)
+    if not success:
+        print("Transcribing {} failed ({}): {}".format(
+            inputPath, attempts, error))
+    return success
+
+
+def scheduleTranscriptions(inOuts, workers=1, transcriber=None, transcriberArgs=None, timeout=None, retries=0):
+    '''
+    Runs up to workers transcriber processes at once over [input, output]
+    pairs. A failing file is retried, then reported at the end instead of
+    stopping the other files.
+    returns [(input, error), ...] for every file that failed
+    '''
+    failures = []
+    startTime = time.time()
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(runTranscription, x, y, transcriber, transcriberArgs, timeout, retries): x
+                   for x, y in inOuts}
+        for future in as_completed(futures):
+            inputPath = futures[future]
+            success, taken, attempts, error = future.result()
+            if success:
+                print("{:.2f}s {}".format(taken, inputPath))
+            else:
+                print("{:.2f}s {} FAILED after {} attempt(s): {}".format(
+                    taken, inputPath, attempts, error))
+                failures.append((inputPath, error))
+
+    elapsed = max(time.time()-startTime, 1e-9)
+    print("Transcribed {} files in {:.2f}s, {:.2f} files/s, {} failed".format(
+        len(inOuts)-len(failures), elapsed, len(inOuts)/elapsed, len(failures)))
+    for inputPath, error in failures:
+        print("Failed: {}: {}".format(inputPath, error))
+    return failures
 
 
-def folderWavToMidi(inputPath, outputPath, skipExistingMidiFiles=True):
+def folderWavToMidi(inputPath, outputPath, skipExistingMidiFiles=True, workers=1, transcriber=None, transcriberArgs=None, timeout=None, retries=0):
     files = FileManagement.listAllFiles(inputPath, relative=True)
     inOuts = [[os.path.join(inputPath, x), os.path.join(outputPath, x)]
               for x in files]
 
     inOuts = [[x[0], os.path.splitext(x[1])[0]+".mid"] for x in inOuts]
+    if skipExistingMidiFiles:
+        inOuts = [x for x in inOuts if not os.path.exists(x[1])]
 
-    for x, y in inOuts:
-        singleWavToMidi(x, y, skipExistingMidiFiles=skipExistingMidiFiles)
+    return scheduleTranscriptions(inOuts, workers=workers, transcriber=transcriber,
+                                  transcriberArgs=transcriberArgs, timeout=timeout, retries=retries)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+import os
+import json
+import argparse
+import numpy as np
+import FileManagement
+import Metrics
+import MidiDecoder
+import QuantizedIndex
+
+# A feature store is a folder holding every clip of every song in one
+# contiguous binary file, plus a small json file with the per-song offset table
+# and the class names:
+#
+#   store.json  {"version", "dtype", "featuresPerClip", "classNames", "songs",
+#                "augmentation"}
+#   clips.bin   clip rows, songs[i] owns rows [start, start+count). A uint8
+#               store holds QuantizedIndex.pack rows, codes then a bit mask
+#   events.bin  MidiDecoder.EVENT_DTYPE rows, songs[i] owns rows
+#               [eventStart, eventStart+eventCount)
+#
+# A store with augmentation settings only holds the base clips of each song,
+# the spread and tempo variants are made from its events when training.
+STORE_VERSION = 2
+READABLE_VERSIONS = [1, 2]
+STORE_META = "store.json"
+STORE_CLIPS = "clips.bin"
+STORE_EVENTS = "events.bin"
+STORE_DTYPES = ["float32", "float16", "uint8"]
+QUANTIZED_DTYPE = "uint8"
+
+
+def rowBytes(dtype, featuresPerClip):
+    if np.dtype(dtype) == np.dtype(QUANTIZED_DTYPE):
+        return QuantizedIndex.rowBytes(featuresPerClip)
+    return featuresPerClip*np.dtype(dtype).itemsize
+
+
+def isFeatureStore(path):
+    return os.path.isfile(os.path.join(path, STORE_META))
+
+
+def readMeta(path):
+    with open(os.path.join(path, STORE_META)) as f:
+        return json.loads(f.read())
+
+
+def writeMeta(path, meta):
+    # Write next to the real file first so a crash never leaves half a table
+    tempPath = os.path.join(path, STORE_META+".tmp")
+    with open(tempPath, "w") as f:
+        f.write(json.dumps(meta))
+    os.replace(tempPath, os.path.join(path, STORE_META))
+
+
+class FeatureStore:
+    '''
+    Read only view of a feature store, the clips are memory mapped so opening
+    a store doesn't copy any features into memory
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        meta = readMeta(path)
+        if meta["version"] not in READABLE_VERSIONS:
+            raise Exception("Unsupported feature store version {}".format(
+                meta["version"]))
+        self.dtype = np.dtype(meta["dtype"])
+        self.featuresPerClip = meta["featuresPerClip"]
+        self.quantized = self.dtype == np.dtype(QUANTIZED_DTYPE)
+        self.rowBytes = rowBytes(self.dtype, self.featuresPerClip)
+        self.classNames = meta["classNames"]
+        self.songs = meta["songs"]
+        self.augmentation = meta.get("augmentation")
+        self.clipCount = sum(x["count"] for x in self.songs)
+        self.eventCount = sum(x.get("eventCount", 0) for x in self.songs)
+
+        width = self.rowBytes if self.quantized else self.featuresPerClip
+        if self.clipCount > 0:
+            self.clips = np.memmap(os.path.join(path, STORE_CLIPS), dtype=self.dtype,
+                                   mode="r", shape=(self.clipCount, width))
+        else:
+            self.clips = np.zeros((0, width), dtype=self.dtype)
+        if self.quantized:
+            # Reads as float clips, QuantizedIndex takes the codes as they are
+            self.clips = QuantizedIndex.QuantizedClips(self.clips, self.featuresPerClip)
+        if self.eventCount > 0:
+            self.events = np.memmap(os.path.join(path, STORE_EVENTS), dtype=MidiDecoder.EVENT_DTYPE,
+                                    mode="r", shape=(self.eventCount,))
+        else:
+            self.events = np.zeros(0, dtype=MidiDecoder.EVENT_DTYPE)
+
+    def labels(self):
+        '''
+        returns the class number of every clip
+        '''
+        classes = np.array([x["class"] for x in self.songs], dtype=np.int32)
+        counts = np.array([x["count"] for x in self.songs], dtype=np.int64)
+        return np.repeat(classes, counts)
+
+    def songClips(self, song):
+        return self.clips[song["start"]:song["start"]+song["count"]]
+
+    def songEvents(self, song):
+        start = song.get("eventStart", 0)
+        return self.events[start:start+song.get("eventCount", 0)]
+
+    def hasEvents(self):
+        return self.augmentation is not None and all("eventCount" in x for x in self.songs)
+
+    def bytesOnDisk(self):
+        return sum(os.path.getsize(os.path.join(self.path, x)) for x in [STORE_META, STORE_CLIPS, STORE_EVENTS]
+                   if os.path.exists(os.path.join(self.path, x)))
+
+    def songsPerClass(self):
+        '''
+        returns {class name: [song, ...]}, the same grouping as
+        FileManagement.listAllFilesPerDir gives for a json feature folder
+        '''
+        perClass = {}
+        for song in self.songs:
+            perClass.setdefault(self.classNames[song["class"]], []).append(song)
+        return perClass
+
+
+class FeatureStoreWriter:
+    '''
+    Appends songs to a feature store, the offset table is written on close.
+    Without append a new store is written next to any old one and only
+    replaces it on close, so an interrupted build leaves the old store whole.
+    augmentation is the {"offset", "secondsPerClip", "spread", "tempoSpread"}
+    the variants of the stored events are made with, every song then needs
+    its events.
+    '''
+
+    def __init__(self, path, featuresPerClip, dtype="float32", append=False, augmentation=None):
+        self.path = path
+        self.featuresPerClip = int(featuresPerClip)
+        self.augmentation = augmentation
+        if path != "" and not os.path.exists(path):
+            os.makedirs(path)
+
+        clipsPath = os.path.join(path, STORE_CLIPS)
+        eventsPath = os.path.join(path, STORE_EVENTS)
+        # (file written, file it replaces on close) for a new store
+        self.replacing = []
+        if append and isFeatureStore(path):
+            meta = readMeta(path)
+            if meta["featuresPerClip"] != self.featuresPerClip:
+                raise Exception("Feature store {} has {} features per clip, not {}".format(
+                    path, meta["featuresPerClip"], self.featuresPerClip))
+            if meta["songs"] and meta.get("augmentation") != augmentation:
+                raise Exception("Feature store {} was built with augmentation {}, not {}".format(
+                    path, meta.get("augmentation"), augmentation))
+            if meta["songs"] and np.dtype(meta["dtype"]) != np.dtype(dtype):
+                raise Exception("Feature store {} holds {} clips, not {}".format(
+                    path, meta["dtype"], np.dtype(dtype).name))
+            self.classNames = meta["classNames"]
+            self.songs = meta["songs"]
+        else:
+            self.classNames = []
+            self.songs = []
+            self.replacing = [(clipsPath+".tmp", clipsPath), (eventsPath+".tmp", eventsPath)]
+            clipsPath, eventsPath = clipsPath+".tmp", eventsPath+".tmp"
+            open(clipsPath, "wb").close()
+            open(eventsPath, "wb").close()
+
+        self.dtype = np.dtype(dtype)
+        self.clipCount = sum(x["count"] for x in self.songs)
+        self.eventCount = sum(x.get("eventCount", 0) for x in self.songs)
+        self.songNames = set(x["name"] for x in self.songs)
+        self.classNumbers = {x: i for i, x in enumerate(self.classNames)}
+
+        self.clipFile = open(clipsPath, "r+b")
+        # Drop rows left behind by a run that never wrote its offset table
+        self.clipFile.truncate(self.clipCount*rowBytes(self.dtype, self.featuresPerClip))
+        self.clipFile.seek(0, os.SEEK_END)
+        # Version 1 stores have no event file
+        self.eventFile = open(eventsPath, "r+b" if os.path.exists(eventsPath) else "w+b")
+        self.eventFile.truncate(self.eventCount*MidiDecoder.EVENT_DTYPE.itemsize)
+        self.eventFile.seek(0, os.SEEK_END)
+
+    def hasSong(self, name):
+        return name in self.songNames
+
+    def addSong(self, className, name, clips, events=None):
+        if self.dtype == np.dtype(QUANTIZED_DTYPE):
+            clips = QuantizedIndex.pack(np.asarray(clips).reshape(-1, self.featuresPerClip))
+        else:
+            clips = np.asarray(clips, dtype=self.dtype).reshape(-1, self.featuresPerClip)
+        if self.augmentation is not None and events is None:
+            raise Exception("Song {} has no events to augment".format(name))
+        if className not in self.classNumbers:
+            self.classNumbers[className] = len(self.classNames)
+            self.classNames.append(className)
+
+        song = {"name": name, "class": self.classNumbers[className],
+                "start": self.clipCount, "count": len(clips)}
+        with Metrics.stage("writeStore", name, bytes=clips.nbytes) as counts:
+            clips.tofile(self.clipFile)
+            if events is not None:
+                events = MidiDecoder.toEventArray(events)
+                events.tofile(self.eventFile)
+                counts["bytes"] += events.nbytes
+                song["eventStart"] = self.eventCount
+                song["eventCount"] = len(events)
+                self.eventCount += len(events)
+        self.songs.append(song)
+        self.songNames.add(name)
+        self.clipCount += len(clips)
+
+    def close(self):
+        self.clipFile.close()
+        self.eventFile.close()
+        if self.replacing and isFeatureStore(self.path):
+            # Until the new table is written there is no store, never the
+            # old table over the new files
+            os.remove(os.path.join(self.path, STORE_META))
+        for tempPath, finalPath in self.replacing:
+            os.replace(tempPath, finalPath)
+        self.replacing = []
+        writeMeta(self.path, {"version": STORE_VERSION, "dtype": self.dtype.name,
+                              "featuresPerClip": self.featuresPerClip,
+                              "classNames": self.classNames, "songs": self.songs,
+                              "augmentation": self.augmentation})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def removeSongs(path, names):
+    '''
+    Removes songs from a feature store, the remaining clips are copied into a
+    new clip file so the store stays contiguous
+    '''
+    names = set(names)
+    if not isFeatureStore(path) or len(names) == 0:
+        return
+    store = FeatureStore(path)
+    kept = [x for x in store.songs if x["name"] not in names]
+    if len(kept) == len(store.songs):
+        return
+
+    tempPath = os.path.join(path, STORE_CLIPS+".tmp")
+    tempEventsPath = os.path.join(path, STORE_EVENTS+".tmp")
+    start = 0
+    eventStart = 0
+    with open(tempPath, "wb") as f, open(tempEventsPath, "wb") as eventFile:
+        for song in kept:
+            store.songClips(song).tofile(f)
+            if "eventCount" in song:
+                store.songEvents(song).tofile(eventFile)
+                song["eventStart"] = eventStart
+                eventStart += song["eventCount"]
+            song["start"] = start
+            start += song["count"]
+    del store.clips
+    del store.events
+    os.replace(tempPath, os.path.join(path, STORE_CLIPS))
+    os.replace(tempEventsPath, os.path.join(path, STORE_EVENTS))
+    writeMeta(path, {"version": STORE_VERSION, "dtype": store.dtype.name,
+                     "featuresPerClip": store.featuresPerClip,
+                     "classNames": store.classNames, "songs": kept,
+                     "augmentation": store.augmentation})
+
+
+def openFeatureStore(path):
+    return FeatureStore(path)
+
+
+def songName(relativePath):
+    '''
+    returns the (class name, song name) a feature file is stored under
+    '''
+    name = os.path.splitext(relativePath)[0].replace(os.sep, "/")
+    return os.path.dirname(name), name
+
+
+def convertJsonTree(inputFolder, storePath, dtype="float32"):
+    '''
+    Packs a folder of json feature files into a feature store
+    '''
+    print("Converting json features {} to feature store {}...".format(
+        inputFolder, storePath))
+    writer = None
+    for x in sorted(FileManagement.listAllFiles(inputFolder, relative=True)):
+        with open(os.path.join(inputFolder, x)) as f:
+            clips = json.loads(f.read())
+        if len(clips) == 0:
+            continue
+        if writer is None:
+            writer = FeatureStoreWriter(storePath, len(clips[0]), dtype=dtype)
+        className, name = songName(x)
+        writer.addSong(className, name, clips)
+
+    if writer is None:
+        print("No features found in {}".format(inputFolder))
+        return
+    writer.close()
+    print("Converted {} songs, {} clips.".format(
+        len(writer.songs), writer.clipCount))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a folder of json features into a feature store")
+    parser.add_argument("jsonPath", type=str, help="Path of json features")
+    parser.add_argument("storePath", type=str,
+                        help="Path to store the feature store")
+    parser.add_argument("-dt", "--DataType", dest="dtype", choices=STORE_DTYPES,
+                        help="Data type to store features as", default="float32")
+    args = vars(parser.parse_args())
+    convertJsonTree(args["jsonPath"], args["storePath"], dtype=args["dtype"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import math
+import functools
+import numpy as np
+from scipy.stats import zscore
+import ConvertMidiToFeatures
+import MidiDecoder
+
+# States of the cells of a piano roll
+OFF = 0
+
+VALID = 1
+DELETE = 2
+FUNDAMENTAL = 3
+ADD = 4
+
+CONFLICT = 5
+CONFLICT_ADD = 6
+
+# Every midi note, 0 to 127
+NOTE_COUNT = 128
+STATE_COUNT = CONFLICT_ADD+1
+# States of the cells a cleaned song keeps, the white cells of the "after" image
+KEPT_STATES = [VALID, FUNDAMENTAL, ADD, CONFLICT, CONFLICT_ADD]
+# Distinct chords remembered by fundamentalOfNotes
+CHORD_CACHE_SIZE = 4096
+# Roll columns per second the clean up looks at
+CLEANUP_FEATURES_PER_SECOND = 20
+
+
+def eventsToRoll(events, featuresPerSecond=20):
+    '''
+    returns a (time, NOTE_COUNT) uint8 piano roll of note states, VALID
+    wherever a note is held
+    '''
+    notes, velocities, timeons, timeoffs = ConvertMidiToFeatures.eventsToArrays(
+        events)
+    if len(notes) == 0:
+        return np.zeros((0, NOTE_COUNT), dtype=np.uint8)
+    midiend = timeoffs.max()
+    width = int(featuresPerSecond*midiend)
+
+    # remove notes if they are too short
+    # events = [x for x in events if x[3]-x[2] > 0.1]
+    # NOTE This ended up working bad for quick rhythms
+
+    # +1 where a note starts and -1 where it ends, summed down the time axis
+    beginbuckets = (timeons/midiend*width).astype(np.int64)
+    endbuckets = (timeoffs/midiend*width).astype(np.int64)
+    held = np.zeros((width+1, NOTE_COUNT), dtype=np.int32)
+    np.add.at(held, (beginbuckets, notes), 1)
+    np.add.at(held, (endbuckets, notes), -1)
+    held = np.cumsum(held[:-1], axis=0)
+    return np.where(held > 0, VALID, OFF).astype(np.uint8)
+
+
+def cleanEvents(events, featuresPerSecond=CLEANUP_FEATURES_PER_SECOND):
+    '''
+    Removes the harmonics of the notes, as found by removeHarmonics and
+    extrapolateNeighbors on a piano roll of the events. An event is dropped
+    when none of the roll cells it covers are kept.
+    returns the kept events as a MidiDecoder.EVENT_DTYPE array
+    '''
+    notes, velocities, timeons, timeoffs = ConvertMidiToFeatures.eventsToArrays(
+        events)
+    cleaned = np.empty(len(notes), dtype=MidiDecoder.EVENT_DTYPE)
+    cleaned["note"] = notes
+    cleaned["velocity"] = velocities
+    cleaned["on"] = timeons
+    cleaned["off"] = timeoffs
+    roll = eventsToRoll(cleaned, featuresPerSecond)
+    if len(roll) == 0:
+        return cleaned
+
+    removeHarmonics(roll)
+    extrapolateNeighbors(roll)
+
+    # Kept cells of each note counted up to every column, so the kept cells
+    # under an event are one subtraction
+    kept = np.isin(roll, KEPT_STATES)
+    keptBefore = np.concatenate(
+        [np.zeros((1, NOTE_COUNT), dtype=np.int64), np.cumsum(kept, axis=0)])
+    midiend = timeoffs.max()
+    width = len(roll)
+    beginbuckets = (timeons/midiend*width).astype(np.int64)
+    endbuckets = (timeoffs/midiend*width).astype(np.int64)
+    keptCells = keptBefore[endbuckets, notes]-keptBefore[beginbuckets, notes]
+    # Notes too short to cover a cell can't be judged and stay
+    return cleaned[(keptCells > 0) | (endbuckets <= beginbuckets)]
+
+
+def heldNotes(roll):
+    '''
+    returns a list of the notes that aren't OFF for every column of the roll
+    '''
+    columns, held = np.nonzero(roll)
+    held = held.tolist()
+    bounds = np.searchsorted(columns, np.arange(len(roll)+1)).tolist()
+    return [held[bounds[i]:bounds[i+1]] for i in range(len(roll))]
+
+
+def removeHarmonics(roll):
+    # Neighbouring columns nearly always hold the same chord, so the
+    # fundamental is found once per run of identical columns, and chords
+    # seen before come out of fundamentalOfNotes' cache
+    held = roll != OFF
+    changes = np.flatnonzero((held[1:] != held[:-1]).any(axis=1))+1
+    runStarts = np.concatenate([[0], changes]) if len(roll) else changes
+    runFundamentals = [fundamentalOfNotes(tuple(np.flatnonzero(held[x]).tolist()))
+                       for x in runStarts.tolist()]
+    fundamentalMidi = np.repeat(np.array(runFundamentals, dtype=np.int64),
+                                np.diff(np.append(runStarts, len(roll))))
+
+    # note 0 counts as no fundamental, like it always has
+    found = fundamentalMidi > 0
+    isFundamental = np.arange(NOTE_COUNT) == fundamentalMidi[:, None]
+    roll[held] = np.where(found[:, None], np.where(isFundamental, FUNDAMENTAL, DELETE),
+                          VALID)[held]
+    columns = np.flatnonzero(found & ~held[np.arange(len(roll)), fundamentalMidi])
+    roll[columns, fundamentalMidi[columns]] = ADD
+
+
+@functools.lru_cache(maxsize=CHORD_CACHE_SIZE)
+def fundamentalOfNotes(notes):
+    '''
+    returns the midi note of the fundamental of a sorted tuple of notes, or 0
+    if there isn't one
+    '''
+    fundamentalFrequency = find_harmonic_fundamental(
+        [midiNoteToFrequency(x) for x in notes])
+    if fundamentalFrequency == None:
+        return 0
+    return frequencyToMidiNote(fundamentalFrequency)
+
+
+def deleteOutliers(roll, outlierScore=1):
+    current_notes = np.nonzero(roll)[1]
+
+    deviations = zscore(current_notes)
+    deviated_numbers = np.unique(current_notes[deviations > outlierScore])
+    for num in deviated_numbers:
+        column = roll[:, num]
+        column[column != OFF] = DELETE
+
+
+def extrapolateNeighbors(roll):
+    '''
+    Every run of a held note becomes one state, picked by resolveRun from
+    the states the run holds. Done per run in one pass over the cells.
+    '''
+    width = len(roll)
+    if width == 0:
+        return
+    # Note major so each note's runs sit next to each other
+    notesByTime = np.ascontiguousarray(roll.T)
+    held = notesByTime != OFF
+    edges = np.diff(np.pad(held, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+    runNotes, runStarts = np.nonzero(edges == 1)
+    runEnds = np.nonzero(edges == -1)[1]
+    if len(runStarts) == 0:
+        return
+
+    # OR together one bit per state over each run. Each reduceat slice runs
+    # up to the next run's start, the gap before it only adds the OFF bit.
+    cells = notesByTime.reshape(-1)
+    stateBits = np.left_shift(1, cells.astype(np.int32))
+    runBits = np.bitwise_or.reduceat(stateBits, runNotes*width+runStarts) & ~(1 << OFF)
+    runStates = RUN_RESOLUTION[runBits]
+
+    heldCells = held.reshape(-1)
+    cellStates = np.repeat(runStates, runEnds-runStarts)
+    cells[heldCells] = np.where(cellStates != OFF, cellStates, cells[heldCells])
+    roll[:] = notesByTime.T
+
+
+def resolveRun(states):
+    '''
+    returns the state a run of a note holding all of states becomes, or
+    None to leave it as it is
+    '''
+    if len(states) < 2:
+        return None
+    if DELETE in states and VALID in states:
+        return DELETE
+    elif DELETE in states and ADD in states:
+        return CONFLICT_ADD
+    elif DELETE in states and FUNDAMENTAL in states:
+        return CONFLICT
+    elif VALID in states and FUNDAMENTAL in states:
+        return FUNDAMENTAL
+    elif VALID in states and ADD in states:
+        return ADD
+    return None
+
+
+def buildRunResolution():
+    '''
+    returns resolveRun as a lookup table indexed by a bit per state, OFF
+    where the run is left alone
+    '''
+    table = np.zeros(1 << STATE_COUNT, dtype=np.uint8)
+    for bits in range(len(table)):
+        value = resolveRun(set(x for x in range(STATE_COUNT) if bits >> x & 1))
+        table[bits] = OFF if value is None else value
+    return table
+
+
+RUN_RESOLUTION = buildRunResolution()
+
+
+def midiNoteToFrequency(note):
+    return 440 * (2**(1./12))**(note-69)
+    # 440 * (2^(1/12))^(note-69)
+
+
+def frequencyToMidiNote(frequency):
+    return round((12*math.log(frequency/440))/math.log(2)+69)
+
+
+def midiNoteToName(note):
+    note -= 12
+    oct = note//12
+    rem = note % 12
+    notes = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+    a = notes[rem]+str(oct)
+    return a
+
+
+def find_harmonic_fundamental(frequencies: list, tolerance=0.05):
+    '''
+    returns the frequency that best explains the others as its harmonics.
+    Every root is scored against every frequency at once: a frequency near
+    the nth harmonic of a root adds its purity/n to that root's score.
+    '''
+    if 0 <= len(frequencies) <= 1:
+        return None
+    frequencies = np.sort(np.asarray(frequencies, dtype=np.float64))
+
+    # ratios[i, j] is frequency j over root i
+    ratios = frequencies[None, :]/frequencies[:, None]
+    distance_to_harmonic = ratios % 1
+    harmonic_ranking = np.floor(ratios+0.5)-1
+    distance_to_harmonic = np.where(
+        distance_to_harmonic > 0.5, 1-distance_to_harmonic, distance_to_harmonic)
+    harmonic_purity = 1-(distance_to_harmonic*2)
+    # found_harmonics = distance_to_harmonic < tolerance & harmonic_ranking > 0
+    allscore = np.where(harmonic_ranking > 0,
+                        (1/np.maximum(harmonic_ranking, 1))*harmonic_purity, 0)
+    # cumsum adds in order like sum() did, so ties break the same way
+    score = np.cumsum(allscore, axis=1)[:, -1]
+    # argmax keeps the lowest root of equal scores
+    return float(frequencies[np.argmax(score)])
@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import ConvertWavToMidi
+import ConvertMidiToFeatures
+import FeatureStore
+import FileManagement
+import Metrics
+
+# Songs flow through transcribe -> decode -> features -> write, each stage
+# starting on a song as soon as the stage before hands it over. Stages are
+# joined by bounded queues, so a fast stage waits for a slow one instead of
+# piling songs up in memory. Transcription runs as subprocesses, decoding and
+# features in a process pool, and writing in this process. Outputs are only
+# ever renamed into place once complete, so cancelling leaves no half
+# written midi or json files, and a feature store keeps every song it added.
+QUEUE_SIZE = 4
+REPORT_SECONDS = 2
+SAMPLE_SECONDS = 0.1
+
+
+def decodeJob(inputFile, eventCache):
+    '''
+    Runs in a worker process.
+    returns (events, metrics recorded by the worker)
+    '''
+    return ConvertMidiToFeatures.loadEvents(inputFile, eventCache=eventCache), Metrics.collect()
+
+
+def featureJob(inputFile, events, settings):
+    '''
+    Runs in a worker process.
+    returns (clips or (clips, events), metrics recorded by the worker)
+    '''
+    return ConvertMidiToFeatures.eventsToClips(events, inputFile, **settings), Metrics.collect()
+
+
+def writeJson(path, clips):
+    parentFolder = os.path.dirname(path)
+    if parentFolder != "" and not os.path.exists(parentFolder):
+        os.makedirs(parentFolder, exist_ok=True)
+    tempPath = path+".tmp"
+    with Metrics.stage("writeJson", path) as counts:
+        text = json.dumps(clips.tolist())
+        with open(tempPath, "w") as f:
+            f.write(text)
+        counts["bytes"] = len(text)
+    os.replace(tempPath, path)
+
+
+class PipelineStage:
+    '''
+    workers coroutines taking songs from inbox, running function on them and
+    handing them to outbox, with the counts the progress report reads
+    '''
+
+    def __init__(self, name, function, workers, inbox, outbox=None):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.inbox = inbox
+        self.outbox = outbox
+        self.busy = 0
+        self.busySeconds = 0.0
+        self.done = 0
+        self.failed = []
+        self.depthSum = 0
+        self.depthSamples = 0
+        self.maxDepth = 0
+
+    async def work(self):
+        while True:
+            song = await self.inbox.get()
+            if song is None:
+                return
+            self.busy += 1
+            startTime = time.perf_counter()
+            try:
+                song = await self.function(song)
+            except Exception as e:
+                self.failed.append((song["name"], "{}: {}".format(e.__class__.__name__, e)))
+                song = None
+            finally:
+                self.busy -= 1
+                self.busySeconds += time.perf_counter()-startTime
+            if song is not None:
+                self.done += 1
+                if self.outbox is not None:
+                    # Waits here while the next stage is behind
+                    await self.outbox.put(song)
+
+    async def run(self, nextWorkers=0):
+        await asyncio.gather(*[self.work() for _ in range(self.workers)])
+        for _ in range(nextWorkers):
+            await self.outbox.put(None)
+
+    def sample(self):
+        depth = self.inbox.qsize()
+        self.depthSum += depth
+        self.depthSamples += 1
+        self.maxDepth = max(self.maxDepth, depth)
+
+    def utilisation(self, elapsed):
+        return self.busySeconds/max(self.workers*elapsed, 1e-9)
+
+    def summary(self, elapsed):
+        return "{:<10} {} songs, {} failed, {:.0%} busy over {} workers, queue mean {:.1f} max {}".format(
+            self.name, self.done, len(self.failed), self.utilisation(elapsed), self.workers,
+            self.depthSum/max(self.depthSamples, 1), self.maxDepth)
+
+
+class IngestPipeline:
+    '''
+    Converts a folder of wav files to midi files and features with every
+    stage running at once. With the numpy backend the wav files are decoded
+    straight to events and there is no transcription stage.
+    '''
+
+    def __init__(self, inputFolder, midiFolder, outputFolder, offset=0, secondsPerClip=20, featuresPerClip=40, spread=0, tempoSpread=0,
+                 outputFormat="json", storeType="float32", workers=1, eventCache=None, cleanHarmonics=False,
+                 materialize=False, backend="waon", skipExistingMidiFiles=False, skipExistingFiles=False, transcriber=None,
+                 transcriberArgs=None, timeout=None, retries=0, queueSize=QUEUE_SIZE, countRemovedClips=False):
+        self.inputFolder = inputFolder
+        self.midiFolder = midiFolder
+        self.outputFolder = outputFolder
+        self.useStore = outputFormat == "store"
+        self.featuresPerClip = featuresPerClip
+        self.storeType = storeType
+        self.workers = max(workers, 1)
+        self.eventCache = eventCache
+        self.backend = backend
+        self.skipExistingMidiFiles = skipExistingMidiFiles
+        self.skipExistingFiles = skipExistingFiles
+        self.transcriberSettings = {"transcriber": transcriber, "transcriberArgs": transcriberArgs,
+                                    "timeout": timeout, "retries": retries}
+        self.queueSize = queueSize
+        # Like folderMidiToStore, a store keeps the base clips and the events
+        # unless materialize is set
+        self.augmentation = None
+        if self.useStore and not materialize:
+            self.augmentation = {"offset": offset, "secondsPerClip": secondsPerClip,
+                                 "spread": spread, "tempoSpread": tempoSpread}
+            spread = 0
+            tempoSpread = 0
+        self.featureSettings = {"offset": offset, "secondsPerClip": secondsPerClip, "featuresPerClip": featuresPerClip,
+                                "spread": spread, "tempoSpread": tempoSpread, "cleanHarmonics": cleanHarmonics,
+                                "returnEvents": self.augmentation is not None, "countRemovedClips": countRemovedClips}
+        self.pool = None
+        self.writer = None
+        self.stages = []
+        self.clipCount = 0
+
+    def songs(self):
+        songs = []
+        for x in sorted(FileManagement.listAllFiles(self.inputFolder, relative=True)):
+            className, name = FeatureStore.songName(x)
+            song = {"relative": x, "className": className, "name": name,
+                    "input": os.path.join(self.inputFolder, x)}
+            if self.backend == "numpy":
+                song["source"] = song["input"]
+            else:
+                song["source"] = os.path.join(self.midiFolder, os.path.splitext(x)[0]+".mid")
+            if self.useStore:
+                if self.writer.hasSong(name):
+                    continue
+            else:
+                song["output"] = os.path.join(self.outputFolder, os.path.splitext(x)[0]+".json")
+                if self.skipExistingFiles and os.path.exists(song["output"]):
+                    continue
+            songs.append(song)
+        return songs
+
+    async def inPool(self, function, *args):
+        result, records = await asyncio.get_running_loop().run_in_executor(self.pool, function, *args)
+        Metrics.merge(records)
+        return result
+
+    async def transcribe(self, song):
+        if self.skipExistingMidiFiles and os.path.exists(song["source"]):
+            return song
+        success, taken, attempts, error = await ConvertWavToMidi.transcribeAsync(
+            song["input"], song["source"], **self.transcriberSettings)
+        if not success:
+            raise Exception("transcription failed after {} attempt(s): {}".format(attempts, error))
+        return song
+
+    async def decode(self, song):
+        song["events"] = await self.inPool(decodeJob, song["source"], self.eventCache)
+        return song
+
+    async def features(self, song):
+        result = await self.inPool(featureJob, song["source"], song.pop("events"), self.featureSettings)
+        song["clips"], song["events"] = result if self.augmentation is not None else (result, None)
+        return song
+
+    async def write(self, song):
+        clips = song.pop("clips")
+        events = song.pop("events")
+        if self.useStore:
+            # Only this coroutine touches the store
+            self.writer.addSong(song["className"], song["name"], clips, events)
+        else:
+            await asyncio.to_thread(writeJson, song["output"], clips)
+        self.clipCount += len(clips)
+        return song
+
+    async def report(self, startTime, total):
+        lastReport = startTime
+        while True:
+            await asyncio.sleep(SAMPLE_SECONDS)
+            for stage in self.stages:
+                stage.sample()
+            if time.perf_counter()-lastReport >= REPORT_SECONDS:
+                lastReport = time.perf_counter()
+                self.printProgress(startTime, total)
+
+    def printProgress(self, startTime, total):
+        elapsed = max(time.perf_counter()-startTime, 1e-9)
+        print("\r{}/{} songs, {:.2f} songs/s | {}".format(
+            self.stages[-1].done, total, self.stages[-1].done/elapsed, " | ".join(
+                "{} {}/{} busy q{}".format(x.name, x.busy, x.workers, x.inbox.qsize()) for x in self.stages)),
+            end="", flush=True)
+
+    async def run(self):
+        startTime = time.perf_counter()
+        songs = self.songs()
+        steps = [("decode", self.decode, self.workers), ("features", self.features, self.workers),
+                 ("write", self.write, 1)]
+        if self.backend != "numpy":
+            steps.insert(0, ("transcribe", self.transcribe, self.workers))
+        # The first stage gets every song up front, the rest are bounded
+        inbox = asyncio.Queue()
+        for song in songs:
+            inbox.put_nowait(song)
+        for _ in range(steps[0][2]):
+            inbox.put_nowait(None)
+        for i, (name, function, workers) in enumerate(steps):
+            outbox = asyncio.Queue(maxsize=self.queueSize) if i+1 < len(steps) else None
+            self.stages.append(PipelineStage(name, function, workers, inbox, outbox))
+            inbox = outbox
+
+        print("Converting {} songs from {} to features, {}...".format(len(songs), self.inputFolder, self.outputFolder))
+        reporter = asyncio.create_task(self.report(startTime, len(songs)))
+        try:
+            await asyncio.gather(*[stage.run(self.stages[i+1].workers if i+1 < len(self.stages) else 0)
+                                   for i, stage in enumerate(self.stages)])
+        finally:
+            reporter.cancel()
+            self.printProgress(startTime, len(songs))
+            print()
+            elapsed = time.perf_counter()-startTime
+            for stage in self.stages:
+                print(stage.summary(elapsed))
+            for stage in self.stages:
+                for name, error in stage.failed:
+                    print("Failed to {} {}: {}".format(stage.name, name, error))
+        print("Finished {} songs, {} clips in {:.2f}s".format(
+            self.stages[-1].done, self.clipCount, time.perf_counter()-startTime))
+
+    async def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            if self.useStore:
+                with FeatureStore.FeatureStoreWriter(self.outputFolder, self.featuresPerClip, dtype=self.storeType,
+                                                     append=self.skipExistingFiles, augmentation=self.augmentation) as self.writer:
+                    await self.run()
+            else:
+                await self.run()
+        finally:
+            # Jobs not started yet are dropped, running ones finish but their
+            # results are never written
+            self.pool.shutdown(wait=True, cancel_futures=True)
+
+
+def runPipeline(inputFolder, midiFolder, outputFolder, **settings):
+    '''
+    Runs an IngestPipeline to the end, or until Ctrl+C. Cancelling keeps
+    every output finished so far and leaves no partial ones.
+    returns the pipeline
+    '''
+    pipeline = IngestPipeline(inputFolder, midiFolder, outputFolder, **settings)
+    try:
+        asyncio.run(pipeline.start())
+    except KeyboardInterrupt:
+        print("Cancelled, {} songs were written completely".format(
+            pipeline.stages[-1].done if pipeline.stages else 0))
+    return pipeline
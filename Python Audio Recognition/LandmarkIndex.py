@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import numpy as np
+import ConvertMidiToFeatures
+import FeatureStore
+import FileManagement
+
+# Landmarks pair each note onset with the next fanOut later onsets at most
+# maxDelta seconds away. A pair hashes the anchor pitch, the pitch interval
+# and the time between the onsets in deltaStep steps, and is stored with its
+# song and the anchor time in offsetStep steps. A query counts, per song, the
+# hits that agree on song time minus query time, so it is found wherever in
+# the song it starts without any spread augmentation. Lookups only read the
+# posting lists of the query's hashes, not the whole catalog.
+#
+#   meta      (key, value)                 settings and version as json
+#   classes   (id, name)
+#   songs     (id, name, class, landmarks)
+#   postings  (hash, batch, songs, times)  the song ids and anchor times as
+#                                          int32 blobs, one row per hash and
+#                                          batch of added songs
+#
+# Adding songs only appends rows under a new batch, the id of its first song,
+# so the blobs already written are never read back or rewritten. A lookup
+# joins the few batches of each hash.
+INDEX_VERSION = 2
+DEFAULT_SETTINGS = {"fanOut": 5, "maxDelta": 2.0, "deltaStep": 0.05, "offsetStep": 0.1}
+SQLITE_HEADER = b"SQLite format 3\x00"
+POSTING_DTYPE = np.dtype("<i4")
+# Landmarks of new songs held before they are merged into the posting lists
+FLUSH_LANDMARKS = 5000000
+# Hashes looked up per statement, under SQLite's variable limit
+LOOKUP_HASHES = 900
+
+
+def isLandmarkIndex(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+            return False
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='postings'").fetchone()[0] > 0
+    finally:
+        connection.close()
+
+
+def landmarks(events, settings=DEFAULT_SETTINGS):
+    '''
+    returns the (hash, anchor time step) of every landmark of the events,
+    without repeats
+    '''
+    notes, velocities, timeons, timeoffs = ConvertMidiToFeatures.eventsToArrays(events)
+    order = np.lexsort((notes, timeons))
+    notes = notes[order]
+    timeons = timeons[order]
+    # Notes of a chord share an onset, pairs start at the next later onset
+    first = np.searchsorted(timeons, timeons, side="right")
+    hashes = []
+    times = []
+    for step in range(settings["fanOut"]):
+        anchors = np.flatnonzero(first+step < len(notes))
+        targets = first[anchors]+step
+        delta = timeons[targets]-timeons[anchors]
+        near = delta <= settings["maxDelta"]
+        anchors = anchors[near]
+        targets = targets[near]
+        deltaSteps = np.rint(delta[near]/settings["deltaStep"]).astype(np.int64)
+        hashes.append((notes[anchors] << 16) | ((notes[targets]-notes[anchors]+128) << 8) | deltaSteps)
+        times.append(np.rint(timeons[anchors]/settings["offsetStep"]).astype(np.int64))
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.stack([np.concatenate(hashes), np.concatenate(times)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def readSongEvents(sourcePath):
+    '''
+    yields (class name, song name, events) from a feature store that keeps
+    its events, or from a folder of midi or wav files
+    '''
+    if FeatureStore.isFeatureStore(sourcePath):
+        store = FeatureStore.openFeatureStore(sourcePath)
+        for song in store.songs:
+            if "eventCount" not in song:
+                raise Exception("Feature store {} doesn't keep the events of {}, convert it again".format(
+                    sourcePath, song["name"]))
+            yield store.classNames[song["class"]], song["name"], store.songEvents(song)
+        return
+    for x in sorted(FileManagement.listAllFiles(sourcePath, relative=True)):
+        className, name = FeatureStore.songName(x)
+        yield className, name, ConvertMidiToFeatures.loadEvents(os.path.join(sourcePath, x))
+
+
+def connect(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS classes (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS songs (id INTEGER PRIMARY KEY, name TEXT UNIQUE, class INTEGER, landmarks INTEGER)")
+    connection.execute("CREATE TABLE IF NOT EXISTS postings (hash INTEGER, batch INTEGER, songs BLOB, times BLOB, "
+                       "PRIMARY KEY (hash, batch)) WITHOUT ROWID")
+    return connection
+
+
+def readSettings(connection):
+    row = connection.execute("SELECT value FROM meta WHERE key='settings'").fetchone()
+    if row is None:
+        return None
+    meta = json.loads(row[0])
+    if meta["version"] != INDEX_VERSION:
+        raise Exception("Unsupported landmark index version {}, build it again".format(meta["version"]))
+    return meta["settings"]
+
+
+def addPostings(connection, hashes, songs, times):
+    '''
+    appends landmarks to the posting lists of their hashes, as new rows under
+    the batch of the first song they come from
+    '''
+    order = np.argsort(hashes, kind="stable")
+    hashes = hashes[order]
+    songs = songs[order].astype(POSTING_DTYPE)
+    times = times[order].astype(POSTING_DTYPE)
+    batch = int(songs.min())
+    unique, starts = np.unique(hashes, return_index=True)
+    ends = np.append(starts[1:], len(hashes))
+    connection.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)", (
+        (hashValue, batch, songs[start:end].tobytes(), times[start:end].tobytes())
+        for hashValue, start, end in zip(unique.tolist(), starts.tolist(), ends.tolist())))
+
+
+def buildIndex(path, sourcePath, settings=DEFAULT_SETTINGS):
+    '''
+    Adds the songs in sourcePath to the landmark index at path, songs
+    already in the index are skipped
+    '''
+    parentFolder = os.path.dirname(path)
+    if parentFolder != "" and not os.path.exists(parentFolder):
+        os.makedirs(parentFolder)
+    print("Adding {} to landmark index {}...".format(sourcePath, path))
+    startTime = time.time()
+    connection = connect(path)
+    # Settings are fixed by the first build, queries hash the same way
+    settings = readSettings(connection) or settings
+    connection.execute("INSERT OR REPLACE INTO meta VALUES ('settings', ?)",
+                       (json.dumps({"version": INDEX_VERSION, "settings": settings}),))
+    classNumbers = dict((name, i) for i, name in connection.execute("SELECT id, name FROM classes"))
+    existing = set(x[0] for x in connection.execute("SELECT name FROM songs"))
+
+    songCount = 0
+    landmarkCount = 0
+    pending = []
+    held = 0
+    with connection:
+        for className, name, events in readSongEvents(sourcePath):
+            if name in existing:
+                continue
+            if className not in classNumbers:
+                classNumbers[className] = len(classNumbers)
+                connection.execute("INSERT INTO classes VALUES (?, ?)", (classNumbers[className], className))
+            hashes, times = landmarks(events, settings)
+            songId = connection.execute("INSERT INTO songs (name, class, landmarks) VALUES (?, ?, ?)",
+                                        (name, classNumbers[className], len(hashes))).lastrowid
+            pending.append((hashes, np.full(len(hashes), songId), times))
+            held += len(hashes)
+            songCount += 1
+            landmarkCount += len(hashes)
+            if held >= FLUSH_LANDMARKS:
+                addPostings(connection, *[np.concatenate(x) for x in zip(*pending)])
+                pending = []
+                held = 0
+        if held > 0:
+            addPostings(connection, *[np.concatenate(x) for x in zip(*pending)])
+    connection.close()
+    print("Added {} songs, {} landmarks in {:.2f}s".format(
+        songCount, landmarkCount, time.time()-startTime))
+
+
+class LandmarkIndex:
+    '''
+    Queries a landmark index with note events instead of clips. rankSongs
+    returns [(class, score, offset), ...] like the clip models, where score is
+    the share of the query's landmarks that line up with the song and offset
+    is where in the song, in seconds, the query starts.
+    '''
+    usesEvents = True
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = connect(path)
+        self.settings = readSettings(self.connection) or DEFAULT_SETTINGS
+        self.classNames = [x[0] for x in self.connection.execute("SELECT name FROM classes ORDER BY id")]
+        songs = self.connection.execute("SELECT id, class FROM songs").fetchall()
+        self.songClasses = np.zeros(max([x[0] for x in songs], default=0)+1, dtype=np.int64)
+        for songId, classId in songs:
+            self.songClasses[songId] = classId
+
+    def postings(self, hashes):
+        '''
+        returns the concatenated song ids and times of the posting lists of
+        hashes, with the start and length of each hash's list
+        '''
+        found = {}
+        hashList = hashes.tolist()
+        for i in range(0, len(hashList), LOOKUP_HASHES):
+            part = hashList[i:i+LOOKUP_HASHES]
+            for hashValue, songs, times in self.connection.execute(
+                    "SELECT hash, songs, times FROM postings WHERE hash IN ({})".format(",".join("?"*len(part))), part):
+                batches = found.setdefault(hashValue, ([], []))
+                batches[0].append(songs)
+                batches[1].append(times)
+        songs = [np.frombuffer(b"".join(found[x][0]), dtype=POSTING_DTYPE) if x in found else np.zeros(0, POSTING_DTYPE)
+                 for x in hashList]
+        times = [np.frombuffer(b"".join(found[x][1]), dtype=POSTING_DTYPE) if x in found else np.zeros(0, POSTING_DTYPE)
+                 for x in hashList]
+        lengths = np.array([len(x) for x in songs], dtype=np.int64)
+        starts = np.cumsum(lengths)-lengths
+        if len(songs) == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), starts, lengths
+        return np.concatenate(songs).astype(np.int64), np.concatenate(times).astype(np.int64), starts, lengths
+
+    def hits(self, events):
+        '''
+        returns the query landmark count and the (song, offset, hits) rows,
+        sorted by song then offset
+        '''
+        hashes, times = landmarks(events, self.settings)
+        unique, inverse = np.unique(hashes, return_inverse=True)
+        postingSongs, postingTimes, starts, lengths = self.postings(unique)
+        # Every query landmark against every posting of its hash
+        counts = lengths[inverse]
+        first = np.repeat(starts[inverse], counts)
+        rows = first+np.arange(len(first))-np.repeat(np.cumsum(counts)-counts, counts)
+        songs = postingSongs[rows]
+        offsets = postingTimes[rows]-np.repeat(times, counts)
+        # One int64 key per (song, offset) sorts far faster than the pairs
+        low = offsets.min() if len(offsets) > 0 else 0
+        span = offsets.max()-low+1 if len(offsets) > 0 else 1
+        keys, hitCounts = np.unique(songs*span+offsets-low, return_counts=True)
+        return len(hashes), np.stack([keys//span, keys % span+low, hitCounts], axis=1)
+
+    def rankSongs(self, events, top=5):
+        queryCount, rows = self.hits(events)
+        if len(rows) == 0:
+            return []
+        songs, offsets, counts = rows.T
+        # Rows come grouped by song and offset, a query time that rounded the
+        # other way lands in the next offset so neighbours are added together
+        nextCounts = np.zeros(len(counts), dtype=np.int64)
+        adjacent = (songs[1:] == songs[:-1]) & (offsets[1:] == offsets[:-1]+1)
+        nextCounts[:-1][adjacent] = counts[1:][adjacent]
+        scores = counts+nextCounts
+
+        classes = self.songClasses[songs]
+        order = np.lexsort((-scores, classes))
+        best = order[np.concatenate([[True], classes[order][1:] != classes[order][:-1]])]
+        best = best[np.argsort(-scores[best], kind="stable")][:top]
+        return [(int(classes[i]), min(float(scores[i])/queryCount, 1.0), float(offsets[i]*self.settings["offsetStep"]))
+                for i in best]
+
+    def predict(self, eventLists):
+        return np.array([ranked[0][0] if ranked else -1 for ranked in
+                         (self.rankSongs(x, top=1) for x in eventLists)])
+
+    def stats(self):
+        songs, landmarkCount = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(landmarks), 0) FROM songs").fetchone()
+        hashCount = self.connection.execute("SELECT COUNT(DISTINCT hash) FROM postings").fetchone()[0]
+        return {"songs": songs, "landmarks": landmarkCount, "hashes": hashCount,
+                "bytes": os.path.getsize(self.path)}
+
+
+def loadIndex(path):
+    index = LandmarkIndex(path)
+    return index, index.classNames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a landmark hash index from the notes of songs")
+    parser.add_argument("indexPath", type=str, help="Path of the index file")
+    parser.add_argument("sourcePath", type=str,
+                        help="Feature store that keeps its events, or a folder of midi or wav files")
+    args = vars(parser.parse_args())
+    buildIndex(args["indexPath"], args["sourcePath"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import sys
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is left out there
+    resource = None
+
+# Every stage(...) block adds its wall time, counts and peak memory to the
+# totals of its stage name, and to the per file list when it was given a file.
+# Worker processes hand their records back with collect() and the parent
+# merge()s them. A forked worker starts with no records, else it would hand
+# back the parent's as well and they'd be counted twice.
+lock = threading.Lock()
+stageTotals = {}
+fileRecords = []
+profileStage = None
+profiler = None
+
+
+def peakRssMB():
+    '''
+    returns the most memory this process has held so far, in MB
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak/2**20 if sys.platform == "darwin" else peak/2**10
+
+
+def addRecord(name, fileName, seconds, counts, peak):
+    with lock:
+        totals = stageTotals.setdefault(name, {"calls": 0, "seconds": 0.0})
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+        if peak is not None:
+            totals["peakRssMB"] = max(totals.get("peakRssMB", 0), peak)
+        if fileName is not None:
+            record = {"stage": name, "file": fileName, "seconds": seconds}
+            record.update(counts)
+            if peak is not None:
+                record["peakRssMB"] = peak
+            fileRecords.append(record)
+
+
+@contextlib.contextmanager
+def stage(name, fileName=None, **counts):
+    '''
+    Times the block as stage name. Counts such as events, clips or bytes
+    can be passed in, or added to the yielded dict inside the block.
+    '''
+    global profiler
+    counts = dict(counts)
+    profiling = name == profileStage
+    if profiling:
+        with lock:
+            if profiler is None:
+                profiler = cProfile.Profile()
+        # cProfile can only run one profile at a time
+        try:
+            profiler.enable()
+        except ValueError:
+            profiling = False
+    startTime = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        seconds = time.perf_counter()-startTime
+        if profiling:
+            profiler.disable()
+        addRecord(name, fileName, seconds, counts, peakRssMB())
+
+
+def profile(stageName):
+    '''
+    Runs cProfile over every block of stageName, the stats are written out by dump
+    '''
+    global profileStage
+    profileStage = stageName
+
+
+def collect():
+    '''
+    returns and clears the records gathered so far, used to send a worker
+    process's records back to the parent
+    '''
+    global stageTotals, fileRecords
+    with lock:
+        records = {"stages": stageTotals, "files": fileRecords}
+        stageTotals = {}
+        fileRecords = []
+    return records
+
+
+def resetInChild():
+    '''
+    Clears what a forked process copied from its parent, the lock included
+    in case another thread held it at the fork
+    '''
+    global lock, stageTotals, fileRecords, profiler
+    lock = threading.Lock()
+    stageTotals = {}
+    fileRecords = []
+    profiler = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=resetInChild)
+
+
+def merge(records):
+    with lock:
+        for name, totals in records["stages"].items():
+            current = stageTotals.setdefault(name, {"calls": 0, "seconds": 0.0})
+            for key, value in totals.items():
+                if key == "peakRssMB":
+                    current[key] = max(current.get(key, 0), value)
+                else:
+                    current[key] = current.get(key, 0) + value
+        fileRecords.extend(records["files"])
+
+
+def dump(path):
+    '''
+    writes the stage totals and per file records to path as json, and the
+    profile of the profiled stage next to it
+    '''
+    with lock:
+        report = {"peakRssMB": peakRssMB(), "stages": stageTotals, "files": fileRecords}
+        with open(path, "w") as f:
+            f.write(json.dumps(report, indent=1))
+    print("Wrote metrics to {}".format(path))
+    if profiler is not None:
+        profiler.dump_stats(path+".prof")
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(20)
+        print("Profile of stage {} (saved to {}):".format(profileStage, path+".prof"))
+        print(text.getvalue())
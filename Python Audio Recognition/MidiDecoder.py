@@ -0,0 +1,218 @@
+import os
+import struct
+import argparse
+import numpy as np
+import BuildManifest
+
+# One row per note, the same columns as the old ['note', 'velocity',
+# 'time on', 'time off'] lists. Times stay float64, midi times often land
+# exactly on a feature bin edge and float32 rounding moves them across it.
+EVENT_DTYPE = np.dtype([("note", "u1"), ("velocity", "u1"),
+                        ("on", "f8"), ("off", "f8")])
+DEFAULT_TEMPO = 500000
+# Decoded events are cached as <cacheFolder>/<midi sha1>-<version>.npy, bump
+# the version when a change to decodeMidi changes what it returns
+DECODER_VERSION = "1"
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+META = 0xFF
+SYSEX = 0xF0
+SYSEX_ESCAPE = 0xF7
+META_TEMPO = 0x51
+META_END_OF_TRACK = 0x2F
+
+
+def readVarLen(data, i):
+    value = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, i
+
+
+def readTrack(data, start, end, trackNumber, notes, tempos):
+    '''
+    appends (tick, track, channel, note, velocity, on) for every note message
+    to notes and (tick, tempo) for every tempo change to tempos.
+    returns the tick the track ends at
+    '''
+    i = start
+    tick = 0
+    status = 0
+    while i < end:
+        delta, i = readVarLen(data, i)
+        tick += delta
+        if data[i] & 0x80:
+            status = data[i]
+            i += 1
+        if status == META:
+            kind = data[i]
+            length, i = readVarLen(data, i+1)
+            if kind == META_TEMPO and length == 3:
+                tempos.append((tick, (data[i] << 16) | (data[i+1] << 8) | data[i+2]))
+            elif kind == META_END_OF_TRACK:
+                break
+            i += length
+            # Meta and sysex messages cancel running status
+            status = 0
+        elif status == SYSEX or status == SYSEX_ESCAPE:
+            length, i = readVarLen(data, i)
+            i += length
+            status = 0
+        elif status == 0:
+            raise Exception("Running status without a status byte at {}".format(i))
+        else:
+            kind = status & 0xF0
+            if kind == NOTE_ON or kind == NOTE_OFF:
+                velocity = data[i+1]
+                # note_on with velocity 0 is a note_off
+                notes.append((tick, trackNumber, status & 0x0F, data[i],
+                              velocity, kind == NOTE_ON and velocity > 0))
+            # Program change and channel pressure have one data byte
+            i += 1 if kind == 0xC0 or kind == 0xD0 else 2
+    return tick
+
+
+def readMidi(path):
+    '''
+    returns (ticks per beat or None, SMPTE ticks per second or None,
+    note messages, tempo changes, end tick of every track)
+    '''
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"MThd":
+        raise Exception("{} is not a midi file".format(path))
+    headerLength, fileFormat, trackCount, division = struct.unpack(">IHHH", data[4:14])
+    ticksPerBeat = None
+    ticksPerSecond = None
+    if division & 0x8000:
+        # SMPTE timing, the tempo doesn't matter
+        ticksPerSecond = (256-(division >> 8))*(division & 0xFF)
+    else:
+        ticksPerBeat = division
+
+    notes = []
+    tempos = []
+    trackEnds = []
+    i = 8+headerLength
+    while i+8 <= len(data) and len(trackEnds) < trackCount:
+        chunkId, length = struct.unpack(">4sI", data[i:i+8])
+        start = i+8
+        end = min(start+length, len(data))
+        i = end
+        if chunkId != b"MTrk":
+            continue
+        trackEnds.append(readTrack(data, start, end, len(trackEnds), notes, tempos))
+    return ticksPerBeat, ticksPerSecond, notes, tempos, np.array(trackEnds, dtype=np.int64)
+
+
+def ticksToSeconds(ticks, ticksPerBeat, ticksPerSecond, tempos):
+    '''
+    converts absolute ticks to seconds through the tempo map in one pass
+    '''
+    ticks = np.asarray(ticks, dtype=np.int64)
+    if ticksPerSecond is not None:
+        return ticks/ticksPerSecond
+    changes = sorted(tempos, key=lambda x: x[0])
+    changeTicks = np.array([0]+[x[0] for x in changes], dtype=np.int64)
+    changeTempos = np.array([DEFAULT_TEMPO]+[x[1] for x in changes], dtype=np.float64)
+    # Seconds from the start of the song to each tempo change
+    changeSeconds = np.concatenate(
+        [[0], np.cumsum(np.diff(changeTicks)*changeTempos[:-1])])/(ticksPerBeat*1e6)
+    # side="right" so the last of several changes on one tick wins
+    segment = np.searchsorted(changeTicks, ticks, side="right")-1
+    return changeSeconds[segment]+(ticks-changeTicks[segment])*changeTempos[segment]/(ticksPerBeat*1e6)
+
+
+def decodeMidi(path):
+    '''
+    returns an EVENT_DTYPE array of every note in the file, sorted by time on.
+    A note still held when another note_on of the same pitch arrives ends
+    there, and notes never released end with their track.
+    '''
+    ticksPerBeat, ticksPerSecond, notes, tempos, trackEnds = readMidi(path)
+    if len(notes) == 0:
+        return np.zeros(0, dtype=EVENT_DTYPE)
+    table = np.array(notes, dtype=np.int64)
+    ticks, tracks, channels, pitches, velocities, isOn = table.T
+    isOn = isOn.astype(bool)
+
+    # Group the messages of each pitch on each channel, keeping file order, so
+    # a note_on ends at whatever message of its pitch comes next
+    key = (tracks*16+channels)*128+pitches
+    order = np.argsort(key, kind="stable")
+    key = key[order]
+    nextSameKey = np.concatenate([key[1:] == key[:-1], [False]])
+    starts = np.flatnonzero(isOn[order])
+    ends = np.where(nextSameKey[starts], ticks[order][np.minimum(starts+1, len(order)-1)],
+                    trackEnds[tracks[order][starts]])
+    # Drop a note immediately restarted on the same tick, the restart replaces it
+    retriggered = nextSameKey[starts] & isOn[order][np.minimum(starts+1, len(order)-1)]
+    keep = ~(retriggered & (ends == ticks[order][starts]))
+    starts = order[starts[keep]]
+    ends = ends[keep]
+
+    events = np.empty(len(starts), dtype=EVENT_DTYPE)
+    events["note"] = pitches[starts]
+    events["velocity"] = velocities[starts]
+    events["on"] = ticksToSeconds(ticks[starts], ticksPerBeat, ticksPerSecond, tempos)
+    events["off"] = ticksToSeconds(ends, ticksPerBeat, ticksPerSecond, tempos)
+    return events[np.lexsort((events["note"], events["on"]))]
+
+
+def toEventArray(events):
+    '''
+    returns ['note', 'velocity', 'time on', 'time off'] lists as an EVENT_DTYPE array
+    '''
+    if isinstance(events, np.ndarray) and events.dtype.names:
+        return events.astype(EVENT_DTYPE, copy=False)
+    table = np.asarray(events, dtype=np.float64).reshape(-1, 4)
+    array = np.empty(len(table), dtype=EVENT_DTYPE)
+    for i, name in enumerate(EVENT_DTYPE.names):
+        array[name] = table[:, i]
+    return array
+
+
+def cachePath(path, cacheFolder):
+    return os.path.join(cacheFolder, "{}-{}.npy".format(BuildManifest.fileHash(path), DECODER_VERSION))
+
+
+def loadMidiEvents(path, cacheFolder=None):
+    '''
+    decodeMidi, through an on disk cache keyed by the hash of the midi file
+    so an unchanged file is only ever parsed once. No cacheFolder, the default,
+    disables it.
+    '''
+    if not cacheFolder:
+        return decodeMidi(path)
+    cached = cachePath(path, cacheFolder)
+    if os.path.exists(cached):
+        try:
+            return np.load(cached)
+        except (OSError, ValueError):
+            # Unreadable entry, decode again and overwrite it
+            pass
+    events = decodeMidi(path)
+    os.makedirs(cacheFolder, exist_ok=True)
+    # Workers may decode the same file at once, each writes its own temp file
+    tempPath = "{}.{}.tmp".format(cached, os.getpid())
+    with open(tempPath, "wb") as f:
+        np.save(f, events)
+    os.replace(tempPath, cached)
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the notes of a midi file")
+    parser.add_argument("midiPath", type=str, help="Path of the midi file")
+    args = vars(parser.parse_args())
+    for note, velocity, timeon, timeoff in decodeMidi(args["midiPath"]):
+        print("{:4d} {:4d} {:10.3f} {:10.3f}".format(note, velocity, timeon, timeoff))
+
+
+if __name__ == "__main__":
+    main()
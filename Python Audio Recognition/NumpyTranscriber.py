@@ -0,0 +1,215 @@
+import os
+import struct
+import argparse
+import numpy as np
+import ConvertMidiToFeatures
+
+# Same analysis settings as the waon "clean" command in ConvertWavToMidi:
+# -w 6 -n 2048 -s 512
+WINDOW_SIZE = 4096//2
+HOP_SIZE = WINDOW_SIZE//4
+# Frames read from the memory mapped wav at a time
+CHUNK_FRAMES = 1 << 18
+
+WAV_PCM = 1
+WAV_FLOAT = 3
+WAV_EXTENSIBLE = 0xFFFE
+
+
+def steeperWindow(size):
+    # waon window 6, the "steeper 30-dB/octave rolloff" window
+    phase = 2*np.pi*np.arange(size)/size
+    return 0.375 - 0.5*np.cos(phase) + 0.125*np.cos(2*phase)
+
+
+def readWavHeader(path):
+    '''
+    returns (format, channels, sample rate, bits per sample, data offset, data size)
+    '''
+    with open(path, "rb") as f:
+        riff, size, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            raise Exception("{} is not a wav file".format(path))
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise Exception("{} has no data chunk".format(path))
+            chunkId, chunkSize = struct.unpack("<4sI", header)
+            if chunkId == b"fmt ":
+                body = f.read(chunkSize)
+                fmt = struct.unpack("<HHIIHH", body[:16])
+                if fmt[0] == WAV_EXTENSIBLE and len(body) >= 26:
+                    # The real format is the start of the sub format guid
+                    fmt = (struct.unpack("<H", body[24:26])[0],) + fmt[1:]
+            elif chunkId == b"data":
+                if fmt is None:
+                    raise Exception("{} has data before its format".format(path))
+                fileSize = os.path.getsize(path)
+                # Some writers leave the size at 0 or too big when streaming
+                chunkSize = min(chunkSize, fileSize-f.tell()) if chunkSize else fileSize-f.tell()
+                return fmt[0], fmt[1], fmt[2], fmt[5], f.tell(), chunkSize
+            else:
+                f.seek(chunkSize + (chunkSize & 1), os.SEEK_CUR)
+
+
+def openWav(path):
+    '''
+    returns the samples as a (frames, channels) memory map and the sample rate
+    '''
+    formatTag, channels, sampleRate, bits, offset, size = readWavHeader(path)
+    if formatTag == WAV_PCM and bits in (8, 16, 32):
+        dtype = {8: np.uint8, 16: np.int16, 32: np.int32}[bits]
+    elif formatTag == WAV_FLOAT and bits in (32, 64):
+        dtype = {32: np.float32, 64: np.float64}[bits]
+    else:
+        raise Exception("Unsupported wav format {} with {} bits".format(
+            formatTag, bits))
+    frameCount = size // (channels*np.dtype(dtype).itemsize)
+    if frameCount == 0:
+        return np.zeros((0, channels), dtype=dtype), sampleRate
+    samples = np.memmap(path, dtype=dtype, mode="r", offset=offset,
+                        shape=(frameCount, channels))
+    return samples, sampleRate
+
+
+def toMono(samples):
+    '''
+    returns a chunk of wav samples as mono floats between -1 and 1
+    '''
+    if samples.dtype == np.uint8:
+        scaled = (samples.astype(np.float32)-128)/128
+    elif np.issubdtype(samples.dtype, np.integer):
+        scaled = samples.astype(np.float32)/np.iinfo(samples.dtype).max
+    else:
+        scaled = samples.astype(np.float32)
+    return scaled.mean(axis=1)
+
+
+class NoteTracker:
+    '''
+    Turns audio into note events a chunk at a time.
+    feed returns the [note, velocity, timeon, timeoff] events that ended
+    within the chunk, flush ends every note still sounding.
+    '''
+
+    def __init__(self, sampleRate, windowSize=WINDOW_SIZE, hopSize=HOP_SIZE, absoluteCutoff=-50, relativeCutoff=-30):
+        self.sampleRate = sampleRate
+        self.windowSize = windowSize
+        self.hopSize = hopSize
+        self.absoluteCutoff = absoluteCutoff
+        self.relativeCutoff = relativeCutoff
+
+        self.window = steeperWindow(windowSize).astype(np.float32)
+        # A full scale sine peaks at half the window sum
+        self.reference = self.window.sum()/2
+
+        # Group fft bins by the midi note they fall into
+        frequencies = np.arange(windowSize//2+1)*sampleRate/windowSize
+        with np.errstate(divide="ignore"):
+            notes = np.round(69+12*np.log2(frequencies/440))
+        usable = np.flatnonzero((frequencies > 0) & (notes >= 0) & (notes <= 127))
+        self.bins = usable
+        self.binNotes, self.noteStarts = np.unique(
+            notes[usable].astype(np.int64), return_index=True)
+
+        self.pending = np.zeros(0, dtype=np.float32)
+        self.frame = 0
+        self.active = np.zeros(128, dtype=bool)
+        self.startFrame = np.zeros(128, dtype=np.int64)
+        self.velocity = np.zeros(128, dtype=np.int64)
+
+    def frameTime(self, frame):
+        return float(frame*self.hopSize/self.sampleRate)
+
+    def noteLevels(self, frames):
+        '''
+        returns the peak level in dB of every midi note for each frame,
+        only counting bins that are a local maximum of the spectrum
+        '''
+        spectrum = np.abs(np.fft.rfft(frames*self.window, axis=1))
+        peaks = np.zeros_like(spectrum)
+        isPeak = (spectrum[:, 1:-1] > spectrum[:, :-2]) & (spectrum[:, 1:-1] >= spectrum[:, 2:])
+        peaks[:, 1:-1] = np.where(isPeak, spectrum[:, 1:-1], 0)
+
+        levels = np.zeros((len(frames), 128), dtype=np.float64)
+        levels[:, self.binNotes] = np.maximum.reduceat(
+            peaks[:, self.bins], self.noteStarts, axis=1)
+        with np.errstate(divide="ignore"):
+            return 20*np.log10(levels/self.reference)
+
+    def feed(self, samples):
+        self.pending = np.concatenate([self.pending, samples.astype(np.float32)])
+        if len(self.pending) < self.windowSize:
+            return []
+        frameCount = 1 + (len(self.pending)-self.windowSize)//self.hopSize
+        frames = np.lib.stride_tricks.sliding_window_view(
+            self.pending, self.windowSize)[::self.hopSize][:frameCount]
+
+        levels = self.noteLevels(frames)
+        loudest = levels.max(axis=1, keepdims=True)
+        on = (levels >= self.absoluteCutoff) & (levels >= loudest+self.relativeCutoff)
+        velocities = np.clip(np.round(127*(1+levels/60)), 1, 127)
+
+        events = self.trackNotes(on, velocities)
+        self.pending = self.pending[frameCount*self.hopSize:]
+        self.frame += frameCount
+        return events
+
+    def trackNotes(self, on, velocities):
+        events = []
+        previous = np.vstack([self.active[None, :], on])
+        changes = previous[1:] != previous[:-1]
+        for note in np.flatnonzero(changes.any(axis=0)):
+            for index in np.flatnonzero(changes[:, note]):
+                frame = self.frame+index
+                if on[index, note]:
+                    self.startFrame[note] = frame
+                    self.velocity[note] = velocities[index, note]
+                else:
+                    events.append([int(note), int(self.velocity[note]), self.frameTime(
+                        self.startFrame[note]), self.frameTime(frame)])
+        self.active = on[-1].copy() if len(on) > 0 else self.active
+        return events
+
+    def flush(self):
+        events = [[int(note), int(self.velocity[note]), self.frameTime(self.startFrame[note]), self.frameTime(self.frame)]
+                  for note in np.flatnonzero(self.active)]
+        self.active[:] = False
+        return events
+
+
+def wavToEvents(inputPath, outputPath=None, chunkFrames=CHUNK_FRAMES, **trackerSettings):
+    '''
+    returns ['note', 'velocity', 'time on', 'time off']s transcribed from a
+    wav file, and writes them as a midi file too if outputPath is given
+    '''
+    samples, sampleRate = openWav(inputPath)
+    tracker = NoteTracker(sampleRate, **trackerSettings)
+    events = []
+    for start in range(0, len(samples), chunkFrames):
+        events.extend(tracker.feed(toMono(samples[start:start+chunkFrames])))
+    events.extend(tracker.flush())
+    events.sort(key=lambda x: (x[2], x[0]))
+
+    if outputPath:
+        parentfolder = os.path.dirname(outputPath)
+        if not os.path.exists(parentfolder) and parentfolder != "":
+            os.makedirs(parentfolder)
+        ConvertMidiToFeatures.convertEventsToMidi(events, outputPath)
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transcribe a wav file to note events without waon")
+    parser.add_argument("wavPath", type=str, help="Path of the wav file")
+    parser.add_argument("midiPath", type=str, nargs="?", default=None,
+                        help="Path to write a midi file to")
+    args = vars(parser.parse_args())
+    events = wavToEvents(args["wavPath"], args["midiPath"])
+    print("Transcribed {} notes.".format(len(events)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import time
+import numpy as np
+import ClipIndex
+
+# Normalized clips hold 0 for a missing bin and 10 to 20 for the others.
+# Quantized, a present bin is a uint8 code with value LOW+code*STEP and which
+# bins are present is a separate bit mask, packed after the codes so a clip of
+# F bins is one row of F+ceil(F/8) bytes, 225 for 200 bins instead of 1600 as
+# float64. The worst rounding error is STEP/2, about 0.02.
+LOW = 10
+HIGH = 20
+LEVELS = 255
+STEP = (HIGH-LOW)/LEVELS
+# Rows of the index compared with a block of queries at a time
+BLOCK_CLIPS = 4096
+
+
+def rowBytes(featuresPerClip):
+    return featuresPerClip+(featuresPerClip+7)//8
+
+
+def pack(clips):
+    '''
+    returns normalized clips as an (n, rowBytes) uint8 array of codes then mask
+    '''
+    if isinstance(clips, QuantizedClips):
+        return np.asarray(clips.packed)
+    clips = np.asarray(clips, dtype=np.float64)
+    clips = clips.reshape(len(clips), -1)
+    present = clips != 0
+    codes = np.rint((np.clip(clips, LOW, HIGH)-LOW)/STEP).astype(np.uint8)
+    codes[~present] = 0
+    return np.concatenate([codes, np.packbits(present, axis=1)], axis=1)
+
+
+def levelsOf(packed, featuresPerClip, dtype=np.float32):
+    '''
+    returns the rows as whole numbers with value level*STEP, LEVELS to
+    2*LEVELS for a present bin and 0 for a missing one. Distances between
+    levels are the distances between the values over STEP.
+    '''
+    present = np.unpackbits(packed[:, featuresPerClip:], axis=1, count=featuresPerClip)
+    return (packed[:, :featuresPerClip].astype(dtype)+LEVELS)*present
+
+
+def unpack(packed, featuresPerClip, dtype=np.float32):
+    '''
+    returns packed rows as normalized clips, 0 for a missing bin
+    '''
+    return (levelsOf(packed, featuresPerClip, dtype=np.float64)*STEP).astype(dtype)
+
+
+class QuantizedClips:
+    '''
+    Packed clips that read like a float array: len, slicing and np.asarray
+    work, so the float models and json code can take them unchanged, while
+    QuantizedIndex uses the codes directly
+    '''
+
+    def __init__(self, packed, featuresPerClip):
+        self.packed = packed
+        self.featuresPerClip = featuresPerClip
+        self.shape = (len(packed), featuresPerClip)
+        self.dtype = np.dtype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return unpack(self.packed[index:index+1], self.featuresPerClip)[0]
+        return QuantizedClips(self.packed[index], self.featuresPerClip)
+
+    def __array__(self, dtype=None, copy=None):
+        return unpack(self.packed, self.featuresPerClip, dtype=dtype or np.float32)
+
+    def tolist(self):
+        return np.asarray(self).tolist()
+
+    def tofile(self, f):
+        np.ascontiguousarray(self.packed).tofile(f)
+
+
+def concatenate(parts):
+    '''
+    joins clip arrays, staying packed when every part is QuantizedClips
+    '''
+    if len(parts) > 0 and all(isinstance(x, QuantizedClips) for x in parts):
+        return QuantizedClips(np.concatenate([x.packed for x in parts]), parts[0].featuresPerClip)
+    return np.concatenate([np.asarray(x, dtype=np.float64) for x in parts])
+
+
+def nearest(queryLevels, queryNorms, levels, norms, offset, bestDistances, bestIndices, k):
+    '''
+    merges the squared level distances of a block of index rows starting at
+    offset into the k best found so far for each query
+    '''
+    # |a-b|^2 = |a|^2 + |b|^2 - 2ab, the levels are whole numbers so the norms
+    # are exact and only the float32 product rounds
+    distances = queryNorms[:, None]+norms[None, :]-2*(queryLevels @ levels.T).astype(np.float64)
+    indices = np.broadcast_to(np.arange(offset, offset+len(levels)), distances.shape)
+    distances = np.concatenate([bestDistances, distances], axis=1)
+    indices = np.concatenate([bestIndices, indices], axis=1)
+    if distances.shape[1] <= k:
+        return distances, indices
+    keep = np.argpartition(distances, k-1, axis=1)[:, :k]
+    return np.take_along_axis(distances, keep, axis=1), np.take_along_axis(indices, keep, axis=1)
+
+
+class QuantizedIndex:
+    '''
+    Brute force nearest neighbour search over quantized clips, a drop in for
+    ClipIndex. The index holds only the packed codes and compares them with
+    the queries a block at a time.
+    '''
+
+    def __init__(self, neighbours=10, blockClips=BLOCK_CLIPS):
+        self.neighbours = neighbours
+        self.blockClips = blockClips
+        self.packed = None
+        self.classes = None
+
+    def fit(self, data, classes):
+        startTime = time.time()
+        if not isinstance(data, QuantizedClips):
+            data = np.asarray(data)
+        self.featuresPerClip = data.shape[1]
+        self.packed = np.ascontiguousarray(pack(data))
+        self.classes = np.asarray(classes, dtype=np.int32)
+        self.norms = np.concatenate([np.square(levelsOf(self.packed[i:i+self.blockClips], self.featuresPerClip,
+                                                        dtype=np.float64)).sum(axis=1)
+                                     for i in range(0, len(self.packed), self.blockClips)] or [np.zeros(0)])
+        self.buildTime = time.time()-startTime
+        print("Quantized {} clips into {:.1f} MB in {:.2f}s".format(
+            len(self.classes), self.nbytes/2**20, self.buildTime))
+        return self
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes+self.norms.nbytes+self.classes.nbytes
+
+    def query(self, data, neighbours=None):
+        '''
+        returns the distances and classes of the nearest clips to every clip
+        '''
+        k = min(neighbours or self.neighbours, len(self.classes))
+        queries = pack(data)
+        distances = np.zeros((len(queries), k))
+        indices = np.zeros((len(queries), k), dtype=np.int64)
+        for start in range(0, len(queries), self.blockClips):
+            queryLevels = levelsOf(queries[start:start+self.blockClips], self.featuresPerClip)
+            queryNorms = np.square(queryLevels.astype(np.float64)).sum(axis=1)
+            bestDistances = np.zeros((len(queryLevels), 0))
+            bestIndices = np.zeros((len(queryLevels), 0), dtype=np.int64)
+            for offset in range(0, len(self.packed), self.blockClips):
+                levels = levelsOf(self.packed[offset:offset+self.blockClips], self.featuresPerClip)
+                bestDistances, bestIndices = nearest(queryLevels, queryNorms, levels,
+                                                     self.norms[offset:offset+self.blockClips], offset,
+                                                     bestDistances, bestIndices, k)
+            order = np.argsort(bestDistances, axis=1, kind="stable")
+            distances[start:start+len(queryLevels)] = np.take_along_axis(bestDistances, order, axis=1)
+            indices[start:start+len(queryLevels)] = np.take_along_axis(bestIndices, order, axis=1)
+        return np.sqrt(np.maximum(distances, 0))*STEP, self.classes[indices]
+
+    def predict(self, data):
+        distances, classes = self.query(data, neighbours=1)
+        return classes[:, 0]
+
+    def rankSongs(self, data, top=5):
+        '''
+        returns [(class, score, mean distance), ...] best first, scored like
+        ClipIndex.rankSongs
+        '''
+        distances, classes = self.query(data)
+        return ClipIndex.rankNeighbours(distances, classes, top=top)
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import threading
+import joblib
+import numpy as np
+import ClipIndex
+import FeatureStore
+import Augmentation
+import FileManagement
+
+# A catalog is a folder of immutable segments, each one a feature store plus
+# a ClipIndex over its clips. catalog.json lists the live segments and the
+# class names, which only ever get appended to so class numbers never change:
+#
+#   catalog.json  {"version", "classNames", "segments", "nextSegment"}
+#   segment-000001/store.json, clips.bin, index.m
+#
+# catalog.json.lock is held while catalog.json is edited. segments.lock is
+# held while a reader loads the segments and while compaction removes the
+# segments it merged, so a reader never finds a listed segment gone.
+CATALOG_VERSION = 1
+CATALOG_META = "catalog.json"
+SEGMENT_INDEX = "index.m"
+SEGMENTS_LOCK = "segments.lock"
+
+
+def isCatalog(path):
+    return os.path.isfile(os.path.join(path, CATALOG_META))
+
+
+def readCatalog(path):
+    if not isCatalog(path):
+        return {"version": CATALOG_VERSION, "classNames": [], "segments": [], "nextSegment": 1}
+    with open(os.path.join(path, CATALOG_META)) as f:
+        return json.loads(f.read())
+
+
+def writeCatalog(path, meta):
+    tempPath = os.path.join(path, CATALOG_META+".tmp")
+    with open(tempPath, "w") as f:
+        f.write(json.dumps(meta, indent=1))
+    os.replace(tempPath, os.path.join(path, CATALOG_META))
+
+
+class CatalogLock:
+    '''
+    Lock file so an ingest and a compaction never edit catalog.json together,
+    or with name SEGMENTS_LOCK so segments aren't removed while being read
+    '''
+
+    def __init__(self, path, timeout=600, name=CATALOG_META+".lock"):
+        self.lockPath = os.path.join(path, name)
+        self.timeout = timeout
+
+    def __enter__(self):
+        startTime = time.time()
+        while True:
+            try:
+                os.close(os.open(self.lockPath, os.O_CREAT | os.O_EXCL))
+                return self
+            except FileExistsError:
+                if time.time()-startTime > self.timeout:
+                    raise Exception("Timed out waiting for {}".format(self.lockPath))
+                time.sleep(0.1)
+
+    def __exit__(self, *args):
+        os.remove(self.lockPath)
+
+
+def songPart(name, parts):
+    '''
+    returns which of parts a song belongs to, the same on every run
+    '''
+    return zlib.crc32(name.encode("utf-8")) % parts
+
+
+def readSongs(sourcePath, augment=True, budget=None, seed=0, stats=None, part=None, skip=None):
+    '''
+    yields (class name, song name, clips) from a feature store or a json
+    feature folder, class names are relative to sourcePath. augment adds the
+    spread and tempo variants of a store that keeps its events. part is an
+    (index, parts) pair that keeps only the songs songPart puts in index,
+    songs named in skip are left out.
+    '''
+    def inPart(name):
+        if skip is not None and name in skip:
+            return False
+        return part is None or songPart(name, part[1]) == part[0]
+    if FeatureStore.isFeatureStore(sourcePath):
+        store = FeatureStore.openFeatureStore(sourcePath)
+        songs = [x for x in store.songs if inPart(x["name"])]
+        if augment and store.hasEvents():
+            yield from Augmentation.augmentedSongs(store, budget=budget, seed=seed, stats=stats, songs=songs)
+            return
+        for song in songs:
+            yield store.classNames[song["class"]], song["name"], store.songClips(song)
+        return
+    for x in sorted(FileManagement.listAllFiles(sourcePath, relative=True)):
+        className, name = FeatureStore.songName(x)
+        if not inPart(name):
+            continue
+        with open(os.path.join(sourcePath, x)) as f:
+            clips = json.loads(f.read())
+        yield className, name, clips
+
+
+def buildSegment(path, name, songs, classNames, featuresPerClip=None, maxClips=None):
+    '''
+    Writes songs into a new segment folder and indexes it.
+    classNames is the catalog's list, new names are appended to it.
+    With maxClips the segment is closed once it holds that many clips, the
+    rest of the songs iterator is left for the next segment.
+    returns the segment entry for catalog.json, or None if there were no clips
+    '''
+    segmentPath = os.path.join(path, name)
+    classNumbers = {x: i for i, x in enumerate(classNames)}
+    writer = None
+    for className, songName, clips in songs:
+        clips = np.asarray(clips)
+        if len(clips) == 0:
+            continue
+        if writer is None:
+            writer = FeatureStore.FeatureStoreWriter(
+                segmentPath, featuresPerClip or clips.shape[1])
+        if className not in classNumbers:
+            classNumbers[className] = len(classNames)
+            classNames.append(className)
+        writer.addSong(className, songName, clips)
+        if maxClips is not None and writer.clipCount >= maxClips:
+            break
+    if writer is None:
+        return None
+    writer.close()
+
+    store = FeatureStore.openFeatureStore(segmentPath)
+    globalClasses = np.array([classNumbers[x] for x in store.classNames], dtype=np.int32)
+    index = ClipIndex.ClipIndex().fit(store.clips, globalClasses[store.labels()])
+    joblib.dump(index, os.path.join(segmentPath, SEGMENT_INDEX))
+    return {"name": name, "clips": store.clipCount, "songs": len(store.songs),
+            "featuresPerClip": store.featuresPerClip}
+
+
+def appendSegment(path, sourcePath, augment=True, budget=None, chunkClips=None, seed=0, part=None, skip=None):
+    '''
+    Adds the songs in sourcePath as new segments of at least chunkClips clips
+    each (one segment without it), nothing already in the catalog is rebuilt.
+    Variants made from a store's events are only held one segment at a time.
+    part and skip limit the songs like readSongs.
+    returns the entries of the new segments
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    stats = {}
+    songs = readSongs(sourcePath, augment=augment, budget=budget, seed=seed, stats=stats, part=part, skip=skip)
+    entries = []
+    with CatalogLock(path):
+        meta = readCatalog(path)
+        while True:
+            name = "segment-{:06d}".format(meta["nextSegment"])
+            entry = buildSegment(path, name, songs, meta["classNames"], maxClips=chunkClips)
+            if entry is None:
+                break
+            print("Added {} to catalog {} as {}, {} songs, {} clips".format(
+                sourcePath, path, name, entry["songs"], entry["clips"]))
+            meta["nextSegment"] += 1
+            featuresPerClip = meta["segments"][0]["featuresPerClip"] if meta["segments"] else entry["featuresPerClip"]
+            if entry["featuresPerClip"] != featuresPerClip:
+                shutil.rmtree(os.path.join(path, name))
+                raise Exception("Catalog has {} features per clip, not {}".format(
+                    featuresPerClip, entry["featuresPerClip"]))
+            meta["segments"].append(entry)
+            entries.append(entry)
+            # Written per segment so an interrupted run keeps what it finished
+            writeCatalog(path, meta)
+    if len(entries) == 0:
+        print("No features found in {}".format(sourcePath))
+        return entries
+    print("Added {} songs, {} clips in {} segments.".format(
+        sum(x["songs"] for x in entries), sum(x["clips"] for x in entries), len(entries)))
+    if stats:
+        Augmentation.reportSavings(FeatureStore.openFeatureStore(sourcePath), stats)
+    return entries
+
+
+def compact(path, smallSegmentClips=100000):
+    '''
+    Merges every segment with fewer than smallSegmentClips clips into one
+    new segment. The new segment is written before catalog.json is switched
+    over, so queries never see a half merged catalog, and the merged ones
+    are only removed once no reader is loading them.
+    '''
+    with CatalogLock(path):
+        meta = readCatalog(path)
+        small = [x for x in meta["segments"] if x["clips"] < smallSegmentClips]
+        if len(small) < 2:
+            return None
+        name = "segment-{:06d}".format(meta["nextSegment"])
+        meta["nextSegment"] += 1
+        print("Compacting {} segments into {}...".format(len(small), name))
+
+        def smallSongs():
+            for segment in small:
+                store = FeatureStore.openFeatureStore(os.path.join(path, segment["name"]))
+                for song in store.songs:
+                    yield store.classNames[song["class"]], song["name"], store.songClips(song)
+        entry = buildSegment(path, name, smallSongs(), meta["classNames"])
+
+        merged = set(x["name"] for x in small)
+        position = meta["segments"].index(small[0])
+        meta["segments"] = [x for x in meta["segments"] if x["name"] not in merged]
+        meta["segments"].insert(min(position, len(meta["segments"])), entry)
+        with CatalogLock(path, name=SEGMENTS_LOCK):
+            writeCatalog(path, meta)
+            for x in merged:
+                shutil.rmtree(os.path.join(path, x), ignore_errors=True)
+    print("Compacted into {} ({} clips).".format(name, entry["clips"]))
+    return entry
+
+
+def compactInBackground(path, smallSegmentClips=100000):
+    thread = threading.Thread(target=compact, args=(path, smallSegmentClips))
+    thread.start()
+    return thread
+
+
+class SegmentedCatalog:
+    '''
+    Searches every segment of a catalog and merges the results, works with
+    the same query/predict/rankSongs calls as ClipIndex
+    '''
+
+    def __init__(self, path, neighbours=10):
+        self.path = path
+        self.neighbours = neighbours
+        self.classNames = []
+        self.segments = []
+        if not isCatalog(path):
+            return
+        # The indexes are read into memory, after that removing a segment can't hurt
+        with CatalogLock(path, name=SEGMENTS_LOCK):
+            meta = readCatalog(path)
+            self.classNames = meta["classNames"]
+            self.segments = [joblib.load(os.path.join(path, x["name"], SEGMENT_INDEX))
+                             for x in meta["segments"]]
+
+    def query(self, data, neighbours=None):
+        k = neighbours or self.neighbours
+        data = np.asarray(data, dtype=np.float64)
+        if len(self.segments) == 0:
+            return np.zeros((len(data), 0)), np.zeros((len(data), 0), dtype=np.int32)
+        distances = []
+        classes = []
+        for segment in self.segments:
+            d, c = segment.query(data, neighbours=k)
+            distances.append(d)
+            classes.append(c)
+        distances = np.concatenate(distances, axis=1)
+        classes = np.concatenate(classes, axis=1)
+        # Keep the k closest over all segments
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(classes, order, axis=1)
+
+    def predict(self, data):
+        distances, classes = self.query(data, neighbours=1)
+        return classes[:, 0]
+
+    def rankSongs(self, data, top=5):
+        distances, classes = self.query(data)
+        return ClipIndex.rankNeighbours(distances, classes, top=top)
+
+
+def loadCatalog(path):
+    catalog = SegmentedCatalog(path)
+    return catalog, catalog.classNames
@@ -0,0 +1,319 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import threading
+import warnings
+import contextlib
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ClipIndex
+import FeatureStore
+import SegmentedCatalog
+
+# A sharded catalog splits its songs over shards, each one an ordinary
+# segmented catalog. Every shard is searched by its own worker process, or by
+# a node started with "ShardedCatalog.py serve" on another port or machine,
+# and the coordinator sends a query's clips to all of them and merges their
+# nearest neighbours. shards.json lists the shards and the class names of the
+# whole catalog, which only ever get appended to:
+#
+#   shards.json  {"version", "classNames", "shards", "nextShard"}
+#   shard-0001/catalog.json, segment-000001/...
+#
+# Each shard entry lists its song names, so building from the same source
+# again only adds the songs that are new. A shard entry with an "address" is
+# reached over a socket instead of a local process. Queries and replies are
+# pickled, so nodes and coordinators must share a secret key, read from a key
+# file or the TUNEFINDER_SHARD_KEY environment variable and kept out of the
+# repository. Nodes refuse to start without one.
+SHARDS_VERSION = 1
+SHARDS_META = "shards.json"
+KEY_VARIABLE = "TUNEFINDER_SHARD_KEY"
+
+
+def isShardedCatalog(path):
+    return os.path.isfile(os.path.join(path, SHARDS_META))
+
+
+def readShards(path):
+    if not isShardedCatalog(path):
+        return {"version": SHARDS_VERSION, "classNames": [], "shards": [], "nextShard": 1}
+    with open(os.path.join(path, SHARDS_META)) as f:
+        return json.loads(f.read())
+
+
+def writeShards(path, meta):
+    tempPath = os.path.join(path, SHARDS_META+".tmp")
+    with open(tempPath, "w") as f:
+        f.write(json.dumps(meta, indent=1))
+    os.replace(tempPath, os.path.join(path, SHARDS_META))
+
+
+def readKey(keyFile=None):
+    '''
+    returns the secret key nodes and coordinators authenticate each other
+    with, from keyFile or else the TUNEFINDER_SHARD_KEY environment variable,
+    None if neither is set
+    '''
+    if keyFile:
+        with open(keyFile, "rb") as f:
+            key = f.read().strip()
+    else:
+        key = os.environ.get(KEY_VARIABLE, "").encode("utf-8")
+    return key or None
+
+
+def parseAddress(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def buildShard(shardPath, sourcePath, part, skip, augmentSettings):
+    '''
+    Builds one shard from the songs of sourcePath in part that aren't in
+    skip, run in a worker
+    returns the shard's segment entries, class names and song names
+    '''
+    warnings.simplefilter("ignore")
+    # Shards build side by side, their progress would interleave
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        entries = SegmentedCatalog.appendSegment(shardPath, sourcePath, part=part, skip=skip, **augmentSettings)
+    songNames = sorted(set(x["name"] for entry in entries
+                           for x in FeatureStore.openFeatureStore(os.path.join(shardPath, entry["name"])).songs))
+    return entries, SegmentedCatalog.readCatalog(shardPath)["classNames"], songNames
+
+
+def buildShards(path, sourcePath, shards=2, workers=None, augment=True, budget=None, chunkClips=None, seed=0):
+    '''
+    Splits the songs in sourcePath over shards new shards, built in parallel
+    by workers processes (one per shard by default). The shards already in
+    the catalog are left as they are, so adding songs never rebuilds them,
+    and songs they already hold are skipped.
+    returns the entries of the new shards
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    print("Adding {} to sharded catalog {} as {} shards...".format(sourcePath, path, shards))
+    startTime = time.time()
+    augmentSettings = {"augment": augment, "budget": budget, "chunkClips": chunkClips, "seed": seed}
+    with SegmentedCatalog.CatalogLock(path):
+        meta = readShards(path)
+        names = ["shard-{:04d}".format(meta["nextShard"]+i) for i in range(shards)]
+        skip = set(x for entry in meta["shards"] for x in entry.get("songNames", []))
+        with ProcessPoolExecutor(max_workers=workers or shards) as pool:
+            futures = [pool.submit(buildShard, os.path.join(path, name), sourcePath, (i, shards), skip, augmentSettings)
+                       for i, name in enumerate(names)]
+            results = [x.result() for x in futures]
+        meta["nextShard"] += shards
+
+        entries = []
+        for name, (segments, classNames, songNames) in zip(names, results):
+            if len(segments) == 0:
+                # No new song fell in this part
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+                continue
+            for x in classNames:
+                if x not in meta["classNames"]:
+                    meta["classNames"].append(x)
+            entry = {"name": name, "songs": sum(x["songs"] for x in segments),
+                     "clips": sum(x["clips"] for x in segments), "songNames": songNames}
+            meta["shards"].append(entry)
+            entries.append(entry)
+            print("Built {}, {} songs, {} clips".format(name, entry["songs"], entry["clips"]))
+        writeShards(path, meta)
+    print("Added {} songs, {} clips in {} shards in {:.2f}s".format(
+        sum(x["songs"] for x in entries), sum(x["clips"] for x in entries), len(entries), time.time()-startTime))
+    return entries
+
+
+def setAddress(path, shardName, address=None):
+    '''
+    Points a shard at a node serving it, or back at a local process when
+    address is None
+    '''
+    with SegmentedCatalog.CatalogLock(path):
+        meta = readShards(path)
+        entry = next((x for x in meta["shards"] if x["name"] == shardName), None)
+        if entry is None:
+            raise Exception("Sharded catalog {} has no shard {}".format(path, shardName))
+        if address:
+            entry["address"] = address
+        else:
+            entry.pop("address", None)
+        writeShards(path, meta)
+
+
+def serveShard(connection, catalog):
+    '''
+    Answers (clips, neighbours) queries on connection until it gets None or
+    closes. The catalog's class names are sent first so the coordinator can
+    map its class numbers.
+    '''
+    connection.send(catalog.classNames)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        clips, neighbours = request
+        try:
+            connection.send(("ok", catalog.query(clips, neighbours=neighbours)))
+        except Exception as e:
+            connection.send(("error", "{}: {}".format(e.__class__.__name__, e)))
+    connection.close()
+
+
+def shardProcess(connection, shardPath):
+    warnings.simplefilter("ignore")
+    serveShard(connection, SegmentedCatalog.SegmentedCatalog(shardPath))
+
+
+def serveNode(shardPath, host="localhost", port=8100, key=None):
+    '''
+    Serves one shard over a socket, each coordinator connection on its own
+    thread. Only coordinators holding key can connect.
+    '''
+    if not key:
+        raise Exception("No shard key, give a key file or set {}".format(KEY_VARIABLE))
+    catalog = SegmentedCatalog.SegmentedCatalog(shardPath)
+    listener = Listener((host, port), authkey=key)
+    print("Serving {} on {}:{}".format(shardPath, host, port))
+    try:
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=serveShard, args=(connection, catalog), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    listener.close()
+
+
+class ShardedCatalog:
+    '''
+    Coordinator of a sharded catalog. Queries are sent to every shard at once
+    and the nearest neighbours they return are merged, so it works with the
+    same query/predict/rankSongs calls as ClipIndex and gives the same
+    results as one catalog of all the songs.
+    '''
+
+    def __init__(self, path, neighbours=10, key=None):
+        self.path = path
+        self.neighbours = neighbours
+        key = key or readKey()
+        meta = readShards(path)
+        self.classNames = meta["classNames"]
+        classNumbers = {x: i for i, x in enumerate(self.classNames)}
+        self.lock = threading.Lock()
+        self.processes = []
+        self.connections = []
+        for entry in meta["shards"]:
+            if "address" in entry:
+                if not key:
+                    self.close()
+                    raise Exception("Shard {} is served at {}, but no shard key is set, give a key file or set {}".format(
+                        entry["name"], entry["address"], KEY_VARIABLE))
+                connection = Client(parseAddress(entry["address"]), authkey=key)
+            else:
+                connection, child = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=shardProcess, args=(
+                    child, os.path.join(path, entry["name"])), daemon=True)
+                process.start()
+                child.close()
+                self.processes.append(process)
+            self.connections.append(connection)
+        # Shards number their classes in the order they met them
+        self.shardClasses = [np.array([classNumbers[x] for x in connection.recv()], dtype=np.int32)
+                             for connection in self.connections]
+
+    def query(self, data, neighbours=None):
+        k = neighbours or self.neighbours
+        data = np.asarray(data, dtype=np.float64)
+        if len(self.connections) == 0:
+            return np.zeros((len(data), 0)), np.zeros((len(data), 0), dtype=np.int32)
+        with self.lock:
+            # Scatter to every shard before waiting on any of them
+            for connection in self.connections:
+                connection.send((data, k))
+            replies = [connection.recv() for connection in self.connections]
+        distances = []
+        classes = []
+        for (status, reply), shardClasses in zip(replies, self.shardClasses):
+            if status != "ok":
+                raise Exception("Shard query failed: {}".format(reply))
+            distances.append(reply[0])
+            classes.append(shardClasses[reply[1]])
+        distances = np.concatenate(distances, axis=1)
+        classes = np.concatenate(classes, axis=1)
+        # Keep the k closest over all shards
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(classes, order, axis=1)
+
+    def predict(self, data):
+        distances, classes = self.query(data, neighbours=1)
+        return classes[:, 0]
+
+    def rankSongs(self, data, top=5):
+        distances, classes = self.query(data)
+        return ClipIndex.rankNeighbours(distances, classes, top=top)
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+                connection.close()
+            except OSError:
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+        self.connections = []
+        self.processes = []
+
+
+def loadShardedCatalog(path, keyFile=None):
+    catalog = ShardedCatalog(path, key=readKey(keyFile))
+    return catalog, catalog.classNames
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build, serve or point the shards of a sharded catalog")
+    parser.add_argument("command", choices=["build", "serve", "address"],
+                        help="build adds shards, serve runs a node for one shard, address records where a shard's node is")
+    parser.add_argument("catalogPath", type=str, help="Path of the sharded catalog")
+    parser.add_argument("-sp", "--SourcePath", type=str, dest="sourcepath", default=None,
+                        help="Feature store or json feature folder to build shards from")
+    parser.add_argument("-sh", "--Shards", type=int, dest="shards", default=2,
+                        help="Number of shards to split the songs over")
+    parser.add_argument("-w", "--Workers", type=int, dest="workers", default=None,
+                        help="Number of processes to build shards with, one per shard by default")
+    parser.add_argument("-n", "--ShardName", type=str, dest="shardname", default=None,
+                        help="Shard to serve or point, e.g. shard-0001")
+    parser.add_argument("-ad", "--Address", type=str, dest="address", default=None,
+                        help="host:port a node serves on, without it address points the shard back at a local process")
+    parser.add_argument("-kf", "--KeyFile", type=str, dest="keyfile", default=None,
+                        help="File holding the secret key nodes and coordinators share, "
+                        "kept outside the repository. Defaults to the {} environment variable".format(KEY_VARIABLE))
+    args = vars(parser.parse_args())
+
+    warnings.simplefilter("ignore")
+    if args["command"] == "build":
+        if not args["sourcepath"]:
+            print("No source path given")
+            return
+        buildShards(args["catalogPath"], args["sourcepath"], shards=args["shards"], workers=args["workers"])
+    elif not args["shardname"]:
+        print("No shard name given")
+    elif args["command"] == "serve":
+        host, port = parseAddress(args["address"] or "localhost:8100")
+        serveNode(os.path.join(args["catalogPath"], args["shardname"]), host, port, key=readKey(args["keyfile"]))
+    else:
+        setAddress(args["catalogPath"], args["shardname"], args["address"])
+
+
+if __name__ == "__main__":
+    main()
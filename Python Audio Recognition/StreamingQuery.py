@@ -0,0 +1,344 @@
+import os
+import sys
+import time
+import argparse
+import warnings
+import numpy as np
+import ConvertMidiToFeatures
+import MidiDecoder
+import NumpyTranscriber
+import tunefinderTestModel
+
+
+class StreamingQuery:
+    '''
+    Identifies a song while it is still being recorded. Notes are added as
+    they end, into a ring buffer holding the bins of the last secondsPerClip
+    seconds, and every hopSeconds the window is taken as a clip and the
+    clips so far are ranked. Only the new clip goes through the model, its
+    votes are added to running per-song scores that rank the same way
+    tunefinderTestModel.rankBatch ranks all the clips at once. The answer is
+    the first ranking whose top song is confident: at least minClips clips,
+    and a top score that is at least confidence of the top two scores
+    together. A model that uses events, such as a landmark index, is given
+    the notes of the window instead of its clip.
+    '''
+
+    def __init__(self, model, classNames=None, secondsPerClip=8, featuresPerClip=200, hopSeconds=1, confidence=0.75, minClips=3, top=5):
+        self.model = model
+        self.classNames = classNames
+        self.secondsPerClip = secondsPerClip
+        self.featuresPerClip = int(featuresPerClip)
+        self.hopSeconds = hopSeconds
+        self.confidence = confidence
+        self.minClips = minClips
+        self.top = top
+
+        # Velocity weighted note sums of the bins in the window, bin b is
+        # kept in slot b % featuresPerClip
+        self.noteSum = np.zeros(self.featuresPerClip, dtype=np.int64)
+        self.velocitySum = np.zeros(self.featuresPerClip, dtype=np.int64)
+        # Bins before headBin are complete, the window ends at it
+        self.headBin = 0
+        self.now = 0.0
+        self.nextQuery = hopSeconds
+        self.tracker = None
+        # ['note', 'velocity', 'time on', 'time off'] rows of the ended notes
+        # that started in the window, for models that use events
+        self.usesEvents = getattr(model, "usesEvents", False)
+        self.windowEvents = np.zeros((0, 4))
+
+        # class -> [score sum, distance sum or None, votes], over votes in all
+        self.scores = {}
+        self.votes = 0
+        self.clipCount = 0
+        self.queries = 0
+        self.ranked = []
+        self.answer = None
+        self.startTime = None
+        self.answerSeconds = None
+        self.answerStreamSeconds = None
+
+    def binOf(self, times):
+        return ConvertMidiToFeatures.timeToIndexArray(
+            np.asarray(times, dtype=np.float64), self.secondsPerClip, self.featuresPerClip, 0)
+
+    def advance(self, now):
+        '''
+        moves the window up to the stream time now, emptying the slots of
+        the bins it moves onto
+        '''
+        self.now = max(self.now, now)
+        newHead = int(self.binOf([self.now])[0])
+        if newHead <= self.headBin:
+            return
+        if newHead-self.headBin >= self.featuresPerClip:
+            self.noteSum[:] = 0
+            self.velocitySum[:] = 0
+        else:
+            slots = np.arange(self.headBin, newHead) % self.featuresPerClip
+            self.noteSum[slots] = 0
+            self.velocitySum[slots] = 0
+        self.headBin = newHead
+
+    def addEvents(self, events, now=None):
+        '''
+        adds ['note', 'velocity', 'time on', 'time off']s that have ended, in
+        stream seconds. now is how far the stream has got, by default the
+        last time off. Queries the model for every hop passed.
+        returns the rankings made
+        '''
+        if self.startTime is None:
+            self.startTime = time.perf_counter()
+        notes, velocities, timeons, timeoffs = ConvertMidiToFeatures.eventsToArrays(
+            events)
+        if len(timeoffs) > 0:
+            now = timeoffs.max() if now is None else max(now, timeoffs.max())
+        self.advance(self.now if now is None else now)
+        if self.usesEvents:
+            self.windowEvents = np.concatenate([self.windowEvents, np.stack(
+                [notes, velocities, timeons, timeoffs], axis=1).astype(np.float64)])
+
+        # Only the bins still in the window are touched
+        starts = np.maximum(self.binOf(timeons), self.headBin-self.featuresPerClip)
+        ends = np.minimum(self.binOf(timeoffs), self.headBin)
+        lengths = np.maximum(ends-starts, 0)
+        if lengths.sum() > 0:
+            first = np.repeat(starts, lengths)
+            bins = first+np.arange(len(first))-np.repeat(np.cumsum(lengths)-lengths, lengths)
+            slots = bins % self.featuresPerClip
+            np.add.at(self.noteSum, slots, np.repeat(notes*velocities, lengths))
+            np.add.at(self.velocitySum, slots, np.repeat(velocities, lengths))
+
+        rankings = []
+        while self.now >= self.nextQuery:
+            ranked = self.query()
+            if ranked is not None:
+                rankings.append(ranked)
+            self.nextQuery += self.hopSeconds
+        return rankings
+
+    def addAudio(self, samples, sampleRate):
+        '''
+        transcribes mono samples between -1 and 1 and adds the notes that ended
+        '''
+        if self.tracker is None:
+            self.tracker = NumpyTranscriber.NoteTracker(sampleRate)
+        events = self.tracker.feed(samples)
+        return self.addEvents(events, now=self.tracker.frameTime(self.tracker.frame))
+
+    def finish(self):
+        '''
+        ends the notes still sounding and ranks once more
+        returns the final ranking
+        '''
+        if self.tracker is not None:
+            self.addEvents(self.tracker.flush(),
+                           now=self.tracker.frameTime(self.tracker.frame))
+        self.query()
+        return self.ranked
+
+    def window(self):
+        '''
+        returns the window as one normalized clip, or None if too few of its
+        bins hold notes
+        '''
+        slots = np.arange(self.headBin-self.featuresPerClip, self.headBin) % self.featuresPerClip
+        noteSum = self.noteSum[slots]
+        velocitySum = self.velocitySum[slots]
+        # Rounded like midiToFeatureArray
+        occupied = velocitySum > 0
+        divisor = np.where(occupied, velocitySum, 1)
+        averages = ((2000*noteSum + divisor) // (2*divisor)) / 1000
+        averages = np.where(occupied, averages, np.nan)
+        clips, kept = ConvertMidiToFeatures.normalizeArray(averages[None, :])
+        return clips[0] if kept[0] else None
+
+    def addVotes(self, clip):
+        '''
+        adds the votes of one clip, or the window's events, to the running scores
+        '''
+        if self.usesEvents:
+            # Every song's share of the window's landmarks, as one vote
+            for cl, score, offset in self.model.rankSongs(MidiDecoder.toEventArray(clip), top=None):
+                self.scores.setdefault(cl, [0.0, None, 0])[0] += score
+            self.votes += 1
+            return
+        data = clip[None, :]
+        if hasattr(self.model, "rankSongs"):
+            # Neighbours score 1/(1+distance), like ClipIndex.rankNeighbours
+            distances, classes = self.model.query(data)
+            for cl, distance in zip(classes.ravel().tolist(), distances.ravel().tolist()):
+                score = self.scores.setdefault(cl, [0.0, 0.0, 0])
+                score[0] += 1/(1+distance)
+                score[1] += distance
+                score[2] += 1
+            self.votes += distances.size
+        elif hasattr(self.model, "predict_proba"):
+            for cl, probability in zip(self.model.classes_.tolist(), self.model.predict_proba(data)[0].tolist()):
+                self.scores.setdefault(cl, [0.0, None, 0])[0] += probability
+            self.votes += 1
+        else:
+            self.scores.setdefault(int(self.model.predict(data)[0]), [0.0, None, 0])[0] += 1
+            self.votes += 1
+
+    def ranking(self, top):
+        # Ties go to the lower class number, as with np.unique and a stable sort
+        order = sorted(self.scores, key=lambda cl: (-self.scores[cl][0], cl))[:top]
+        return [(int(cl), self.scores[cl][0]/self.votes,
+                 None if self.scores[cl][1] is None else self.scores[cl][1]/self.scores[cl][2]) for cl in order]
+
+    def eventWindow(self):
+        '''
+        returns the ended notes that started in the window, or None if there
+        are none, and drops the ones before it
+        '''
+        self.windowEvents = self.windowEvents[self.windowEvents[:, 2] >= self.now-self.secondsPerClip]
+        return self.windowEvents if len(self.windowEvents) > 0 else None
+
+    def query(self):
+        clip = self.eventWindow() if self.usesEvents else self.window()
+        if clip is None:
+            return None
+        self.addVotes(clip)
+        self.clipCount += 1
+        self.queries += 1
+        self.ranked = self.ranking(self.top)
+        if self.answer is None and self.isConfident(self.ranked):
+            self.answer = self.ranked
+            self.answerSeconds = time.perf_counter()-self.startTime
+            self.answerStreamSeconds = self.now
+        return self.ranked
+
+    def isConfident(self, ranked):
+        if self.clipCount < self.minClips or len(ranked) == 0:
+            return False
+        second = ranked[1][1] if len(ranked) > 1 else 0
+        total = ranked[0][1]+second
+        return total > 0 and ranked[0][1]/total >= self.confidence
+
+    def named(self, ranked):
+        return [(os.path.basename(self.classNames[cl]) if self.classNames else str(cl), score)
+                for cl, score, distance in ranked]
+
+
+def wavChunks(path, chunkSeconds=0.5, realtime=False):
+    '''
+    yields (mono samples, sample rate) from a wav file a chunk at a time,
+    at the pace it would be recorded if realtime is set
+    '''
+    samples, sampleRate = NumpyTranscriber.openWav(path)
+    chunkFrames = max(int(chunkSeconds*sampleRate), 1)
+    startTime = time.perf_counter()
+    for start in range(0, len(samples), chunkFrames):
+        if realtime:
+            time.sleep(max(start/sampleRate-(time.perf_counter()-startTime), 0))
+        yield NumpyTranscriber.toMono(samples[start:start+chunkFrames]), sampleRate
+
+
+def pcmChunks(stream, sampleRate, chunkSeconds=0.5):
+    '''
+    yields (mono samples, sample rate) from raw 16 bit mono pcm on a stream,
+    e.g. a recorder piped into stdin
+    '''
+    chunkBytes = max(int(chunkSeconds*sampleRate), 1)*2
+    while True:
+        data = stream.read(chunkBytes)
+        if not data:
+            return
+        data = data[:len(data)//2*2]
+        yield NumpyTranscriber.toMono(np.frombuffer(data, dtype="<i2")[:, None]), sampleRate
+
+
+def eventChunks(events, chunkSeconds=0.5, realtime=False):
+    '''
+    yields (events, stream time) with each event in the chunk it ends in
+    '''
+    notes, velocities, timeons, timeoffs = ConvertMidiToFeatures.eventsToArrays(
+        events)
+    table = np.stack([notes, velocities, timeons, timeoffs], axis=1)
+    chunkOf = np.floor(timeoffs/chunkSeconds).astype(np.int64)
+    chunkCount = int(chunkOf.max())+1 if len(chunkOf) > 0 else 0
+    startTime = time.perf_counter()
+    for chunk in range(chunkCount):
+        now = (chunk+1)*chunkSeconds
+        if realtime:
+            time.sleep(max(now-(time.perf_counter()-startTime), 0))
+        yield table[chunkOf == chunk].tolist(), now
+
+
+def streamFile(query, inputPath, chunkSeconds=0.5, realtime=False, sampleRate=22050, full=False):
+    '''
+    feeds a wav file, midi file or "-" (pcm on stdin) to query, stopping at
+    the first confident answer unless full is set
+    '''
+    if inputPath == "-":
+        chunks = ((query.addAudio, x) for x in pcmChunks(
+            sys.stdin.buffer, sampleRate, chunkSeconds))
+    elif os.path.splitext(inputPath)[1].lower() == ".wav":
+        chunks = ((query.addAudio, x) for x in wavChunks(
+            inputPath, chunkSeconds, realtime))
+    else:
+        events = ConvertMidiToFeatures.convertMidiToEvents(inputPath)
+        chunks = ((query.addEvents, x) for x in eventChunks(
+            events, chunkSeconds, realtime))
+
+    for add, chunk in chunks:
+        for ranked in add(*chunk):
+            print("{:7.2f}s {}".format(query.now, ", ".join(
+                "{} {:.3f}".format(name, score) for name, score in query.named(ranked))))
+        if query.answer is not None and not full:
+            return query.answer
+    query.finish()
+    return query.answer
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Identify a song from audio or notes as they arrive")
+    parser.add_argument("ModelPath", type=str, help="Path of the model")
+    parser.add_argument("inputPath", type=str,
+                        help="Wav or midi file to stream, or - for 16 bit mono pcm on stdin")
+    parser.add_argument("-cl", "--ClipLength", dest="cliplength", type=float,
+                        help="Clip length the model was built with", default=8)
+    parser.add_argument("-fc", "--FeatureCount", dest="featurecount", type=float,
+                        help="Features per clip the model was built with", default=200)
+    parser.add_argument("-hs", "--HopSeconds", dest="hopseconds", type=float,
+                        help="Seconds of stream between queries", default=1)
+    parser.add_argument("-cs", "--ChunkSeconds", dest="chunkseconds", type=float,
+                        help="Seconds of stream read at a time", default=0.5)
+    parser.add_argument("-cf", "--Confidence", dest="confidence", type=float,
+                        help="Share of the top two scores the top song needs to be the answer", default=0.75)
+    parser.add_argument("-mc", "--MinClips", dest="minclips", type=int,
+                        help="Clips to rank before answering", default=3)
+    parser.add_argument("-k", "--Top", dest="top", type=int,
+                        help="Number of ranked songs to show", default=5)
+    parser.add_argument("-sr", "--SampleRate", dest="samplerate", type=int,
+                        help="Sample rate of pcm read from stdin", default=22050)
+    parser.add_argument("-rt", "--Realtime", dest="realtime", action="store_true",
+                        help="Read files at the pace they'd be recorded")
+    parser.add_argument("-f", "--Full", dest="full", action="store_true",
+                        help="Keep ranking to the end of the stream after answering")
+    args = vars(parser.parse_args())
+
+    warnings.simplefilter("ignore")
+    model, classNames = tunefinderTestModel.loadModel(args["ModelPath"])
+    if model is None:
+        print("Model {} doesn't exist".format(args["ModelPath"]))
+        return
+    query = StreamingQuery(model, classNames, secondsPerClip=args["cliplength"], featuresPerClip=args["featurecount"],
+                           hopSeconds=args["hopseconds"], confidence=args["confidence"], minClips=args["minclips"], top=args["top"])
+    answer = streamFile(query, args["inputPath"], chunkSeconds=args["chunkseconds"], realtime=args["realtime"],
+                        sampleRate=args["samplerate"], full=args["full"])
+    if answer is None:
+        print("No confident answer after {:.2f}s of stream, {} queries".format(
+            query.now, query.queries))
+        if query.ranked:
+            print("Best guess: {}".format(query.named(query.ranked)[0][0]))
+        return
+    print("Answer: {} after {:.2f}s of stream, {:.3f}s to first answer, {} queries".format(
+        query.named(answer)[0][0], query.answerStreamSeconds, query.answerSeconds, query.queries))
+
+
+if __name__ == "__main__":
+    main()
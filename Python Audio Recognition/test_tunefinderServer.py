@@ -0,0 +1,68 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import warnings
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import LandmarkIndex
+import tunefinderBenchmark
+import tunefinderServer
+
+
+class QuietHandler(tunefinderServer.QueryHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class LandmarkServerTest(unittest.TestCase):
+    '''
+    Queries a server backed by a landmark index, which matches the notes of
+    an upload instead of its clips
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        warnings.simplefilter("ignore")
+        cls.folder = tempfile.mkdtemp(prefix="tunefinderServerTest-")
+        tunefinderBenchmark.generateCatalog(cls.folder, songs=4, secondsPerSong=20, querySeconds=10, wav=True)
+        indexPath = os.path.join(cls.folder, "landmarks.db")
+        with tunefinderBenchmark.quiet():
+            LandmarkIndex.buildIndex(indexPath, os.path.join(cls.folder, "midi"))
+            tunefinderServer.QueryHandler.service = tunefinderServer.QueryService(indexPath)
+        cls.server = ThreadingHTTPServer(("localhost", 0), QuietHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://localhost:{}/query".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.folder, ignore_errors=True)
+
+    def post(self, body, contentType):
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": contentType})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def testWavUpload(self):
+        with open(os.path.join(self.folder, "wav", "song0002", "song.wav"), "rb") as f:
+            status, body = self.post(f.read(), "audio/wav")
+        self.assertEqual(status, 200, body)
+        self.assertGreater(body["clips"], 0)
+        self.assertEqual(body["matches"][0]["song"], "song0002")
+
+    def testFeatureUploadRefused(self):
+        status, body = self.post(json.dumps([[0.0]*200]).encode(), "application/json")
+        self.assertEqual(status, 400)
+        self.assertIn("upload a wav file", body["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,395 @@
+import os
+import io
+import json
+import time
+import wave
+import shutil
+import tempfile
+import argparse
+import platform
+import warnings
+import subprocess
+import contextlib
+import numpy as np
+import ConvertMidiToFeatures
+import FeatureStore
+import FileManagement
+import HarmonicCleanup
+import LandmarkIndex
+import NumpyTranscriber
+import QuantizedIndex
+import tunefinderTestModel
+
+# C major scale over two octaves, melodies walk up and down it
+SCALE = [48, 50, 52, 53, 55, 57, 59, 60, 62, 64, 65, 67, 69, 71, 72]
+NOTE_LENGTHS = [0.125, 0.25, 0.25, 0.5, 0.5, 1.0]
+# Numbered like the OFF, VALID and ADD states, which the baseline walk
+# skipped. Held under the melody so the legacy comparison covers them
+LOW_NOTES = [0, 1, 4]
+# Written into every folder the benchmark makes, only those are ever emptied
+FOLDER_MARKER = ".tunefinderBenchmark"
+
+
+def randomMelody(rng, seconds):
+    '''
+    returns ['note', 'velocity', 'time on', 'time off']s of a random melody
+    '''
+    events = []
+    position = int(rng.integers(len(SCALE)))
+    t = 0.0
+    while t < seconds:
+        position = int(np.clip(position+rng.integers(-2, 3), 0, len(SCALE)-1))
+        length = float(rng.choice(NOTE_LENGTHS))
+        velocity = int(rng.integers(60, 120))
+        events.append([SCALE[position], velocity, t, t+length*0.9])
+        # Now and then a chord note under the melody
+        if rng.random() < 0.2 and position >= 4:
+            events.append([SCALE[position-4], velocity//2, t, t+length*0.9])
+        t += length
+    return events
+
+
+def excerpt(events, start, seconds, rng):
+    '''
+    returns the events between start and start+seconds moved to time 0, with
+    the velocities jittered a little like a different recording would
+    '''
+    clipped = []
+    for note, velocity, timeon, timeoff in events:
+        if timeon >= start and timeoff <= start+seconds:
+            velocity = int(np.clip(velocity+rng.integers(-10, 11), 1, 127))
+            clipped.append([note, velocity, timeon-start, timeoff-start])
+    return clipped
+
+
+def synthesiseWav(events, path, sampleRate=22050):
+    '''
+    writes the events as summed sine tones to a 16 bit mono wav
+    '''
+    length = max(x[3] for x in events)+0.5
+    signal = np.zeros(int(length*sampleRate), dtype=np.float64)
+    for note, velocity, timeon, timeoff in events:
+        start = int(timeon*sampleRate)
+        end = int(timeoff*sampleRate)
+        t = np.arange(end-start)/sampleRate
+        frequency = 440*2**((note-69)/12)
+        # Short fades so note edges don't click across the spectrum
+        envelope = np.minimum(1, np.minimum(t, t[::-1])*100)
+        signal[start:end] += velocity/127*envelope*np.sin(2*np.pi*frequency*t)
+    signal /= max(np.abs(signal).max(), 1)
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sampleRate)
+        w.writeframes((signal*32000).astype("<i2").tobytes())
+
+
+def generateCatalog(folder, songs=20, seed=0, secondsPerSong=60, querySeconds=20, wav=False):
+    '''
+    Writes a deterministic synthetic catalog:
+        folder/midi/songNNNN/song.mid       the catalog songs
+        folder/testmidi/songNNNN/query.mid  an excerpt of each song to search for
+        folder/wav/songNNNN/song.wav        sine tone renders, if wav is set
+    '''
+    for i in range(songs):
+        rng = np.random.default_rng([seed, i])
+        name = "song{:04d}".format(i)
+        events = randomMelody(rng, secondsPerSong)
+        start = float(rng.uniform(0, max(secondsPerSong-querySeconds, 0)))
+        query = excerpt(events, start, querySeconds, rng)
+
+        for kind, fileName, songEvents in [("midi", "song.mid", events), ("testmidi", "query.mid", query)]:
+            songFolder = os.path.join(folder, kind, name)
+            os.makedirs(songFolder, exist_ok=True)
+            ConvertMidiToFeatures.convertEventsToMidi(
+                songEvents, os.path.join(songFolder, fileName))
+        if wav:
+            songFolder = os.path.join(folder, "wav", name)
+            os.makedirs(songFolder, exist_ok=True)
+            synthesiseWav(events, os.path.join(songFolder, "song.wav"))
+
+
+def legacyExtrapolateNeighbors(roll):
+    '''
+    The walk left and right from every cell that HarmonicCleanup.extrapolateNeighbors
+    replaced, kept to compare against. The baseline skipped notes numbered
+    like the OFF, VALID and ADD states, HarmonicCleanup dropped that check
+    and so does this copy.
+    '''
+    # Plain lists, indexing a numpy array one cell at a time is slow. Each
+    # run of a note that changes is copied back to the roll at the end.
+    eventgrid = roll.tolist()
+    changed = {}
+    width = len(eventgrid)
+    for i, (vert, notes) in enumerate(zip(eventgrid, HarmonicCleanup.heldNotes(roll))):
+        for note in notes:
+            begin_index = i
+            end_index = i
+            while(begin_index - 1 >= 0 and eventgrid[begin_index-1][note] != HarmonicCleanup.OFF):
+                begin_index -= 1
+
+            while(end_index + 1 < width and eventgrid[end_index+1][note] != HarmonicCleanup.OFF):
+                end_index += 1
+
+            these_notes = list(set([eventgrid[n][note]
+                                    for n in range(begin_index, end_index+1)]))
+
+            val = None
+
+            assert(len(these_notes) > 0)
+            if len(these_notes) == 1:
+                val = vert[note]
+            elif len(these_notes) > 1:
+                if HarmonicCleanup.DELETE in these_notes and HarmonicCleanup.VALID in these_notes:
+                    val = HarmonicCleanup.DELETE
+                elif HarmonicCleanup.DELETE in these_notes and HarmonicCleanup.ADD in these_notes:
+                    val = HarmonicCleanup.CONFLICT_ADD
+                elif HarmonicCleanup.DELETE in these_notes and HarmonicCleanup.FUNDAMENTAL in these_notes:
+                    val = HarmonicCleanup.CONFLICT
+                elif HarmonicCleanup.VALID in these_notes and HarmonicCleanup.FUNDAMENTAL in these_notes:
+                    val = HarmonicCleanup.FUNDAMENTAL
+                elif HarmonicCleanup.VALID in these_notes and HarmonicCleanup.ADD in these_notes:
+                    val = HarmonicCleanup.ADD
+
+            if val != None:
+                for v in range(begin_index, end_index+1):
+                    eventgrid[v][note] = val
+                changed[(begin_index, note)] = (end_index, val)
+    for (begin_index, note), (end_index, val) in changed.items():
+        roll[begin_index:end_index+1, note] = val
+
+
+def withLowNotes(events, seconds=2.0):
+    '''
+    returns the events with LOW_NOTES held under them in turn, each for a
+    few melody notes so its runs cross different chords
+    '''
+    notes, velocities, timeons, timeoffs = ConvertMidiToFeatures.eventsToArrays(events)
+    events = [list(x) for x in zip(notes, velocities, timeons, timeoffs)]
+    end = timeoffs.max() if len(timeoffs) else 0
+    for i, start in enumerate(np.arange(0, end, seconds)):
+        events.append([LOW_NOTES[i % len(LOW_NOTES)], 60, start, min(start+seconds*0.9, end)])
+    return events
+
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def sameRows(a, b):
+    '''
+    returns whether a and b hold the same rows, in any order
+    '''
+    if a.shape != b.shape:
+        return False
+    return bool((a[np.lexsort(a.T[::-1])] == b[np.lexsort(b.T[::-1])]).all())
+
+
+def timeStage(results, name, function, items=None):
+    '''
+    runs function with its output hidden and records how long it took
+    '''
+    startTime = time.perf_counter()
+    with quiet():
+        value = function()
+    seconds = time.perf_counter()-startTime
+    results[name] = {"seconds": seconds}
+    if items is not None:
+        results[name]["items"] = items
+        results[name]["perSecond"] = items/max(seconds, 1e-9)
+    print("{:<24} {:8.3f}s".format(name, seconds))
+    return value
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def prepareFolder(folder):
+    '''
+    makes folder ready for a run, emptying it only if an earlier run made it.
+    A folder that holds anything else is refused.
+    '''
+    if os.path.exists(folder) and len(os.listdir(folder)) > 0:
+        if not os.path.isfile(os.path.join(folder, FOLDER_MARKER)):
+            raise Exception("{} isn't empty and wasn't made by the benchmark, pick another folder".format(folder))
+        shutil.rmtree(folder)
+    os.makedirs(folder, exist_ok=True)
+    open(os.path.join(folder, FOLDER_MARKER), "w").close()
+
+
+def runBenchmark(folder, songs=20, seed=0, secondsPerClip=8, featuresPerClip=200, modelType="tree", wav=False, workers=1):
+    settings = {"songs": songs, "seed": seed, "secondsPerClip": secondsPerClip, "featuresPerClip": featuresPerClip,
+                "modelType": modelType, "wav": wav, "workers": workers}
+    stages = {}
+    prepareFolder(folder)
+    midiFolder = os.path.join(folder, "midi")
+    spread = secondsPerClip-1
+
+    timeStage(stages, "generateCatalog", lambda: generateCatalog(
+        folder, songs=songs, seed=seed, wav=wav), songs)
+    midiFiles = FileManagement.listAllFiles(midiFolder)
+
+    events = timeStage(stages, "convertMidiToEvents", lambda: [
+        ConvertMidiToFeatures.convertMidiToEvents(x, cacheFolder=None) for x in midiFiles], len(midiFiles))
+    # Five times the usual columns per second so notes make long runs
+    rolls = []
+    for x in events:
+        roll = HarmonicCleanup.eventsToRoll(withLowNotes(x), featuresPerSecond=100)
+        HarmonicCleanup.removeHarmonics(roll)
+        rolls.append(roll)
+    legacyRolls = [x.copy() for x in rolls]
+    timeStage(stages, "extrapolateLegacy", lambda: [
+        legacyExtrapolateNeighbors(x) for x in legacyRolls], len(rolls))
+    timeStage(stages, "extrapolateNeighbors", lambda: [
+        HarmonicCleanup.extrapolateNeighbors(x) for x in rolls], len(rolls))
+    stages["extrapolateNeighbors"]["matchesLegacy"] = all(
+        (x == y).all() for x, y in zip(rolls, legacyRolls))
+
+    if wav:
+        wavFiles = FileManagement.listAllFiles(os.path.join(folder, "wav"))
+        transcribed = timeStage(stages, "wavToEvents", lambda: [
+            NumpyTranscriber.wavToEvents(x) for x in wavFiles], len(wavFiles))
+        stages["wavToEvents"]["notes"] = sum(len(x) for x in transcribed)
+
+    spRange, tmpRange = ConvertMidiToFeatures.augmentationRanges(secondsPerClip, spread)
+    clipCount = timeStage(stages, "midiToFeatures", lambda: sum(
+        len(ConvertMidiToFeatures.midiToFeatureArray(x, offsets=spRange, secondsPerClips=[secondsPerClip+j for j in tmpRange],
+                                                     featuresPerClip=featuresPerClip)) for x in events), len(events))
+    stages["midiToFeatures"]["clips"] = clipCount
+
+    storePath = os.path.join(folder, "features")
+    materializedPath = os.path.join(folder, "materializedfeatures")
+    testPath = os.path.join(folder, "testfeatures")
+    timeStage(stages, "folderMidiToFeatures", lambda: ConvertMidiToFeatures.folderMidiToFeatures(
+        midiFolder, storePath, secondsPerClip=secondsPerClip, featuresPerClip=featuresPerClip, spread=spread,
+        outputFormat="store", workers=workers, eventCache=None), len(midiFiles))
+    stages["folderMidiToFeatures"]["storeBytes"] = FeatureStore.openFeatureStore(storePath).bytesOnDisk()
+    # The variants written out like before, to compare sizes and load times with
+    timeStage(stages, "folderMidiToFeaturesMaterialized", lambda: ConvertMidiToFeatures.folderMidiToFeatures(
+        midiFolder, materializedPath, secondsPerClip=secondsPerClip, featuresPerClip=featuresPerClip, spread=spread,
+        outputFormat="store", workers=workers, eventCache=None, materialize=True), len(midiFiles))
+    stages["folderMidiToFeaturesMaterialized"]["storeBytes"] = FeatureStore.openFeatureStore(
+        materializedPath).bytesOnDisk()
+    with quiet():
+        ConvertMidiToFeatures.folderMidiToFeatures(os.path.join(folder, "testmidi"), testPath, secondsPerClip=secondsPerClip,
+                                                   featuresPerClip=featuresPerClip, outputFormat="store", eventCache=None)
+
+    # Materialized clips are memory mapped, copy them so both loads end with the clips in memory
+    materializedClips = timeStage(stages, "loadDataMaterialized", lambda: np.array(tunefinderTestModel.loadData(
+        materializedPath)[0]), clipCount)
+    data, classes, classNames = timeStage(stages, "loadData", lambda: tunefinderTestModel.loadData(
+        storePath), clipCount)
+    stages["loadData"]["matchesMaterialized"] = sameRows(data, materializedClips)
+    del materializedClips
+    model = timeStage(stages, "createModel", lambda: tunefinderTestModel.createModel(
+        data, classes, modelType=modelType), len(data))
+    modelPath = os.path.join(folder, "model.m")
+    tunefinderTestModel.saveModel(modelPath, model, classNames)
+    stages["createModel"]["modelBytes"] = os.path.getsize(modelPath)
+
+    top1, top5 = timeStage(stages, "testMachine", lambda: tunefinderTestModel.testMachineBatch(
+        modelPath, testPath), songs)
+    stages["testMachine"]["top1"] = top1
+    stages["testMachine"]["top5"] = top5
+    compareQuantized(stages, folder, data, classes, classNames, testPath)
+    compareLandmark(stages, folder, storePath, testPath, songs)
+
+    return {"commit": gitCommit(), "python": platform.python_version(), "numpy": np.__version__,
+            "settings": settings, "stages": stages}
+
+
+def compareQuantized(stages, folder, data, classes, classNames, testPath):
+    '''
+    knn over float64 clips against QuantizedIndex over uint8 codes: index
+    memory, query throughput with every training clip as a query, and accuracy
+    '''
+    quantizedTestPath = os.path.join(folder, "quantizedtestfeatures")
+    testStore = FeatureStore.openFeatureStore(testPath)
+    with FeatureStore.FeatureStoreWriter(quantizedTestPath, testStore.featuresPerClip, dtype="uint8") as writer:
+        for song in testStore.songs:
+            writer.addSong(testStore.classNames[song["class"]], song["name"], testStore.songClips(song))
+
+    queries = np.asarray(data, dtype=np.float64)
+    packedQueries = QuantizedIndex.QuantizedClips(QuantizedIndex.pack(queries), queries.shape[1])
+    nearest = {}
+    for name, modelType, clips, testFeatures in [("queryFloat64", "knn", queries, testPath),
+                                                 ("queryQuantized", "quantized", packedQueries, quantizedTestPath)]:
+        with quiet():
+            model = tunefinderTestModel.createModel(data, classes, modelType=modelType)
+        modelPath = os.path.join(folder, modelType+".m")
+        tunefinderTestModel.saveModel(modelPath, model, classNames)
+        distances, found = timeStage(stages, name, lambda: model.query(clips), len(clips))
+        nearest[name] = found[:, 0]
+        if modelType == "knn":
+            stages[name]["indexBytes"] = sum(x.nbytes for x in model.tree.get_arrays())
+        else:
+            stages[name]["indexBytes"] = model.nbytes
+        stages[name]["modelBytes"] = os.path.getsize(modelPath)
+        with quiet():
+            top1, top5 = tunefinderTestModel.testMachineBatch(modelPath, testFeatures)
+        stages[name]["top1"] = top1
+        stages[name]["top5"] = top5
+    stages["queryQuantized"]["nearestMatchesFloat64"] = float(
+        (nearest["queryQuantized"] == nearest["queryFloat64"]).mean())
+
+
+def compareLandmark(stages, folder, storePath, testPath, songs):
+    '''
+    LandmarkIndex built from the store's events and queried with the test
+    songs' events, to compare with the clip models above
+    '''
+    indexPath = os.path.join(folder, "landmarks.db")
+    timeStage(stages, "buildLandmarkIndex", lambda: LandmarkIndex.buildIndex(indexPath, storePath), songs)
+    index, classNames = LandmarkIndex.loadIndex(indexPath)
+    stages["buildLandmarkIndex"].update(index.stats())
+    top1, top5 = timeStage(stages, "queryLandmark", lambda: tunefinderTestModel.testMachineBatch(
+        indexPath, testPath), songs)
+    stages["queryLandmark"]["top1"] = top1
+    stages["queryLandmark"]["top5"] = top5
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time every stage of the pipeline on a synthetic catalog")
+    parser.add_argument("outputPath", type=str,
+                        help="Path of the json file to write results to")
+    parser.add_argument("-f", "--Folder", dest="folder", type=str,
+                        help="Folder to generate the catalog in and keep, a temporary folder that is removed afterwards by default", default=None)
+    parser.add_argument("-n", "--Songs", dest="songs", type=int,
+                        help="Number of songs to generate", default=20)
+    parser.add_argument("-s", "--Seed", dest="seed", type=int,
+                        help="Seed for the generated songs", default=0)
+    parser.add_argument("-cl", "--ClipLength", dest="cliplength", type=float,
+                        help="Length of clips to create features from", default=8)
+    parser.add_argument("-fc", "--FeatureCount", dest="featurecount", type=float,
+                        help="Number of features to take from an audio clip", default=200)
+    parser.add_argument("-mt", "--ModelType", dest="modeltype", choices=[x for x in tunefinderTestModel.MODEL_TYPES if x not in ["catalog", "sharded", "landmark"]],
+                        help="Kind of model to train", default="tree")
+    parser.add_argument("-wv", "--Wav", dest="wav", action="store_true",
+                        help="Also synthesise sine tone wav files for the songs and time transcribing them")
+    parser.add_argument("-w", "--Workers", dest="workers", type=int,
+                        help="Number of processes to convert features with", default=1)
+    args = vars(parser.parse_args())
+
+    warnings.simplefilter("ignore")
+    folder = args["folder"] or tempfile.mkdtemp(prefix="tunefinderBenchmark-")
+    try:
+        results = runBenchmark(folder, songs=args["songs"], seed=args["seed"], secondsPerClip=args["cliplength"],
+                               featuresPerClip=args["featurecount"], modelType=args["modeltype"], wav=args["wav"], workers=args["workers"])
+    finally:
+        if args["folder"] is None:
+            shutil.rmtree(folder, ignore_errors=True)
+    with open(args["outputPath"], "w") as f:
+        f.write(json.dumps(results, indent=1))
+    print("Wrote {}".format(args["outputPath"]))
+
+
+if __name__ == "__main__":
+    main()
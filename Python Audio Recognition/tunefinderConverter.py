@@ -2,6 +2,11 @@ import argparse
 import warnings
 import ConvertWavToMidi
 import ConvertMidiToFeatures
+import FeatureStore
+import FileManagement
+import BuildManifest
+import Metrics
+import IngestPipeline
 import os
 
 
@@ -36,6 +41,40 @@ def main():
                         action="store_true", help="Skip creation of midi from wav if midi already exists")
     search.add_argument("-ss", "--SkipSpread", dest="skipspread",
                         action="store_true", help="Skip the automatic spread of audio, this is used for creating test features")
+    search.add_argument("-of", "--OutputFormat", dest="outputformat", choices=["store", "json"],
+                        help="Write features into one memory mapped feature store, or one json file per song", default="store")
+    search.add_argument("-ma", "--Materialize", dest="materialize", action="store_true",
+                        help="Write every spread and tempo variant into the feature store instead of making them from the stored events at training time")
+    search.add_argument("-dt", "--DataType", dest="datatype", choices=FeatureStore.STORE_DTYPES,
+                        help="Data type of features in the feature store", default="float32")
+    search.add_argument("-w", "--Workers", "--workers", dest="workers", type=int,
+                        help="Number of processes to transcribe and convert features with", default=1)
+    search.add_argument("-tb", "--TranscriberBackend", dest="backend", choices=["waon", "numpy"],
+                        help="Transcribe with the waon executable, or in process with numpy (no midi files are written)", default="waon")
+    search.add_argument("-tr", "--Transcriber", dest="transcriber", type=str,
+                        help="Path of the wav to midi transcriber", default=None)
+    search.add_argument("-ta", "--TranscriberArgs", dest="transcriberargs", type=str,
+                        help="Arguments for the transcriber, {input} and {output} are replaced with the file paths", default=None)
+    search.add_argument("-to", "--Timeout", dest="timeout", type=float,
+                        help="Seconds before a transcription is stopped", default=None)
+    search.add_argument("-rt", "--Retries", dest="retries", type=int,
+                        help="Times to retry a failed transcription", default=0)
+    search.add_argument("-i", "--Incremental", dest="incremental", action="store_true",
+                        help="Only rebuild midis and features whose source files or parameters changed, using a build manifest")
+    search.add_argument("-pl", "--Pipeline", dest="pipeline", action="store_true",
+                        help="Transcribe, decode and take features at the same time, each song moving on as soon as a stage is done with it")
+    search.add_argument("-qs", "--QueueSize", dest="queuesize", type=int,
+                        help="Songs a pipeline stage can hold waiting for the next one", default=IngestPipeline.QUEUE_SIZE)
+    search.add_argument("-mf", "--Manifest", dest="manifest", type=str,
+                        help="Path of the build manifest, defaults to <featurePath>.manifest.json", default=None)
+    search.add_argument("-ec", "--EventCache", dest="eventcache", type=str,
+                        help="Folder to cache decoded midi events in, so an unchanged midi file is only parsed once. Off unless given", default=None)
+    search.add_argument("-ch", "--CleanHarmonics", dest="cleanharmonics", action="store_true",
+                        help="Remove the harmonics of transcribed notes before taking features")
+    search.add_argument("-me", "--Metrics", "--metrics", dest="metrics", type=str,
+                        help="Write per stage timings and counts to this json file", default=None)
+    search.add_argument("-pr", "--Profile", "--profile", dest="profile", type=str,
+                        help="Run cProfile over one named stage, e.g. features. Use with --Workers 1, worker processes aren't profiled", default=None)
     args = vars(parser.parse_args())
     # print(args)
     inputFolder = args["wavPath"]
@@ -47,8 +86,33 @@ def main():
         exit()
 
     warnings.simplefilter("ignore")
-    ConvertWavToMidi.folderWavToMidi(
-        inputFolder, midiFolder, skipExistingMidiFiles=skipMidi)
+    if args["profile"]:
+        Metrics.profile(args["profile"])
+    if args["pipeline"] and args["incremental"]:
+        print("The pipeline doesn't use a build manifest, leave out --Incremental")
+        exit()
+    manifest = None
+    if args["incremental"]:
+        manifestPath = args["manifest"]
+        if manifestPath is None:
+            manifestPath = os.path.normpath(featureFolder)+".manifest.json"
+        manifest = BuildManifest.BuildManifest(manifestPath)
+    plans = []
+
+    transcriberSettings = {"workers": args["workers"], "transcriber": args["transcriber"],
+                           "transcriberArgs": args["transcriberargs"], "timeout": args["timeout"], "retries": args["retries"]}
+    if args["pipeline"]:
+        # Transcription happens inside the pipeline
+        pass
+    elif args["backend"] == "numpy":
+        # Features are made straight from the wav files
+        midiFolder = inputFolder
+    elif manifest:
+        plans.append(incrementalWavToMidi(
+            manifest, inputFolder, midiFolder, transcriberSettings))
+    else:
+        ConvertWavToMidi.folderWavToMidi(
+            inputFolder, midiFolder, skipExistingMidiFiles=skipMidi, **transcriberSettings)
 
     skipFeatures = args["skipfeatures"]
     clipLength = args["cliplength"]
@@ -59,8 +123,127 @@ def main():
         spread = clipLength-1
     tempoSpread = args["tempospread"]
 
-    ConvertMidiToFeatures.folderMidiToFeatures(
-        midiFolder, featureFolder, skipExistingFiles=skipFeatures, secondsPerClip=clipLength, featuresPerClip=featuresPerClip, spread=spread, tempoSpread=tempoSpread)
+    featureSettings = {"secondsPerClip": clipLength, "featuresPerClip": featuresPerClip, "spread": spread, "tempoSpread": tempoSpread,
+                       "outputFormat": args["outputformat"], "storeType": args["datatype"], "workers": args["workers"],
+                       "eventCache": args["eventcache"], "cleanHarmonics": args["cleanharmonics"],
+                       "materialize": args["materialize"],
+                       # Counting removed clips takes the features twice, only done for a metrics run
+                       "countRemovedClips": args["cleanharmonics"] and args["metrics"] is not None}
+    if args["pipeline"]:
+        transcriberSettings.pop("workers")
+        IngestPipeline.runPipeline(inputFolder, midiFolder, featureFolder, backend=args["backend"], skipExistingMidiFiles=skipMidi,
+                                   skipExistingFiles=skipFeatures, queueSize=args["queuesize"], **transcriberSettings, **featureSettings)
+    elif manifest:
+        params = dict(featureSettings, backend=args["backend"])
+        params.pop("workers")
+        params.pop("eventCache")
+        params.pop("countRemovedClips")
+        plans.append(incrementalMidiToFeatures(
+            manifest, midiFolder, featureFolder, featureSettings, params))
+        manifest.save()
+        for plan in plans:
+            print(plan.summary())
+            for output in plan.rebuild:
+                print("  rebuilt {}: {}".format(output, plan.reasons[output]))
+            for output in plan.removed:
+                print("  removed {}: source deleted".format(output))
+    else:
+        ConvertMidiToFeatures.folderMidiToFeatures(
+            midiFolder, featureFolder, skipExistingFiles=skipFeatures, **featureSettings)
+    if args["cleanharmonics"]:
+        reportCleanHarmonics()
+    if args["metrics"]:
+        Metrics.dump(args["metrics"])
+
+
+def reportCleanHarmonics():
+    clean = Metrics.stageTotals.get("cleanHarmonics")
+    if clean is None:
+        print("Harmonic clean up didn't run, no files were converted")
+        return
+    baseline = Metrics.stageTotals.get("cleanHarmonicsBaseline")
+    # Clips are only counted on a --Metrics run, it takes the features twice
+    removedClips = "" if baseline is None else " and {} clips".format(baseline["removedClips"])
+    print("Harmonic clean up removed {} of {} events{} over {} files, adding {:.2f}s".format(
+        clean["removedEvents"], clean["events"], removedClips, clean["calls"], clean["seconds"]))
+
+
+def incrementalWavToMidi(manifest, inputFolder, midiFolder, transcriberSettings):
+    params = {"command": ConvertWavToMidi.__getCommand__(clean=True, transcriber=transcriberSettings["transcriber"],
+                                                         transcriberArgs=transcriberSettings["transcriberArgs"])}
+    sources = {}
+    for x in FileManagement.listAllFiles(inputFolder, relative=True):
+        output = os.path.join(midiFolder, os.path.splitext(x)[0]+".mid")
+        sources[output] = os.path.join(inputFolder, x)
+    plan = manifest.plan("midi", sources, params, os.path.exists)
+
+    for output in plan.removed:
+        if os.path.exists(output):
+            os.remove(output)
+        manifest.forget("midi", output)
+
+    failures = ConvertWavToMidi.scheduleTranscriptions(
+        [[sources[x], x] for x in plan.rebuild], **transcriberSettings)
+    failed = set(x[0] for x in failures)
+    for output in plan.rebuild:
+        if sources[output] in failed:
+            plan.failed.append(output)
+            manifest.forget("midi", output)
+        else:
+            manifest.record("midi", output, sources[output], params)
+    return plan
+
+
+def incrementalMidiToFeatures(manifest, midiFolder, featureFolder, featureSettings, params):
+    useStore = featureSettings["outputFormat"] == "store"
+    files = {}
+    sources = {}
+    for x in FileManagement.listAllFiles(midiFolder, relative=True):
+        if useStore:
+            output = FeatureStore.songName(x)[1]
+        else:
+            output = os.path.join(featureFolder, os.path.splitext(x)[0]+".json")
+        files[output] = x
+        sources[output] = os.path.join(midiFolder, x)
+
+    def storedSongs():
+        if not FeatureStore.isFeatureStore(featureFolder):
+            return set()
+        return set(x["name"] for x in FeatureStore.readMeta(featureFolder)["songs"])
+
+    existing = storedSongs() if useStore else None
+    plan = manifest.plan("features", sources, params,
+                         (lambda x: x in existing) if useStore else os.path.exists)
+
+    # Clear everything that is about to be rebuilt or whose source is gone,
+    # so whatever exists afterwards was built by this run
+    stale = plan.removed + plan.rebuild
+    if useStore:
+        FeatureStore.removeSongs(featureFolder, stale)
+    else:
+        for output in stale:
+            if os.path.exists(output):
+                os.remove(output)
+    for output in plan.removed:
+        manifest.forget("features", output)
+
+    if len(plan.rebuild) > 0:
+        # A store of other clips was emptied above, as the changed settings
+        # rebuild every song, and is written again from scratch
+        append = useStore and FeatureStore.isFeatureStore(featureFolder) and \
+            FeatureStore.readMeta(featureFolder)["featuresPerClip"] == int(featureSettings["featuresPerClip"]) and \
+            FeatureStore.readMeta(featureFolder)["dtype"] == featureSettings["storeType"]
+        ConvertMidiToFeatures.folderMidiToFeatures(midiFolder, featureFolder, skipExistingFiles=append,
+                                                   files=[files[x] for x in plan.rebuild], **featureSettings)
+
+    built = storedSongs() if useStore else None
+    for output in plan.rebuild:
+        if (output in built) if useStore else os.path.exists(output):
+            manifest.record("features", output, sources[output], params)
+        else:
+            plan.failed.append(output)
+            manifest.forget("features", output)
+    return plan
 
 
 if __name__ == "__main__":
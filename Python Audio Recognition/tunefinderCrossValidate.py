@@ -0,0 +1,252 @@
+import io
+import os
+import json
+import time
+import argparse
+import warnings
+import contextlib
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import joblib
+import numpy as np
+import Augmentation
+import ConvertMidiToFeatures
+import FeatureStore
+import LandmarkIndex
+import MidiDecoder
+import tunefinderTestModel
+
+# Songs are the classes, so a fold can't hold a whole song out: a model
+# can't name a song it never saw. Instead every song is cut into folds
+# equal stretches of time, and fold i queries each song with the clips that
+# lie inside its stretch i. Fold i trains on every base and variant clip of
+# the song that doesn't overlap stretch i, so no clip of the queried music,
+# augmented or not, is ever trained on.
+CV_MODEL_TYPES = ["tree", "knn", "quantized"]
+PERCENTILES = [50, 90, 99]
+
+
+def readSongs(sourcePath):
+    '''
+    returns [(class name, events), ...] and the feature store's augmentation
+    settings, None for a folder of midi or wav files
+    '''
+    augmentation = None
+    if FeatureStore.isFeatureStore(sourcePath):
+        augmentation = FeatureStore.openFeatureStore(sourcePath).augmentation
+    songs = [(className, MidiDecoder.toEventArray(events)) for className, name, events in LandmarkIndex.readSongEvents(sourcePath)]
+    return songs, augmentation
+
+
+def configAugmentation(augmentation, secondsPerClip):
+    '''
+    returns the store's augmentation settings for another clip length, the
+    spread follows the clip length like tunefinderConverter's
+    '''
+    augmentation = augmentation or {"offset": 0, "spread": 1, "tempoSpread": 0}
+    return {"offset": augmentation["offset"], "secondsPerClip": secondsPerClip,
+            "spread": secondsPerClip-1 if augmentation["spread"] else 0, "tempoSpread": augmentation["tempoSpread"]}
+
+
+def songClips(events, augmentation, featuresPerClip):
+    '''
+    returns the clips of every (offset, clip length) of a song, with the start
+    and end time of each clip and whether it is a base clip
+    '''
+    base = (augmentation["offset"], augmentation["secondsPerClip"])
+    clips = []
+    starts = []
+    ends = []
+    isBase = []
+    for offset, secondsPerClip in [base]+Augmentation.variantCombos(augmentation):
+        comboClips, comboStarts = ConvertMidiToFeatures.midiToFeatureArray(
+            events, featuresPerClip=featuresPerClip, combos=[(offset, secondsPerClip)], returnStarts=True)
+        clips.append(comboClips)
+        starts.append(comboStarts)
+        ends.append(comboStarts+secondsPerClip)
+        isBase.append(np.full(len(comboClips), (offset, secondsPerClip) == base))
+    return np.concatenate(clips), np.concatenate(starts), np.concatenate(ends), np.concatenate(isBase)
+
+
+def foldSplit(songs, augmentation, featuresPerClip, fold, folds, budget=None, seed=0):
+    '''
+    returns the training clips and classes and the [(class, query clips), ...]
+    of one fold
+    '''
+    rng = np.random.default_rng(seed)
+    trainClips = []
+    trainClasses = []
+    queries = []
+    for classNumber, events in songs:
+        if len(events) == 0:
+            continue
+        clips, starts, ends, isBase = songClips(events, augmentation, featuresPerClip)
+        edges = np.linspace(0, events["off"].max(), folds+1)
+        low, high = edges[fold], edges[fold+1]
+        inside = isBase & (starts >= low) & (ends <= high)
+        train = (ends <= low) | (starts >= high)
+        if budget is not None:
+            # Every base clip, and at most budget variants picked at random
+            variants = np.flatnonzero(train & ~isBase)
+            if len(variants) > budget:
+                train[np.setdiff1d(variants, rng.choice(variants, budget, replace=False))] = False
+        trainClips.append(clips[train])
+        trainClasses.append(np.full(train.sum(), classNumber, dtype=np.int32))
+        if inside.any():
+            queries.append((classNumber, clips[inside]))
+    return np.concatenate(trainClips), np.concatenate(trainClasses), queries
+
+
+def modelBytes(model):
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+    return buffer.tell()
+
+
+def runFold(songs, augmentation, secondsPerClip, featuresPerClip, modelTypes, fold, folds, budget=None, seed=0):
+    '''
+    Runs in a worker process. Fits every model type on one fold of one clip
+    setting and queries it one song at a time.
+    returns {model type: results}
+    '''
+    warnings.simplefilter("ignore")
+    augmentation = configAugmentation(augmentation, secondsPerClip)
+    data, classes, queries = foldSplit(songs, augmentation, featuresPerClip, fold, folds, budget=budget, seed=seed)
+    results = {}
+    for modelType in modelTypes:
+        startTime = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            model = tunefinderTestModel.createModel(data, classes, modelType=modelType)
+        fitSeconds = time.perf_counter()-startTime
+        top1 = 0
+        top5 = 0
+        latencies = []
+        for classNumber, clips in queries:
+            startTime = time.perf_counter()
+            ranked = tunefinderTestModel.rankBatch(model, [clips], top=5)[0]
+            latencies.append(time.perf_counter()-startTime)
+            found = [x[0] for x in ranked]
+            top1 += found[:1] == [classNumber]
+            top5 += classNumber in found
+        results[modelType] = {"fold": fold, "trainClips": len(data), "queries": len(queries), "top1": top1, "top5": top5,
+                              "fitSeconds": fitSeconds, "modelBytes": modelBytes(model), "latencies": latencies}
+    return results
+
+
+def summarise(foldResults):
+    '''
+    joins the results of every fold of one configuration
+    '''
+    queries = sum(x["queries"] for x in foldResults)
+    latencies = np.concatenate([x["latencies"] for x in foldResults] or [np.zeros(0)])
+    summary = {"folds": len(foldResults), "queries": queries,
+               "top1": sum(x["top1"] for x in foldResults)/max(queries, 1),
+               "top5": sum(x["top5"] for x in foldResults)/max(queries, 1),
+               "trainClips": float(np.mean([x["trainClips"] for x in foldResults])),
+               "fitSeconds": float(np.mean([x["fitSeconds"] for x in foldResults])),
+               "modelBytes": float(np.mean([x["modelBytes"] for x in foldResults]))}
+    for p in PERCENTILES:
+        summary["latencyP{}".format(p)] = float(np.percentile(latencies, p)) if len(latencies) > 0 else None
+    return summary
+
+
+def crossValidate(sourcePath, clipLengths=[8], featureCounts=[200], modelTypes=["knn"], folds=5, workers=1, budget=None, seed=0):
+    '''
+    Runs song and time grouped k-fold cross-validation of every combination
+    of clip length, feature count and model type, the folds in parallel.
+    Clips are made from the events of a feature store or a folder of midi
+    or wav files, so any clip length and feature count can be tried.
+    returns [{"secondsPerClip", "featuresPerClip", "modelType", ...summary}, ...]
+    '''
+    if not os.path.exists(sourcePath):
+        raise Exception("{} doesn't exist".format(sourcePath))
+    if folds < 2:
+        raise Exception("Cross-validation needs at least 2 folds, not {}".format(folds))
+    print("Reading songs from {}...".format(sourcePath))
+    songs, augmentation = readSongs(sourcePath)
+    songs = [x for x in songs if len(x[1]) > 0]
+    if len(songs) == 0:
+        raise Exception("No songs with notes found in {}".format(sourcePath))
+    # A query clip has to fit inside one song's stretch of time
+    longest = max(events["off"].max() for className, events in songs)
+    for secondsPerClip in clipLengths:
+        if longest/folds < secondsPerClip:
+            raise Exception("The longest song is {:.1f}s, so {} folds cut it into {:.1f}s stretches, too short for "
+                            "any {:g}s query clip. Use fewer folds or shorter clips".format(
+                                longest, folds, longest/folds, secondsPerClip))
+    classNames = sorted(set(x[0] for x in songs))
+    classNumbers = {x: i for i, x in enumerate(classNames)}
+    songs = [(classNumbers[className], events) for className, events in songs]
+    configs = list(product(clipLengths, featureCounts))
+    print("Cross-validating {} songs, {} folds, {} settings x {} model types...".format(
+        len(songs), folds, len(configs), len(modelTypes)))
+
+    startTime = time.time()
+    foldResults = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(runFold, songs, augmentation, secondsPerClip, featuresPerClip, modelTypes, fold, folds,
+                               budget, seed): (secondsPerClip, featuresPerClip)
+                   for secondsPerClip, featuresPerClip in configs for fold in range(folds)}
+        for done, future in enumerate(as_completed(futures), 1):
+            for modelType, result in future.result().items():
+                foldResults.setdefault(futures[future]+(modelType,), []).append(result)
+            print("\r{}/{} folds, {:.2f}s".format(done, len(futures), time.time()-startTime), end="", flush=True)
+    print()
+
+    results = []
+    for secondsPerClip, featuresPerClip in configs:
+        for modelType in modelTypes:
+            summary = summarise(foldResults[(secondsPerClip, featuresPerClip, modelType)])
+            results.append(dict({"secondsPerClip": secondsPerClip, "featuresPerClip": featuresPerClip,
+                                 "modelType": modelType}, **summary))
+    return results
+
+
+def printResults(results):
+    print("{:>6} {:>8} {:<10} {:>7} {:>7} {:>7} {:>8} {:>10} {}".format(
+        "clip", "features", "model", "queries", "top-1", "top-5", "fit", "size", " ".join(
+            "{:>8}".format("p{}".format(p)) for p in PERCENTILES)))
+    for x in results:
+        print("{:>5g}s {:>8} {:<10} {:>7} {:>6.1%} {:>6.1%} {:>7.2f}s {:>8.1f}MB {}".format(
+            x["secondsPerClip"], x["featuresPerClip"], x["modelType"], x["queries"], x["top1"], x["top5"],
+            x["fitSeconds"], x["modelBytes"]/2**20, " ".join(
+                "{:>6.1f}ms".format(x["latencyP{}".format(p)]*1000) if x["latencyP{}".format(p)] is not None
+                else "{:>8}".format("-") for p in PERCENTILES)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cross-validate clip settings and model types, reporting accuracy, fit time, size and query latency")
+    parser.add_argument("sourcePath", type=str,
+                        help="Feature store that keeps its events, or a folder of midi or wav files")
+    parser.add_argument("-k", "--Folds", dest="folds", type=int,
+                        help="Number of folds each song's time is cut into", default=5)
+    parser.add_argument("-cl", "--ClipLength", dest="cliplength", type=float, nargs="+",
+                        help="Clip lengths to try", default=[8])
+    parser.add_argument("-fc", "--FeatureCount", dest="featurecount", type=int, nargs="+",
+                        help="Features per clip to try", default=[200])
+    parser.add_argument("-mt", "--ModelType", dest="modeltype", choices=CV_MODEL_TYPES, nargs="+",
+                        help="Kinds of model to try", default=["knn"])
+    parser.add_argument("-w", "--Workers", dest="workers", type=int,
+                        help="Number of folds to run at once, use 1 for undisturbed timings", default=1)
+    parser.add_argument("-ab", "--AugmentBudget", dest="augmentbudget", type=int,
+                        help="Most variant clips to train on per song and fold, picked at random", default=None)
+    parser.add_argument("-as", "--AugmentSeed", dest="augmentseed", type=int,
+                        help="Seed for picking variant clips within the budget", default=0)
+    parser.add_argument("-o", "--Output", dest="output", type=str,
+                        help="Write the results to this json file", default=None)
+    args = vars(parser.parse_args())
+
+    warnings.simplefilter("ignore")
+    results = crossValidate(args["sourcePath"], clipLengths=args["cliplength"], featureCounts=args["featurecount"],
+                            modelTypes=args["modeltype"], folds=args["folds"], workers=args["workers"],
+                            budget=args["augmentbudget"], seed=args["augmentseed"])
+    printResults(results)
+    if args["output"]:
+        with open(args["output"], "w") as f:
+            f.write(json.dumps(results, indent=1))
+        print("Wrote {}".format(args["output"]))
+
+
+if __name__ == "__main__":
+    main()
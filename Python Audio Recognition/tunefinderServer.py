@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import queue
+import argparse
+import tempfile
+import threading
+import warnings
+import numpy as np
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import ConvertWavToMidi
+import ConvertMidiToFeatures
+import NumpyTranscriber
+import MidiDecoder
+import tunefinderTestModel
+
+
+class PredictionBatcher:
+    '''
+    Collects the clips of queries arriving at about the same time and runs
+    them through the model in one call
+    '''
+
+    def __init__(self, model, classNames, batchWindow=0.01, maxBatchClips=20000, top=5):
+        self.model = model
+        self.classNames = classNames
+        self.batchWindow = batchWindow
+        self.maxBatchClips = maxBatchClips
+        self.top = top
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.batchedQueries = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def rank(self, clips):
+        '''
+        blocks until the batch holding clips is predicted, returns the ranked matches.
+        Models that use events are given an event array instead of clips.
+        '''
+        if not getattr(self.model, "usesEvents", False):
+            clips = np.asarray(clips, dtype=np.float64)
+        request = {"clips": clips, "done": threading.Event()}
+        self.requests.put(request)
+        request["done"].wait()
+        if "error" in request:
+            raise request["error"]
+        return request["result"]
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            clipCount = len(batch[0]["clips"])
+            deadline = time.time()+self.batchWindow
+            while clipCount < self.maxBatchClips:
+                try:
+                    request = self.requests.get(timeout=max(deadline-time.time(), 0))
+                except queue.Empty:
+                    break
+                batch.append(request)
+                clipCount += len(request["clips"])
+
+            try:
+                results = self.predictBatch([x["clips"] for x in batch])
+                for request, result in zip(batch, results):
+                    request["result"] = result
+            except Exception as e:
+                for request in batch:
+                    request["error"] = e
+            self.batches += 1
+            self.batchedQueries += len(batch)
+            for request in batch:
+                request["done"].set()
+
+    def predictBatch(self, clipLists):
+        return [self.named(x) for x in tunefinderTestModel.rankBatch(self.model, clipLists, top=self.top)]
+
+    def named(self, ranked):
+        matches = []
+        for cl, score, distance in ranked:
+            name = self.classNames[cl] if self.classNames else str(cl)
+            match = {"song": os.path.basename(name), "class": cl, "score": score}
+            if distance is not None:
+                match["distance"] = distance
+            matches.append(match)
+        return matches
+
+
+class QueryService:
+    '''
+    Holds the model and the settings used to turn an upload into clips
+    '''
+
+    def __init__(self, modelPath, secondsPerClip=8, featuresPerClip=200, backend="numpy", transcriber=None, transcriberArgs=None, batchWindow=0.01, top=5):
+        print("Loading model {}...".format(modelPath))
+        model, classNames = tunefinderTestModel.loadModel(modelPath)
+        if model is None:
+            raise Exception("Model {} doesn't exist".format(modelPath))
+        self.secondsPerClip = secondsPerClip
+        self.featuresPerClip = featuresPerClip
+        self.backend = backend
+        self.transcriber = transcriber
+        self.transcriberArgs = transcriberArgs
+        self.batcher = PredictionBatcher(
+            model, classNames, batchWindow=batchWindow, top=top)
+        print("Model loaded.")
+
+    def wavToClips(self, wavData):
+        timings = {}
+        folder = tempfile.mkdtemp()
+        wavPath = os.path.join(folder, "upload.wav")
+        try:
+            with open(wavPath, "wb") as f:
+                f.write(wavData)
+            startTime = time.time()
+            if self.backend == "numpy":
+                events = NumpyTranscriber.wavToEvents(wavPath)
+            else:
+                midiPath = os.path.join(folder, "upload.mid")
+                success, taken, attempts, error = ConvertWavToMidi.runTranscription(
+                    wavPath, midiPath, transcriber=self.transcriber, transcriberArgs=self.transcriberArgs)
+                if not success:
+                    raise Exception("Transcription failed: {}".format(error))
+                events = MidiDecoder.decodeMidi(midiPath)
+            timings["transcribe"] = time.time()-startTime
+        finally:
+            for x in os.listdir(folder):
+                os.remove(os.path.join(folder, x))
+            os.rmdir(folder)
+
+        if getattr(self.batcher.model, "usesEvents", False):
+            # A landmark index matches the notes themselves
+            return MidiDecoder.toEventArray(events), timings
+        startTime = time.time()
+        clips = ConvertMidiToFeatures.midiToFeatureArray(
+            events, secondsPerClips=[self.secondsPerClip], featuresPerClip=self.featuresPerClip)
+        timings["features"] = time.time()-startTime
+        return clips, timings
+
+    def query(self, clips, timings):
+        startTime = time.time()
+        matches = self.batcher.rank(clips) if len(clips) > 0 else []
+        timings["predict"] = time.time()-startTime
+        return {"matches": matches, "clips": len(clips), "timings": timings}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def sendJson(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        # The website pages are opened from disk or another port
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.end_headers()
+
+    def do_GET(self):
+        batcher = self.service.batcher
+        self.sendJson(200, {"status": "ready", "batches": batcher.batches,
+                            "queries": batcher.batchedQueries})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/query":
+            self.sendJson(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        contentType = self.headers.get("Content-Type", "")
+        try:
+            if contentType.startswith("application/json"):
+                if getattr(self.service.batcher.model, "usesEvents", False):
+                    raise Exception("This model matches notes, not features, upload a wav file instead")
+                # Precomputed features, a list of clips or {"features": clips}
+                features = json.loads(body)
+                if isinstance(features, dict):
+                    features = features["features"]
+                clips, timings = np.asarray(features, dtype=np.float64), {}
+            else:
+                clips, timings = self.service.wavToClips(self.readWav(body, contentType))
+            self.sendJson(200, self.service.query(clips, timings))
+        except Exception as e:
+            self.sendJson(400, {"error": "{}: {}".format(e.__class__.__name__, e)})
+
+    def readWav(self, body, contentType):
+        if not contentType.startswith("multipart/form-data"):
+            return body
+        message = BytesParser(policy=HTTP).parsebytes(
+            "Content-Type: {}\r\n\r\n".format(contentType).encode()+body)
+        for part in message.iter_parts():
+            if part.get_param("name", header="content-disposition") == "userfile":
+                return part.get_payload(decode=True)
+        raise Exception("No userfile in the upload")
+
+    def log_message(self, format, *args):
+        print("{} {}".format(self.address_string(), format % args))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve song queries from a model kept in memory")
+    parser.add_argument("ModelPath", type=str, help="Path of the model to serve")
+    parser.add_argument("-p", "--Port", type=int, dest="port",
+                        help="Port to listen on", default=8000)
+    parser.add_argument("-ho", "--Host", type=str, dest="host",
+                        help="Address to listen on", default="localhost")
+    parser.add_argument("-cl", "--ClipLength", dest="cliplength", type=float,
+                        help="Clip length the model was built with", default=8)
+    parser.add_argument("-fc", "--FeatureCount", dest="featurecount", type=float,
+                        help="Features per clip the model was built with", default=200)
+    parser.add_argument("-tb", "--TranscriberBackend", dest="backend", choices=["waon", "numpy"],
+                        help="How uploaded wav files are transcribed", default="numpy")
+    parser.add_argument("-tr", "--Transcriber", dest="transcriber", type=str,
+                        help="Path of the wav to midi transcriber", default=None)
+    parser.add_argument("-ta", "--TranscriberArgs", dest="transcriberargs", type=str,
+                        help="Arguments for the transcriber, {input} and {output} are replaced with the file paths", default=None)
+    parser.add_argument("-bw", "--BatchWindow", dest="batchwindow", type=float,
+                        help="Seconds to wait for more queries to predict together", default=0.01)
+    parser.add_argument("-k", "--Top", dest="top", type=int,
+                        help="Number of ranked songs to return", default=5)
+    args = vars(parser.parse_args())
+
+    warnings.simplefilter("ignore")
+    QueryHandler.service = QueryService(args["ModelPath"], secondsPerClip=args["cliplength"], featuresPerClip=args["featurecount"],
+                                        backend=args["backend"], transcriber=args["transcriber"], transcriberArgs=args["transcriberargs"],
+                                        batchWindow=args["batchwindow"], top=args["top"])
+    server = ThreadingHTTPServer((args["host"], args["port"]), QueryHandler)
+    print("Listening on http://{}:{}/query".format(args["host"], args["port"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
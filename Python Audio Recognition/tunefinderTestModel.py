@@ -1,14 +1,25 @@
 from sklearn import tree
 # from sklearn.impute import SimpleImputer
-from sklearn import svm
 from sklearn.neighbors import KNeighborsRegressor
 import os
 import numpy as np
 import json
-import math
 import joblib
 import FileManagement
+import FeatureStore
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import time
+import ClipIndex
+import QuantizedIndex
+import Metrics
+import Augmentation
+import SegmentedCatalog
+import ShardedCatalog
+import LandmarkIndex
+import ConvertMidiToFeatures
+
+MODEL_TYPES = ["tree", "knn", "quantized", "catalog", "sharded", "landmark"]
 
 
 def main():
@@ -19,10 +30,34 @@ def main():
                         help="Path of features to test", dest="TestPath", default=None)
     parser.add_argument("-tf", "--TrainFolder", type=str,
                         required=False, help="Path of folder to train model", default=None, dest="TrainFolder")
+    parser.add_argument("-mt", "--ModelType", type=str, choices=MODEL_TYPES,
+                        help="Kind of model to train", default="tree", dest="ModelType")
+    parser.add_argument("-k", "--Top", type=int,
+                        help="Number of ranked songs to show for models that rank", default=5, dest="Top")
+    parser.add_argument("-c", "--Compact", action="store_true", dest="Compact",
+                        help="Merge the small segments of a catalog model in the background")
+    parser.add_argument("-me", "--Metrics", "--metrics", type=str, dest="Metrics", default=None,
+                        help="Write per stage timings and counts to this json file")
+    parser.add_argument("-pr", "--Profile", "--profile", type=str, dest="Profile", default=None,
+                        help="Run cProfile over one named stage, e.g. createModel")
+    parser.add_argument("-na", "--NoAugment", action="store_true", dest="NoAugment",
+                        help="Train on the clips in the feature store only, without making spread and tempo variants from its events")
+    parser.add_argument("-ab", "--AugmentBudget", type=int, dest="AugmentBudget", default=None,
+                        help="Most variant clips to make per song, picked at random")
+    parser.add_argument("-as", "--AugmentSeed", type=int, dest="AugmentSeed", default=0,
+                        help="Seed for picking variant clips within the budget")
+    parser.add_argument("-cc", "--ChunkClips", type=int, dest="ChunkClips", default=Augmentation.CHUNK_CLIPS,
+                        help="Clips to make at a time while training, a catalog model gets one segment per chunk")
+    parser.add_argument("-sh", "--Shards", type=int, dest="Shards", default=2,
+                        help="Number of shards to split new songs over for a sharded model, built in parallel")
+    parser.add_argument("-b", "--Batch", action="store_true", dest="Batch",
+                        help="Predict every test clip in one call, vote per song and report top-1/top-5 accuracy")
     # parser.add_argument("-fn", "--FileNames", type=str,
     #                     help="Path to file containing names for results from model", default=None, dest="FileNames")
 
     args = vars(parser.parse_args())
+    if args["Profile"]:
+        Metrics.profile(args["Profile"])
     modelPath = args["ModelPath"]
     testPath = args["TestPath"]
     trainFolder = args["TrainFolder"]
@@ -32,40 +67,87 @@ def main():
         print("No valid parameters given")
         exit()
 
+    augmentSettings = {"augment": not args["NoAugment"], "budget": args["AugmentBudget"],
+                       "chunkClips": args["ChunkClips"], "seed": args["AugmentSeed"]}
     if not (os.path.exists(modelPath) or trainFolder):
         print("Model not supplied")
         exit()
+    elif trainFolder and args["ModelType"] == "landmark" and os.path.exists(modelPath) and \
+            not LandmarkIndex.isLandmarkIndex(modelPath):
+        print("{} holds another kind of model, not a landmark index, give a new model path".format(modelPath))
+        exit()
+    elif trainFolder and (args["ModelType"] == "landmark" or LandmarkIndex.isLandmarkIndex(modelPath)):
+        # Built from the notes of the songs, not their clips
+        LandmarkIndex.buildIndex(modelPath, trainFolder)
+    elif trainFolder and (args["ModelType"] == "sharded" or ShardedCatalog.isShardedCatalog(modelPath)):
+        # New songs go to new shards, the others aren't rebuilt
+        ShardedCatalog.buildShards(modelPath, trainFolder, shards=args["Shards"], **augmentSettings)
+    elif trainFolder and (args["ModelType"] == "catalog" or SegmentedCatalog.isCatalog(modelPath)):
+        # Catalogs only index the new songs
+        SegmentedCatalog.appendSegment(modelPath, trainFolder, **augmentSettings)
     elif trainFolder:
-        data, classes, classNames = loadData(trainFolder)
-        model = createModel(data, classes)
+        data, classes, classNames = loadData(trainFolder, **augmentSettings)
+        model = createModel(data, classes, modelType=args["ModelType"])
         saveModel(modelPath, model, classNames)
 
+    compaction = None
+    if args["Compact"] and SegmentedCatalog.isCatalog(modelPath):
+        compaction = SegmentedCatalog.compactInBackground(modelPath)
+
     if testPath:
         if not os.path.exists(testPath):
             print("Path for testing doesn't exist")
             exit()
-        testMachine(modelPath, testPath)
+        if args["Batch"]:
+            testMachineBatch(modelPath, testPath, top=args["Top"])
+        else:
+            testMachine(modelPath, testPath, top=args["Top"])
+    if compaction:
+        compaction.join()
+    if args["Metrics"]:
+        Metrics.dump(args["Metrics"])
     # print(args)
 
 
-def testMachine(modelPath, testPath):
+def testMachine(modelPath, testPath, top=5):
     clf, filenames = loadModel(modelPath)
     names = filenames
-    files = FileManagement.listAllFilesPerDir(testPath)
+    files = listTests(testPath)
+    load = loadTestEvents if getattr(clf, "usesEvents", False) else loadTest
+    queryCount = 0
+    clipCount = 0
+    startTime = time.time()
     for x in files.keys():
         featfiles = files[x]
         for y in featfiles:
-            dat = loadTest(y)
+            dat = load(y)
             # print(dat)
-            if dat != []:
-                pred = clf.predict(dat).tolist()
+            if len(dat) > 0:
+                queryCount += 1
+                clipCount += len(dat)
+                if hasattr(clf, "rankSongs"):
+                    with Metrics.stage("predict", testName(y), queries=1, clips=len(dat)):
+                        ranked = clf.rankSongs(dat, top=top)
+                    print("Actual: {}".format(os.path.basename(testName(y))))
+                    for i, (cl, score, distance) in enumerate(ranked):
+                        if filenames:
+                            cl = names[cl]
+                        print("{}. {} (score {:.3f}, {} {:.2f})".format(
+                            i+1, os.path.basename(cl), score, "at" if load is loadTestEvents else "distance", distance))
+                    print()
+                    continue
+                with Metrics.stage("predict", testName(y), queries=1, clips=len(dat)):
+                    pred = clf.predict(dat).tolist()
                 # print(pred)
                 # cl = pred.index(max(pred[0]))
                 cl = pred[0]
                 if filenames:
                     cl = names[cl]
                 print("Predicted: {}\nActual: {}\n".format(
-                    os.path.basename(cl), os.path.basename(y)))
+                    os.path.basename(cl), os.path.basename(testName(y))))
+    elapsed = max(time.time()-startTime, 1e-9)
+    print("{} queries ({} clips) in {:.2f}s, {:.2f} queries/s".format(
+        queryCount, clipCount, elapsed, queryCount/elapsed))
 
     # for x in files.keys():
     #     featfiles = files[x]
@@ -100,17 +182,94 @@ def testMachine(modelPath, testPath):
         # print()
 
 
-def testModelOnFile(featurePath, testPath):
-    data, cleanClasses, classes = loadData(featurePath)
-
-    clf = svm.SVC(probability=True).fit(data, cleanClasses)
-    joblib.dump(clf, "model.m")
-    print(clf.predict_proba([loadTest(testPath)]))
-    for i, x in enumerate(classes):
-        print("{}: {}".format(i, x))
+def rankBatch(clf, clipLists, top=5):
+    '''
+    Runs the clips of many queries through the model in one call, models
+    that use events take a list of event arrays instead.
+    returns [(class, score, mean distance or None), ...] best first for each query
+    '''
+    if getattr(clf, "usesEvents", False):
+        return [clf.rankSongs(x, top=top) for x in clipLists]
+    sizes = [len(x) for x in clipLists]
+    splits = np.cumsum(sizes)[:-1]
+
+    if hasattr(clf, "rankSongs"):
+        # Clips from a uint8 store stay packed for a QuantizedIndex
+        data = QuantizedIndex.concatenate(clipLists)
+        distances, classes = clf.query(data)
+        return [ClipIndex.rankNeighbours(d, c, top=top)
+                for d, c in zip(np.split(distances, splits), np.split(classes, splits))]
+
+    data = np.concatenate([np.asarray(x, dtype=np.float64) for x in clipLists])
+    results = []
+    if hasattr(clf, "predict_proba"):
+        # Average the class probabilities of every clip of the query
+        probabilities = clf.predict_proba(data)
+        for part in np.split(probabilities, splits):
+            mean = part.mean(axis=0)
+            order = np.argsort(-mean, kind="stable")[:top]
+            results.append([(int(clf.classes_[i]), float(mean[i]), None) for i in order])
+        return results
+
+    votes = clf.predict(data)
+    for part in np.split(votes, splits):
+        found, counts = np.unique(part, return_counts=True)
+        order = np.argsort(-counts, kind="stable")[:top]
+        results.append([(int(found[i]), float(counts[i])/len(part), None) for i in order])
+    return results
+
+
+def testMachineBatch(modelPath, testPath, top=5):
+    '''
+    Evaluates every test at once, the actual song of a test is the name of
+    the folder it is in
+    '''
+    clf, filenames = loadModel(modelPath)
+    files = listTests(testPath)
+    load = loadTestEvents if getattr(clf, "usesEvents", False) else loadTest
+    tests = []
+    clipLists = []
+    for x in files.keys():
+        for y in files[x]:
+            dat = load(y)
+            if len(dat) > 0:
+                tests.append((x, y))
+                clipLists.append(dat)
+    if len(tests) == 0:
+        print("No test features found")
+        return
+
+    startTime = time.time()
+    with Metrics.stage("predict", queries=len(clipLists), clips=sum(len(x) for x in clipLists)):
+        ranked = rankBatch(clf, clipLists, top=max(top, 5))
+    elapsed = max(time.time()-startTime, 1e-9)
+
+    top1 = 0
+    top5 = 0
+    for (folder, test), songs in zip(tests, ranked):
+        predicted = [os.path.basename(filenames[cl] if filenames else str(cl))
+                     for cl, score, distance in songs]
+        actual = os.path.basename(os.path.normpath(folder))
+        top1 += predicted[:1] == [actual]
+        top5 += actual in predicted[:5]
+        print("Predicted: {}\nActual: {} ({})\n".format(
+            ", ".join(predicted[:top]), actual, os.path.basename(testName(test))))
+
+    clipCount = sum(len(x) for x in clipLists)
+    print("Top-1 accuracy: {:.2%}, top-5 accuracy: {:.2%}".format(
+        top1/len(tests), top5/len(tests)))
+    print("{} queries ({} clips) in {:.2f}s, {:.2f} queries/s".format(
+        len(tests), clipCount, elapsed, len(tests)/elapsed))
+    return top1/len(tests), top5/len(tests)
 
 
 def loadModel(path):
+    if LandmarkIndex.isLandmarkIndex(path):
+        return LandmarkIndex.loadIndex(path)
+    if ShardedCatalog.isShardedCatalog(path):
+        return ShardedCatalog.loadShardedCatalog(path)
+    if SegmentedCatalog.isCatalog(path):
+        return SegmentedCatalog.loadCatalog(path)
     if os.path.exists(path):
         model, classes = joblib.load(path)
         # classes = joblib.load(os.path.join(
@@ -129,68 +288,170 @@ def saveModel(path, data, ClassNames):
 
 
 def loadTest(path):
+    '''
+    path is either a json feature file, or a (store, song) pair from listTests
+    '''
+    if isinstance(path, tuple):
+        store, song = path
+        return store.songClips(song)
     with open(path) as f:
         return json.loads(f.read())
 
 
-def testModel(data, classes, iters=100):
-    testdata = []
-    testclass = []
-    for i in range(iters):
-        a = math.floor(random.random()*len(data))
-        testdata.append(data.pop(a))
-        testclass.append(classes.pop(a))
-
-    clf = svm.SVC(probability=True)
-    # clf = tree.DecisionTreeClassifier()
-
-    clf = clf.fit(data, classes)
-    right = 0
-    for d, c in zip(testdata, testclass):
-        # print()
-        predictedArray = clf.predict_proba([d]).tolist()[0]
-        # print(predictedArray)
-        # print(c)
-
-        predictedClass = predictedArray.index(max(predictedArray))
-        if predictedClass == c:
-            right += 1
-    right /= len(testdata)
-    return right
-
-
-def loadData(path):
-    data = []
+def loadTestEvents(path):
+    '''
+    path is a midi or wav file, or a (store, song) pair from listTests of a
+    feature store that keeps its events
+    '''
+    if isinstance(path, tuple):
+        store, song = path
+        if "eventCount" not in song:
+            raise Exception("Feature store {} doesn't keep the events of {}, convert it again".format(
+                store.path, song["name"]))
+        return store.songEvents(song)
+    return ConvertMidiToFeatures.loadEvents(path)
+
+
+def listTests(testPath):
+    '''
+    returns {folder: [test, ...]} for a json feature folder or a feature store,
+    each test can be passed to loadTest
+    '''
+    if FeatureStore.isFeatureStore(testPath):
+        store = FeatureStore.openFeatureStore(testPath)
+        perClass = store.songsPerClass()
+        return {x: [(store, song) for song in perClass[x]] for x in perClass}
+    return FileManagement.listAllFilesPerDir(testPath)
+
+
+def testName(test):
+    if isinstance(test, tuple):
+        return test[1]["name"]
+    return test
+
+
+def countClips(path):
+    '''
+    returns the number of clips in a json feature file without parsing it,
+    the file is a list of lists of numbers so every "[" but the first opens a clip
+    '''
+    with open(path, "rb") as f:
+        return max(f.read().count(b"[")-1, 0)
+
+
+def loadData(path, threads=8, augment=True, budget=None, chunkClips=Augmentation.CHUNK_CLIPS, seed=0):
+    '''
+    augment adds the spread and tempo variants of a feature store that keeps
+    its events, budget limits them per song
+    '''
+    with Metrics.stage("loadData") as counts:
+        data, labels, classNames = readData(path, threads, augment=augment, budget=budget,
+                                            chunkClips=chunkClips, seed=seed)
+        counts["clips"] = len(data)
+        counts["bytes"] = data.nbytes+labels.nbytes
+    return data, labels, classNames
+
+
+def readData(path, threads=8, augment=True, budget=None, chunkClips=Augmentation.CHUNK_CLIPS, seed=0):
     classes = []
-    cleanClasses = []
     count = 0
     print("Loading Data...")
-
+    startTime = time.time()
+    if FeatureStore.isFeatureStore(path):
+        store = FeatureStore.openFeatureStore(path)
+        if augment and store.hasEvents():
+            return readAugmented(store, startTime, budget, chunkClips, seed)
+        # Zero copy, the clips stay memory mapped
+        labels = store.labels()
+        reportLoad(startTime, store.clips, labels)
+        return store.clips, labels, store.classNames
+
+    # First pass counts the clips so the arrays can be allocated once
     allfiles = FileManagement.listAllFilesPerDir(path)
+    fileClasses = []
     for di in allfiles:
         classes.append(di)
-        fileList = allfiles[di]
-        for fName in fileList:
-            with open(fName) as f:
-                fData = json.loads(f.read())
-
-            data.extend(fData)
-            for i in range(len(fData)):
-                cleanClasses.append(count)
-
+        fileClasses.extend((fName, count) for fName in allfiles[di])
         count += 1
-    print("Loaded.")
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        clipCounts = list(pool.map(countClips, [x[0] for x in fileClasses]))
+
+    starts = np.concatenate([[0], np.cumsum(clipCounts)]).astype(np.int64)
+    width = 0
+    for (fName, cl), clipCount in zip(fileClasses, clipCounts):
+        if clipCount > 0:
+            width = len(loadTest(fName)[0])
+            break
+    data = np.empty((int(starts[-1]), width), dtype=np.float32)
+    cleanClasses = np.empty(int(starts[-1]), dtype=np.int32)
+
+    # Second pass parses each file straight into its slice
+    def loadFile(i):
+        fName, cl = fileClasses[i]
+        fData = loadTest(fName)
+        if len(fData) != clipCounts[i]:
+            raise Exception("{} has {} clips, expected {}".format(
+                fName, len(fData), clipCounts[i]))
+        if len(fData) > 0:
+            data[starts[i]:starts[i+1]] = fData
+        cleanClasses[starts[i]:starts[i+1]] = cl
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(loadFile, range(len(fileClasses))))
+
+    reportLoad(startTime, data, cleanClasses)
     return data, cleanClasses, classes
 
 
-def createModel(data, classes):
+def readAugmented(store, startTime, budget, chunkClips, seed):
+    '''
+    The tree and knn models fit on every clip at once, so the chunks are
+    copied into one array, sized up front so only one chunk is held besides
+    it. Catalogs take them a chunk at a time instead.
+    '''
+    stats = {}
+    rows = Augmentation.trainingRows(store, budget=budget)
+    if rows == 0:
+        return store.clips, store.labels(), store.classNames
+    # A uint8 store stays packed
+    data = np.empty((rows, store.rowBytes), dtype=np.uint8) if store.quantized else np.empty(
+        (rows, store.featuresPerClip), dtype=np.float32)
+    labels = np.empty(rows, dtype=np.int32)
+    filled = 0
+    for clips, classes in Augmentation.trainingChunks(store, chunkClips=chunkClips, budget=budget, seed=seed, stats=stats):
+        data[filled:filled+len(classes)] = QuantizedIndex.pack(clips) if store.quantized else clips
+        labels[filled:filled+len(classes)] = classes
+        filled += len(classes)
+    # The row count is an upper bound, sparse variant clips are dropped
+    data.resize((filled, data.shape[1]), refcheck=False)
+    labels.resize(filled, refcheck=False)
+    if store.quantized:
+        data = QuantizedIndex.QuantizedClips(data, store.featuresPerClip)
+    reportLoad(startTime, data, labels)
+    Augmentation.reportSavings(store, stats, time.time()-startTime-stats.get("seconds", 0))
+    return data, labels, store.classNames
+
+
+def reportLoad(startTime, data, labels):
+    elapsed = max(time.time()-startTime, 1e-9)
+    print("Loaded {} clips, {:.1f} MB in {:.2f}s, {:.0f} clips/s".format(
+        len(data), (data.nbytes+labels.nbytes)/2**20, elapsed, len(data)/elapsed))
+
+
+def createModel(data, classes, modelType="tree"):
 
     print("Fitting Data... (This may take a while)")
+    startTime = time.time()
     # clf = svm.SVC().fit(data, classes)
-    clf = tree.DecisionTreeClassifier().fit(data, classes)
+    with Metrics.stage("createModel", clips=len(data)):
+        if modelType == "knn":
+            clf = ClipIndex.ClipIndex().fit(data, classes)
+        elif modelType == "quantized":
+            clf = QuantizedIndex.QuantizedIndex().fit(data, classes)
+        else:
+            clf = tree.DecisionTreeClassifier().fit(data, classes)
     # clf = KNeighborsRegressor(n_neighbors=10).fit(data, classes)
 
-    print("Finished fitting model")
+    print("Finished fitting model in {:.2f}s".format(time.time()-startTime))
     return clf
 
 
@@ -1,8 +1,26 @@
 alert("hello")
 var k;
 k=document.getElementById("userfile");
+// tunefinderServer.py running on this machine
+var queryUrl="http://localhost:8000/query";
 k.onchange=function(){
-	alert(k.value)
+	var form=new FormData();
+	form.append("userfile",k.files[0]);
+	document.getElementById("find").value="Searching...";
+	fetch(queryUrl,{method:"POST",body:form})
+	.then(function(response){return response.json();})
+	.then(function(result){
+		if(result.error){
+			document.getElementById("find").value=result.error;
+		}else if(result.matches.length==0){
+			document.getElementById("find").value="No match found";
+		}else{
+			document.getElementById("find").value=result.matches.map(function(m){return m.song;}).join(", ");
+		}
+	})
+	.catch(function(){
+		document.getElementById("find").value="Search server isn't running";
+	});
 	//	href="\Users\thain2\Documents\Senior project\audiosearch.html"
 };
 